@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 import django
@@ -42,6 +43,7 @@ if django.VERSION[:2] >= (1, 8):
     INSTALLED_APPS += ('formtools', )
 
 MIDDLEWARE_CLASSES = (
+    'expenses.instrumentation.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -88,12 +90,31 @@ TEMPLATES = [
             'context_processors': [
                 'django.contrib.auth.context_processors.auth',
                 "django.template.context_processors.i18n",
+                'expenses.groups.context_processor',
             ],
             'debug': DEBUG,
         }
     },
 ]
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Slowest requests, shared by the server processes and the slow_requests command
+    'instrumentation': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'expenses-instrumentation'),
+    },
+    # Bill wizards in progress, shared by the server processes and never culled, see expenses.wizard_storage
+    # (the table is created by "manage.py createcachetable")
+    'wizard': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'expenses_wizard_cache',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -120,3 +141,24 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+
+
+# Expenses
+
+EXPENSES_HISTORY_PAGE_SIZE = 10
+EXPENSES_HISTORY_MAX_PAGE_SIZE = 100
+EXPENSES_BALANCE_HISTORY_MAX_DAYS = 3660
+EXPENSES_SLOW_REQUESTS_SIZE = 50  # Slowest requests kept by the instrumentation middleware
+EXPENSES_SLOW_REQUESTS_STATEMENTS = 5  # Most repeated statements kept for each of them
+EXPENSES_SLOW_REQUESTS_CACHE = 'instrumentation'  # Alias of a cache shared by the processes, holding nothing else
+EXPENSES_CACHE = 'default'  # Alias of the cache of the pages, may be local to each process: see expenses.caching
+EXPENSES_CACHE_TIMEOUT = 3600
+EXPENSES_NOTIFY_BY_EMAIL = False  # Mail the people involved in a new bill, from the run_tasks worker
+EXPENSES_TASK_MAX_ATTEMPTS = 5
+# Compact storage of the bill wizard: CompactCacheStorage (EXPENSES_WIZARD_CACHE) or CompactCookieStorage
+# (signed cookie, dropped by the browsers over 4 KB, i.e. past a few dozen participants). The session by default.
+EXPENSES_WIZARD_STORAGE = 'expenses.wizard_storage.CompactCacheStorage'
+EXPENSES_WIZARD_CACHE = 'wizard'  # Alias of a cache shared by the processes, holding nothing else
+EXPENSES_WIZARD_TIMEOUT = 86400
+EXPENSES_PARTICIPANT_SEARCH_LIMIT = 20  # Users returned by a search of the participant picker
+EXPENSES_PARTICIPANT_SUGGESTIONS = 8
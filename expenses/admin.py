@@ -1,5 +1,7 @@
 from django.contrib import admin
-from expenses.models import Atom, Bill, ExtendedUser, Category, User
+from django.core.exceptions import ValidationError
+from django.forms.models import BaseInlineFormSet
+from expenses.models import Atom, Bill, ExtendedUser, Category, ExpenseGroup, Membership, Task, User
 from django.contrib.auth.admin import UserAdmin
 
 
@@ -7,9 +9,30 @@ class ExtendedUserInline(admin.StackedInline):
     model = ExtendedUser
 
 
+class MembershipFormSet(BaseInlineFormSet):
+    def clean(self):
+        super().clean()
+        deleted = [form.instance.pk for form in self.deleted_forms if form.instance.pk is not None]
+        protected = Membership.objects.filter(pk__in=deleted).with_atoms().select_related('user')
+        if protected:
+            raise ValidationError("These members have bills in the group: %s" % ', '.join(
+                str(membership.user) for membership in protected))
+
+
+class MembershipInline(admin.TabularInline):
+    model = Membership
+    formset = MembershipFormSet
+    readonly_fields = ('balance', )
+
+
+class ExpenseGroupAdmin(admin.ModelAdmin):
+    inlines = (MembershipInline, )
+
+
 class UserAdmin(UserAdmin):
     inlines = (ExtendedUserInline, )
 
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
-admin.site.register([Atom, Bill, Category])
+admin.site.register([Atom, Bill, Category, Task])
+admin.site.register(ExpenseGroup, ExpenseGroupAdmin)
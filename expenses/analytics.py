@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spending per user or per category within an ```ExpenseGroup```, by day, week or month.
+
+The reports read the daily rollups ```UserSpending``` and ```CategorySpending``` of the group instead of the bills.
+The atom write paths queue the refresh of the days they touch, see ```refresh_day```. ```rebuild``` and ```check```
+recompute the rollups from the raw ```Bill```/```Atom``` data.
+"""
+import datetime
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+
+from expenses.models import Atom, Bill, CategorySpending, UserSpending, start_of_day
+
+
+ROLLUPS = {
+    'user': UserSpending,
+    'category': CategorySpending,
+}
+
+PERIODS = ('day', 'week', 'month')
+
+CENT = Decimal('0.01')
+
+
+def key_field(by):
+    """
+    Returns the name of the field of the rollups ``by`` user or category holding the user or category id.
+    """
+    return ROLLUPS[by].counter_keys[-1]
+
+
+def period_start(day, period):
+    """
+    Returns the first day of the ``period`` containing ``day``.
+    """
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def spending(by, period, start=None, end=None, keys=None, group=None):
+    """
+    Returns an ordered dict (period start -> {key id -> amount}) of the spending in ``group`` ``by`` user or
+    category between the days ``start`` and ``end``, optionally restricted to some ``keys`` ids.
+    """
+    model = ROLLUPS[by]
+    rows = model.objects.filter(group=group).exclude(amount=0)
+    if start is not None:
+        rows = rows.filter(day__gte=start)
+    if end is not None:
+        rows = rows.filter(day__lte=end)
+    if keys is not None:
+        rows = rows.filter(**{key_field(by) + '__in': keys})
+
+    report = OrderedDict()
+    for key_id, day, amount in rows.order_by('day').values_list(key_field(by), 'day', 'amount'):
+        totals = report.setdefault(period_start(day, period), defaultdict(Decimal))
+        totals[key_id] += amount
+    return report
+
+
+def raw_spending(by):
+    """
+    Returns the dict (day, group id, key id) -> amount computed from the atoms, as the rollups should be.
+    """
+    atoms = Atom.objects.filter(amount__lt=0, child_of_bill__refund=False)
+    key = 'user_id' if by == 'user' else 'child_of_bill__category'
+    if by == 'category':
+        atoms = atoms.filter(child_of_bill__category__isnull=False)
+    rows = (atoms.annotate(day=TruncDate('child_of_bill__date')).order_by()
+            .values_list('day', 'child_of_bill__group', key).annotate(Sum('amount')))
+    return {(day, group_id, key_id): -amount for day, group_id, key_id, amount in rows}
+
+
+def rollup_spending(by):
+    """
+    Returns the dict (day, group id, key id) -> amount stored in the rollups.
+    """
+    model = ROLLUPS[by]
+    return {(day, group_id, key_id): amount for day, group_id, key_id, amount in
+            model.objects.exclude(amount=0).values_list(*model.counter_keys + (model.counter_field, ))}
+
+
+def check(by):
+    """
+    Returns the list of (day, group id, key id, rollup amount, raw amount) which differ.
+    """
+    raw, rollup = raw_spending(by), rollup_spending(by)
+    return sorted((keys + (rollup.get(keys, 0), raw.get(keys, 0)) for keys in set(raw) | set(rollup)
+                   if rollup.get(keys, 0) != raw.get(keys, 0)), key=lambda row: (row[0], row[1] or 0, row[2]))
+
+
+def rebuild(by):
+    """
+    Replaces the rollups with the spending computed from the atoms.
+    """
+    model = ROLLUPS[by]
+    with transaction.atomic():
+        model.objects.all().delete()
+        model.objects.bulk_create([model(amount=amount, **dict(zip(model.counter_keys, keys)))
+                                   for keys, amount in raw_spending(by).items()], batch_size=1000)
+
+
+def refresh_day(day):
+    """
+    Replaces the rollups of ``day`` with the spending computed from its bills.
+    """
+    bills = Bill.objects.filter(date__gte=start_of_day(day), date__lt=start_of_day(day + datetime.timedelta(days=1)),
+                                refund=False)
+    atoms = Atom.objects.filter(child_of_bill__in=bills, amount__lt=0).order_by()
+    rows = {
+        'user': atoms.values_list('child_of_bill__group', 'user_id').annotate(Sum('amount')),
+        'category': atoms.filter(child_of_bill__category__isnull=False)
+                         .values_list('child_of_bill__group', 'child_of_bill__category').annotate(Sum('amount')),
+    }
+    with transaction.atomic():
+        for by, model in ROLLUPS.items():
+            model.objects.filter(day=day).delete()
+            model.objects.bulk_create([model(day=day, group_id=group_id, amount=(-Decimal(str(amount))).quantize(CENT),
+                                             **{key_field(by): key_id})
+                                       for group_id, key_id, amount in rows[by]])
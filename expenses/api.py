@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Version 1 of the JSON API, scoped to the current ```ExpenseGroup``` like the pages.
+
+The lists are paginated with the ``before``/``after`` cursors and ``size``, and ``fields`` selects the
+returned fields. The responses of GET requests carry an ETag derived from the versions of the current group
+and of the users, see ```expenses.caching```: a client sending it back in ``If-None-Match`` gets
+a ``304 Not Modified`` once its session and these versions are read.
+"""
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.db import transaction
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import condition, require_GET, require_http_methods
+
+from expenses import caching, groups, participants, ranking, tasks
+from expenses.forms import BillForm, RepaymentForm
+from expenses.groups import current_group
+from expenses.models import Atom, Bill
+from expenses.pagination import InvalidCursor, keyset_page
+
+
+BILL_FIELDS = {
+    'id': lambda bill: bill.pk,
+    'title': lambda bill: bill.title,
+    'description': lambda bill: bill.description,
+    'amount': lambda bill: str(bill.amount),
+    'date': lambda bill: bill.date.isoformat(),
+    'refund': lambda bill: bill.refund,
+    'creator': lambda bill: bill.creator_id,
+    'group': lambda bill: bill.group_id,
+    'atoms': lambda bill: [{'id': atom.pk, 'user': atom.user_id, 'amount': str(atom.amount)} for atom in bill.atoms.all()],
+}
+ATOM_FIELDS = {
+    'id': lambda atom: atom.pk,
+    'user': lambda atom: atom.user_id,
+    'bill': lambda atom: atom.child_of_bill_id,
+    'amount': lambda atom: str(atom.amount),
+    'date': lambda atom: atom.date.isoformat(),
+}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def api_view(view):
+    """
+    Answers 401 to anonymous users, 403 to the users outside of any group and 400 to a ```BadRequest```, in JSON.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return error("Authentication required", 401)
+        if current_group(request) is None:
+            return error("Membership of a group required", 403)
+        try:
+            return view(request, *args, **kwargs)
+        except BadRequest as exception:
+            return error(str(exception))
+    return wrapper
+
+
+def ledger_etag(request, *args, **kwargs):
+    """
+    Returns the ETag of a GET request: the same URL read by the same session gives the same answer
+    while the versions of the group and of the users don't change. Only the session and the versions
+    are read once a group is selected in the session.
+    """
+    user_id = request.session.get(SESSION_KEY)
+    if user_id is None:
+        return None
+    group_id = request.session.get(groups.SESSION_KEY)
+    if group_id is None:
+        group = current_group(request)
+        group_id = group and group.pk
+    scope = caching.LEDGER if group_id is None else caching.group_version_name(group_id)
+    group_version, users = caching.versions(scope, caching.USERS)
+    key = repr((request.get_full_path(), user_id, group_id, group_version, users))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def selected_fields(request, available):
+    """
+    Returns the ``fields`` asked for, all the ``available`` ones by default.
+    """
+    if not request.GET.get('fields'):
+        return list(available)
+    fields = request.GET['fields'].split(',')
+    unknown = set(fields) - set(available)
+    if unknown:
+        raise BadRequest("Unknown fields: %s" % ', '.join(sorted(unknown)))
+    return fields
+
+
+def serialize(item, fields, available):
+    return {field: available[field](item) for field in fields}
+
+
+def paginated(request, queryset, fields, available):
+    """
+    Returns the JSON response of a page of ``queryset``, see ```keyset_page```.
+    """
+    try:
+        size = int(request.GET.get('size', settings.EXPENSES_HISTORY_PAGE_SIZE))
+        size = min(max(size, 1), settings.EXPENSES_HISTORY_MAX_PAGE_SIZE)
+        page = keyset_page(queryset, size, before=request.GET.get('before'), after=request.GET.get('after'))
+    except (ValueError, InvalidCursor):
+        raise BadRequest("Invalid size or cursor")
+    return JsonResponse({
+        'results': [serialize(item, fields, available) for item in page.items],
+        'previous': page.previous_cursor,
+        'next': page.next_cursor,
+    })
+
+
+def bills_queryset(group, fields):
+    queryset = Bill.objects.filter(group=group)
+    if 'atoms' in fields:
+        queryset = queryset.prefetch_related('atoms')
+    return queryset
+
+
+def request_data(request):
+    """
+    Returns the submitted data, posted as a form or as a JSON object.
+    """
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body.decode())
+        except ValueError:
+            raise BadRequest("Invalid JSON")
+        if not isinstance(data, dict):
+            raise BadRequest("A JSON object is expected")
+        return data
+    return request.POST
+
+
+@condition(etag_func=ledger_etag)
+@require_http_methods(['GET', 'HEAD', 'POST'])
+@api_view
+def bills(request):
+    """
+    GET: the bills of the current group, newest first.
+    POST: creates a bill split equally, validated by ```BillForm```.
+    """
+    group = current_group(request)
+    if request.method == 'POST':
+        form = BillForm(request_data(request), group=group)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        with transaction.atomic(), form.save(commit=False) as bill:
+            bill.creator = request.user.extendeduser
+            bill.group = group
+            bill.save()
+            bill.create_atoms(form.cleaned_data['buyer'], form.cleaned_data['participants'])
+            tasks.notify_involved(bill)
+        bill = Bill.objects.prefetch_related('atoms').get(pk=bill.pk)
+        return JsonResponse(serialize(bill, list(BILL_FIELDS), BILL_FIELDS), status=201)
+    fields = selected_fields(request, BILL_FIELDS)
+    return paginated(request, bills_queryset(group, fields), fields, BILL_FIELDS)
+
+
+@condition(etag_func=ledger_etag)
+@require_GET
+@api_view
+def bill(request, bill_id):
+    """
+    The bill ``bill_id`` of the current group.
+    """
+    fields = selected_fields(request, BILL_FIELDS)
+    bill = get_object_or_404(bills_queryset(current_group(request), fields), pk=bill_id)
+    return JsonResponse(serialize(bill, fields, BILL_FIELDS))
+
+
+@require_http_methods(['POST'])
+@api_view
+def refunds(request):
+    """
+    Creates a refund, validated by ```RepaymentForm```.
+    """
+    group = current_group(request)
+    form = RepaymentForm(request_data(request), group=group)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    with transaction.atomic(), form.save(commit=False) as refund:
+        refund.refund = True
+        refund.creator = request.user.extendeduser
+        refund.group = group
+        refund.title = refund.refund_name()
+        refund.save()
+        refund.create_atoms(form.cleaned_data['buyer'], form.cleaned_data['participant'], True)
+        tasks.notify_involved(refund)
+    refund = Bill.objects.prefetch_related('atoms').get(pk=refund.pk)
+    return JsonResponse(serialize(refund, list(BILL_FIELDS), BILL_FIELDS), status=201)
+
+
+@condition(etag_func=ledger_etag)
+@require_GET
+@api_view
+def atoms(request):
+    """
+    The atoms of the current group, newest first: those of the current user, or of the ``user`` id.
+    """
+    fields = selected_fields(request, ATOM_FIELDS)
+    try:
+        user_id = int(request.GET.get('user', request.user.extendeduser.pk))
+    except ValueError:
+        raise BadRequest("Invalid user")
+    queryset = Atom.objects.filter(user_id=user_id, child_of_bill__group=current_group(request))
+    return paginated(request, queryset, fields, ATOM_FIELDS)
+
+
+@condition(etag_func=ledger_etag)
+@require_GET
+@api_view
+def balances(request):
+    """
+    The balances of the members of the current group, ordered by decreasing balance.
+    """
+    rows = ranking.leaderboard(current_group(request))
+    return JsonResponse({'results': [
+        {'id': row.pk, 'nickname': row.nickname, 'balance': str(row.balance)} for row in rows
+    ]})
+
+
+def user_rows(users):
+    return [{'id': pk, 'nickname': nickname} for pk, nickname in users]
+
+
+@condition(etag_func=ledger_etag)
+@require_GET
+@api_view
+def participants_search(request):
+    """
+    The members of the current group whose nickname or username starts with ``q``, at most ``size``.
+    """
+    try:
+        size = int(request.GET['size']) if 'size' in request.GET else None
+    except ValueError:
+        raise BadRequest("Invalid size")
+    users = participants.search(current_group(request), request.GET.get('q', ''), size)
+    return JsonResponse({'results': user_rows(users)})
+
+
+@condition(etag_func=ledger_etag)
+@require_GET
+@api_view
+def participant_suggestions(request):
+    """
+    The users who recently or frequently shared the bills of the current user, within the current group.
+    """
+    suggestions = participants.suggestions(request.user.extendeduser.pk, current_group(request))
+    return JsonResponse({name: user_rows(users) for name, users in suggestions.items()})
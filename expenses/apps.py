@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class ExpensesConfig(AppConfig):
+    name = 'expenses'
+
+    def ready(self):
+        from expenses.constraints import create_constraints
+        post_migrate.connect(create_constraints, sender=self)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Seeded generator of users, groups, bills and atoms for the benchmarks.
+"""
+import datetime
+import random
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+
+from expenses import splitting
+from expenses.models import Atom, Bill, ExpenseGroup, ExtendedUser, Membership
+
+
+CHUNK_SIZE = 1000
+
+
+def participant_count(rng, members):
+    """
+    Draws the number of participants of a bill: mostly a few people, sometimes the whole group.
+    """
+    if rng.random() < 0.1:
+        return len(members)
+    return min(len(members), 1 + int(rng.expovariate(1 / 2.5)))
+
+
+def generate(users, bills, groups=1, days=365, seed=0):
+    """
+    Creates ``users`` users, spread in ``groups`` groups (at least one), and ``bills`` bills
+    dated over the last ``days`` days, with a few participants each. Returns the created ```ExtendedUser```.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    with transaction.atomic():
+        User.objects.bulk_create([User(username='bench%d' % i) for i in range(users)], batch_size=CHUNK_SIZE)
+        accounts = [ExtendedUser(user_id=pk, nickname=username) for pk, username in
+                    User.objects.filter(username__startswith='bench').order_by('pk').values_list('pk', 'username')]
+        ExtendedUser.objects.bulk_create(accounts, batch_size=CHUNK_SIZE)
+        accounts = list(ExtendedUser.objects.filter(nickname__startswith='bench').order_by('pk'))
+
+        groups = max(groups, 1)
+        expense_groups = [ExpenseGroup.objects.create(name='Group %d' % i) for i in range(groups)]
+        Membership.objects.bulk_create([Membership(group=expense_groups[i % groups], user=account)
+                                        for i, account in enumerate(accounts)])
+        members = [accounts[i::groups] for i in range(groups)]
+
+        for start in range(0, bills, CHUNK_SIZE):
+            write_bills(rng, now, days, expense_groups, members, min(CHUNK_SIZE, bills - start))
+    return accounts
+
+
+def write_bills(rng, now, days, expense_groups, members, count):
+    """
+    Inserts ``count`` random bills and their atoms.
+    """
+    drafts = []
+    for _ in range(count):
+        index = rng.randrange(len(members))
+        people = members[index]
+        buyer = rng.choice(people)
+        participants = rng.sample(people, participant_count(rng, people))
+        cents = rng.randint(100, 20000)
+        bill = Bill(creator=buyer, amount=splitting.from_cents(cents), title='Bill %d' % rng.randrange(10 ** 6),
+                    date=now - datetime.timedelta(seconds=rng.randrange(days * 86400)),
+                    group=expense_groups[index])
+        drafts.append((bill, buyer, participants, cents))
+
+    bills = [bill for bill, buyer, participants, cents in drafts]
+    if connection.features.can_return_ids_from_bulk_insert:
+        bills = Bill.objects.bulk_create(bills)
+    else:
+        for bill in bills:
+            bill.save()
+
+    shares = splitting.batch_equal_split([(cents, len(participants)) for bill, buyer, participants, cents in drafts],
+                                         seed=rng.randrange(2 ** 32))
+    atoms = []
+    for (bill, buyer, participants, cents), parts in zip(drafts, shares):
+        atoms.append(Atom(user=buyer, amount=bill.amount, child_of_bill=bill, date=bill.date))
+        atoms.extend(Atom(user=participant, amount=-splitting.from_cents(part), child_of_bill=bill, date=bill.date)
+                     for participant, part in zip(participants, parts) if part)
+    Atom.objects.bulk_create(atoms)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measures how ```expenses.settlement.settle``` scales with the number of users.
+
+    $ python -m expenses.benchmarks.settlement [sizes...]
+"""
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+import django
+
+
+def random_balances(size, seed=0):
+    """
+    Returns ``size`` random balances summing to zero.
+    """
+    rng = random.Random(seed)
+    cents = [rng.randint(-100000, 100000) for _ in range(size - 1)]
+    cents.append(-sum(cents))
+    return {user: Decimal(amount) / 100 for user, amount in enumerate(cents)}
+
+
+def main(sizes):
+    from expenses.settlement import settle
+
+    print("%8s %10s %10s" % ("users", "transfers", "ms"))
+    for size in sizes:
+        balances = random_balances(size)
+        start = time.perf_counter()
+        transfers = settle(balances)
+        elapsed = time.perf_counter() - start
+        print("%8d %10d %10.1f" % (size, len(transfers), elapsed * 1000))
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Share.settings')
+    django.setup()
+    main([int(size) for size in sys.argv[1:]] or [10, 100, 1000, 10000, 100000])
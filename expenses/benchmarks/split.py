@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares ```expenses.splitting``` with the former ```Bill.equal_split``` implementation.
+
+    $ python -m expenses.benchmarks.split [number of bills]
+"""
+import decimal
+import sys
+import time
+from decimal import Decimal
+from random import Random, shuffle
+
+from expenses import splitting
+
+
+def legacy_equal_split(amount, participants):
+    """
+    The former ```Bill.equal_split```, which changed the global decimal context.
+    """
+    decimal.getcontext().rounding = decimal.ROUND_DOWN
+    nb_of_participants = len(participants)
+    missing_cents = int(amount*100 % nb_of_participants)
+    base_amount = (-amount/nb_of_participants).quantize(Decimal('.01'))
+    amount_list = [base_amount - Decimal('0.01')]*missing_cents
+    amount_list += [base_amount]*(nb_of_participants - missing_cents)
+    shuffle(amount_list)
+    return list(zip(participants, amount_list))
+
+
+def measure(function):
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+
+def main(size):
+    rng = Random(0)
+    bills = [(rng.randint(1, 100000), rng.randint(1, 40)) for _ in range(size)]
+    amounts = [(splitting.from_cents(total), list(range(count))) for total, count in bills]
+
+    context = decimal.getcontext().copy()
+    try:
+        legacy = measure(lambda: [legacy_equal_split(amount, participants) for amount, participants in amounts])
+    finally:
+        decimal.setcontext(context)
+    single = measure(lambda: [splitting.equal_split(total, count, seed=0) for total, count in bills])
+    batch = measure(lambda: list(splitting.batch_equal_split(bills, seed=0)))
+    weighted = measure(lambda: [splitting.weighted_split(total, list(range(1, count + 1)), seed=0)
+                                for total, count in bills])
+
+    print("%d bills" % size)
+    for name, elapsed in (("legacy Bill.equal_split", legacy), ("equal_split", single),
+                          ("batch_equal_split", batch), ("weighted_split", weighted)):
+        print("%-25s %10.1f ms" % (name, elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Repeatable benchmarks of the main pages and computations, compared against a stored baseline.
+
+Each benchmark reports its latency percentiles, its number of queries and its peak of allocated memory.
+Run them on a throwaway database with ``manage.py benchmark``.
+"""
+import json
+import os
+import random
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from django.core.urlresolvers import reverse
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from expenses import caching, splitting
+from expenses.groups import members
+from expenses.models import Bill
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+def percentile(values, rank):
+    """
+    Returns the ``rank`` percentile of the sorted list ``values``, by the nearest rank method.
+    """
+    index = max(0, min(len(values) - 1, int(round(rank / 100 * len(values))) - 1))
+    return values[index]
+
+
+def measure(function, repeat):
+    """
+    Calls ``function`` ``repeat`` times, and returns its statistics. Memory is traced on an extra call,
+    so that tracing doesn't slow down the timed ones. The page cache is emptied before each call:
+    the pages are measured as computed, not as read from ```expenses.caching```.
+    """
+    function()  # Warm up the connection and the imports
+    timings = []
+    for _ in range(repeat):
+        caching.get_cache().clear()
+        reset_queries()  # The query log is bounded
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            function()
+            timings.append((time.perf_counter() - start) * 1000)
+        query_count = len(queries)  # Before the next request resets the query log
+    timings.sort()
+
+    caching.get_cache().clear()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([
+        ('p50', round(percentile(timings, 50), 3)),
+        ('p90', round(percentile(timings, 90), 3)),
+        ('p99', round(percentile(timings, 99), 3)),
+        ('queries', query_count),
+        ('peak_kib', round(peak / 1024, 1)),
+    ])
+
+
+class Benchmarks:
+    """
+    The benchmarks, run as the first of ``users`` on the generated dataset.
+    """
+    def __init__(self, users, seed=0):
+        self.user = users[0]
+        self.users = users
+        self.rng = random.Random(seed)
+        self.client = Client()
+        self.client.force_login(self.user.user)
+
+    def get(self, url):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError("%s answered %d" % (url, response.status_code))
+
+    def bench_view_home(self):
+        self.get(reverse('home'))
+
+    def bench_view_balances(self):
+        self.get(reverse('balances'))
+
+    def bench_view_history(self):
+        self.get(reverse('history_page'))
+
+    def bench_display_bill(self):
+        self.get(reverse('display_bill', args=[self.bill.pk]))
+
+    def bench_wizard_bill(self):
+        prefix = 'wizard_bill_view'
+        url = reverse('wizard_bill_form')
+        participants = self.participants
+        shares = splitting.equal_split(1000, len(participants), seed=0)
+        self.client.post(url, {
+            prefix + '-current_step': '0', '0-title': 'Benchmark', '0-amount': '10.00',
+            '0-buyer': self.user.pk, '0-participants': [user.pk for user in participants],
+        })
+        data = {prefix + '-current_step': '1', 'form-TOTAL_FORMS': len(participants), 'form-INITIAL_FORMS': 0,
+                'form-MIN_NUM_FORMS': len(participants), 'form-MAX_NUM_FORMS': len(participants)}
+        data.update({'form-%d-amount' % i: splitting.from_cents(cents) for i, cents in enumerate(shares)})
+        self.client.post(url, data)
+        response = self.client.post(url, {prefix + '-current_step': '2'})
+        if response.status_code != 302:
+            raise RuntimeError("The wizard didn't save the bill")
+
+    def bench_check_global_integrity(self):
+        Bill.check_global_integrity()
+
+    def bench_equal_split(self):
+        for _ in range(1000):
+            splitting.equal_split(self.rng.randint(1, 100000), self.rng.randint(1, 40), seed=self.rng.random())
+
+    def prepare(self):
+        """
+        Picks the bill and the participants used by the benchmarks, among the ones visible to the user.
+        """
+        group = self.user.expense_groups.order_by('pk').first()
+        self.bill = Bill.objects.filter(group=group).order_by('-date', '-id').first()
+        self.participants = list(members(group).order_by('pk')[:4])
+        if self.bill is None:
+            raise RuntimeError("The dataset has no bill")
+
+    def names(self):
+        return sorted(name[len('bench_'):] for name in dir(self) if name.startswith('bench_'))
+
+    def run(self, repeat, only=None):
+        """
+        Returns the statistics of each benchmark (of the ``only`` list, all by default).
+        """
+        self.prepare()
+        return OrderedDict((name, measure(getattr(self, 'bench_' + name), repeat))
+                           for name in self.names() if only is None or name in only)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns the regressions of ``results`` against ``baseline``: (benchmark, metric, baseline, result) tuples.
+    Latencies and memory may grow by ``tolerance`` (a ratio), the number of queries must not grow at all.
+    """
+    regressions = []
+    for name, stats in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        for metric in ('p50', 'p90', 'peak_kib'):
+            if metric in reference and stats[metric] > reference[metric] * (1 + tolerance):
+                regressions.append((name, metric, reference[metric], stats[metric]))
+        if 'queries' in reference and stats['queries'] > reference['queries']:
+            regressions.append((name, 'queries', reference['queries'], stats['queries']))
+    return regressions
+
+
+def load_baseline(path):
+    """
+    Returns the parameters and the results stored in the baseline file ``path``.
+    """
+    with open(path) as baseline:
+        content = json.load(baseline)
+    return content['parameters'], content['benchmarks']
+
+
+def save_baseline(path, results, parameters):
+    with open(path, 'w') as baseline:
+        json.dump({'parameters': parameters, 'benchmarks': results}, baseline, indent=2)
+        baseline.write('\n')
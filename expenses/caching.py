@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Caches the computed contexts of the pages, under keys holding version numbers instead of being deleted.
+
+Every write of bills or atoms bumps the version of the ```ExpenseGroup``` of the bill (the ledger version for
+a bill outside of any group), every change of a user bumps the users version. A page of a group is cached
+under the version of the group and the users version, the pages outside of any group under the ledger version
+and the users version.
+
+The versions are ```CacheVersion``` rows rather than cache entries: the cache may be local to each process
+(the local-memory cache by default), while a bump made by a command, the ``run_tasks`` worker or another
+server process must reach them all. A version is bumped in the transaction of the write, so it changes
+for the other transactions with the data it covers. It is a random token rather than a counter, so that
+the cached pages never match the versions of a database rebuilt from scratch.
+
+The cache is ``EXPENSES_CACHE`` (an alias of ``CACHES``), entries expire after ``EXPENSES_CACHE_TIMEOUT`` seconds.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+PREFIX = 'expenses'
+LEDGER, USERS = 'ledger', 'users'
+
+
+def get_cache():
+    return caches[getattr(settings, 'EXPENSES_CACHE', 'default')]
+
+
+def group_version_name(group_id):
+    return 'group:%s' % group_id
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def _versions():
+    from expenses.models import CacheVersion  # The models bump the versions
+    return CacheVersion.objects
+
+
+def versions(*names):
+    """
+    Returns the current version of each of ``names``, in one query.
+    """
+    tokens = _versions().current(names)
+    return [tokens[name] for name in names]
+
+
+def ledger_version():
+    return versions(LEDGER)[0]
+
+
+def bump(names):
+    """
+    Makes the entries cached under the versions ``names`` obsolete, with the current transaction.
+    """
+    _versions().bump(list(names))
+
+
+def bump_ledger(group_ids=()):
+    """
+    Bumps the version of the groups ``group_ids``, and the ledger version if one of them is None (no group).
+    """
+    group_ids = set(group_ids)
+    names = [group_version_name(group_id) for group_id in group_ids if group_id is not None]
+    if None in group_ids:
+        names.append(LEDGER)
+    bump(names)
+
+
+def bump_users():
+    bump([USERS])
+
+
+def page_key(name, group, *parts):
+    """
+    Returns the cache key of the page ``name`` of ``group`` (possibly None), for the given key ``parts``.
+    """
+    scope = LEDGER if group is None else group_version_name(group.pk)
+    scope_version, users_version = versions(scope, USERS)
+    # Hashed, as the parts may come from the query string
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return ':'.join([PREFIX, 'page', name, scope, str(scope_version), str(users_version), digest])
+
+
+def cached(key, compute):
+    """
+    Returns the value cached under ``key``, calling ``compute()`` to set it when missing.
+    """
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, getattr(settings, 'EXPENSES_CACHE_TIMEOUT', 3600))
+    return value
+
+
+def cached_page(name, group, compute, *parts):
+    """
+    Returns the cached result of ``compute()`` for the page ``name`` of ``group``, see ```page_key```.
+    """
+    return cached(page_key(name, group, *parts), compute)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Indexes and checks which can't be declared in the ``Meta`` of the models: partial indexes and check constraints
+of the ```Atom``` and ```Bill``` tables, and expression indexes of the user tables. They are created, when missing,
+after each ``migrate``.
+
+The migrations of the app are generated on deployment, so these objects are installed by a ``post_migrate``
+receiver rather than by a migration. Once the expenses tables exist, it only installs what is missing and what
+the existing rows allow: a constraint broken by some rows is skipped with a warning, and left for the next
+``migrate``. On PostgreSQL, the checks are added ``NOT VALID`` (enforced for the new rows without scanning
+the table) and validated afterwards.
+
+The ``install_constraints`` command reports the offending rows and, with ``--fix``, cleans them up first:
+the null atoms are deleted, and the atoms of a user on the same side of a bill are merged into one, which leaves
+the balances and the bill amounts unchanged.
+"""
+import logging
+from decimal import Decimal
+
+from django.db import connections, transaction
+from django.db.models import Count, Min, Sum
+
+from django.contrib.auth.models import User
+
+from expenses.models import Atom, Bill, ExtendedUser
+
+
+logger = logging.getLogger(__name__)
+
+ATOM, BILL = Atom._meta.db_table, Bill._meta.db_table
+
+# (name, table, columns, condition, unique)
+PARTIAL_INDEXES = [
+    # One positive and one negative atom at most per user and bill
+    ('expenses_atom_credit_uniq', ATOM, ['user_id', 'child_of_bill_id'], 'amount > 0', True),
+    ('expenses_atom_debit_uniq', ATOM, ['user_id', 'child_of_bill_id'], 'amount < 0', True),
+    # Last operations of a user as a buyer or as a participant, see ```view_account_history```
+    ('expenses_atom_credit_user_id', ATOM, ['user_id', 'id'], 'amount > 0', False),
+    ('expenses_atom_debit_user_id', ATOM, ['user_id', 'id'], 'amount < 0', False),
+]
+PARTIAL_INDEX_VENDORS = ('postgresql', 'sqlite')
+# (name, table, expression)
+EXPRESSION_INDEXES = [
+    # Case insensitive prefix searches of the participant picker, see ```expenses.participants```
+    ('expenses_extendeduser_nickname_lower', ExtendedUser._meta.db_table, 'lower(nickname)'),
+    ('expenses_auth_user_username_lower', User._meta.db_table, 'lower(username)'),
+]
+# Lets PostgreSQL use the index for LIKE 'prefix%' whatever the collation
+EXPRESSION_INDEX_OPCLASSES = {'postgresql': ' text_pattern_ops'}
+
+INDEX_NAMES_SQL = {
+    'postgresql': 'SELECT indexname FROM pg_indexes WHERE indexname IN (%s)',
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND name IN (%s)",
+}
+
+# (name, table, condition)
+CHECKS = [
+    ('expenses_atom_amount_not_null', ATOM, 'amount <> 0'),
+    ('expenses_bill_amount_positive', BILL, 'amount >= 0'),
+]
+CHECK_VENDORS = ('postgresql', )
+
+
+def missing(connection):
+    """
+    Returns the lists of the ``PARTIAL_INDEXES``, ``EXPRESSION_INDEXES`` and ``CHECKS`` missing on ``connection``,
+    the checks added but not validated included.
+    """
+    indexes, expression_indexes, checks = [], [], []
+    with connection.cursor() as cursor:
+        if connection.vendor in PARTIAL_INDEX_VENDORS:
+            names = [index[0] for index in PARTIAL_INDEXES + EXPRESSION_INDEXES]
+            cursor.execute(INDEX_NAMES_SQL[connection.vendor] % ', '.join(['%s'] * len(names)), names)
+            existing = {row[0] for row in cursor.fetchall()}
+            indexes = [index for index in PARTIAL_INDEXES if index[0] not in existing]
+            expression_indexes = [index for index in EXPRESSION_INDEXES if index[0] not in existing]
+        if connection.vendor in CHECK_VENDORS:
+            cursor.execute('SELECT conname FROM pg_constraint WHERE conname IN %s AND convalidated',
+                           [tuple(check[0] for check in CHECKS)])
+            existing = {row[0] for row in cursor.fetchall()}
+            checks = [check for check in CHECKS if check[0] not in existing]
+    return indexes, expression_indexes, checks
+
+
+def cleanup(using):
+    """
+    Deletes the null atoms and merges the atoms of a user on the same side of a bill, through the ```Atom```
+    write paths so that the derived data stays consistent. Returns the numbers of deleted and merged atoms.
+    """
+    field = Atom._meta.get_field('amount')
+    limit = Decimal(10) ** (field.max_digits - field.decimal_places)
+    atoms = Atom.objects.using(using)
+    with transaction.atomic(using=using):
+        deleted = atoms.filter(amount=0).count()
+        if deleted:
+            atoms.filter(amount=0).delete()
+        merged = 0
+        for sign in ('gt', 'lt'):
+            duplicates = (atoms.filter(**{'amount__' + sign: 0}).order_by().values('user_id', 'child_of_bill_id')
+                          .annotate(count=Count('id'), first=Min('id'), total=Sum('amount')).filter(count__gt=1))
+            for duplicate in duplicates:
+                if abs(duplicate['total']) >= limit:
+                    continue  # Reported by ```offending_rows```
+                others = atoms.filter(user_id=duplicate['user_id'], child_of_bill_id=duplicate['child_of_bill_id'],
+                                      **{'amount__' + sign: 0}).exclude(pk=duplicate['first'])
+                others.delete()
+                atom = atoms.get(pk=duplicate['first'])
+                atom.amount = duplicate['total']
+                atom.save(using=using)
+                merged += duplicate['count'] - 1
+    return deleted, merged
+
+
+def offending_rows(connection, index_or_check):
+    """
+    Returns the number of rows (or groups of rows, for a unique index) which prevent the creation of
+    the partial index or check ``index_or_check``.
+    """
+    quote = connection.ops.quote_name
+    if len(index_or_check) == 3:
+        name, table, condition = index_or_check
+        sql = 'SELECT COUNT(*) FROM %s WHERE NOT (%s)' % (quote(table), condition)
+    else:
+        name, table, columns, condition, unique = index_or_check
+        if not unique:
+            return 0
+        columns = ', '.join(quote(column) for column in columns)
+        sql = 'SELECT COUNT(*) FROM (SELECT %s FROM %s WHERE %s GROUP BY %s HAVING COUNT(*) > 1) duplicates' % (
+            columns, quote(table), condition, columns)
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return cursor.fetchone()[0]
+
+
+def install(connection):
+    """
+    Creates the missing partial and expression indexes and checks on ``connection``, when its database supports them.
+    Returns the list of (name, number of offending rows) of those which couldn't be created.
+    """
+    quote = connection.ops.quote_name
+    indexes, expression_indexes, checks = missing(connection)
+    skipped = []
+    with connection.cursor() as cursor:
+        for name, table, expression in expression_indexes:
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s%s)' % (
+                quote(name), quote(table), expression, EXPRESSION_INDEX_OPCLASSES.get(connection.vendor, '')))
+        for index in indexes:
+            name, table, columns, condition, unique = index
+            count = offending_rows(connection, index)
+            if count:
+                skipped.append((name, count))
+                continue
+            cursor.execute('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s) WHERE %s' % (
+                'UNIQUE ' if unique else '', quote(name), quote(table),
+                ', '.join(quote(column) for column in columns), condition,
+            ))
+        if checks:
+            cursor.execute('SELECT conname FROM pg_constraint WHERE conname IN %s', [tuple(check[0] for check in checks)])
+            existing = {row[0] for row in cursor.fetchall()}
+        for check in checks:
+            name, table, condition = check
+            if name not in existing:
+                cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s) NOT VALID' % (quote(table), quote(name), condition))
+            count = offending_rows(connection, check)
+            if count:
+                skipped.append((name, count))
+                continue
+            cursor.execute('ALTER TABLE %s VALIDATE CONSTRAINT %s' % (quote(table), quote(name)))
+    return skipped
+
+
+def tables_exist(connection):
+    return {ATOM, BILL} <= set(connection.introspection.table_names())
+
+
+def create_constraints(sender, using, verbosity=1, **kwargs):
+    """
+    ``post_migrate`` receiver installing the constraints on the migrated database, once the expenses tables exist.
+    The rows are never changed: the constraints they break are skipped.
+    """
+    connection = connections[using]
+    if not tables_exist(connection) or not any(missing(connection)):
+        return
+    for name, count in install(connection):
+        if verbosity >= 1:
+            logger.warning("%s not installed: %d offending row(s), see the install_constraints command", name, count)
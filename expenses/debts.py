@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pairwise debts between users ("who owes whom"), derived from the atoms of each bill.
+
+In a bill, each participant owes each buyer his share weighted by the part of the bill this
+buyer paid. The debts of the bills of an ```ExpenseGroup``` are computed by one grouped query, netted
+between each pair of members and cached under the ledger version of the group, see ```expenses.caching```.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+
+from expenses import caching
+from expenses.models import Atom
+
+
+CENT = Decimal('0.01')
+
+
+def compute_debts(group):
+    """
+    Returns the netted debts within ``group`` as a dict (debtor id, creditor id) -> positive amount.
+    """
+    # Negative: the participant atom amount is negative
+    debt = ExpressionWrapper(F('amount') * F('child_of_bill__atoms__amount') / F('child_of_bill__amount'),
+                             output_field=DecimalField(max_digits=12, decimal_places=2))
+    rows = (Atom.objects
+            .filter(child_of_bill__group=group, amount__lt=0, child_of_bill__atoms__amount__gt=0,
+                    child_of_bill__amount__gt=0)
+            .order_by()
+            .values_list('user_id', 'child_of_bill__atoms__user_id')
+            .annotate(debt=Sum(debt)))
+
+    owed = defaultdict(Decimal)
+    for debtor, creditor, amount in rows:
+        if debtor != creditor:
+            owed[debtor, creditor] -= Decimal(str(amount))
+    debts = {}
+    for (debtor, creditor), amount in owed.items():
+        net = (amount - owed.get((creditor, debtor), 0)).quantize(CENT)
+        if net > 0:
+            debts[debtor, creditor] = net
+    return debts
+
+
+def pairwise_debts(group):
+    """
+    Returns the result of ```compute_debts```, cached until an atom of ``group`` is written.
+    """
+    return caching.cached_page('pairwise_debts', group, lambda: compute_debts(group))
+
+
+def debts_of(user_id, group):
+    """
+    Returns the row of ``user_id`` in the matrix of ``group``: the lists of (user id, amount) owed by and to the user.
+    """
+    owes, owed = [], []
+    for (debtor, creditor), amount in pairwise_debts(group).items():
+        if debtor == user_id:
+            owes.append((creditor, amount))
+        elif creditor == user_id:
+            owed.append((debtor, amount))
+    return sorted(owes, key=lambda row: -row[1]), sorted(owed, key=lambda row: -row[1])
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reads the query plans of the database, to find the queries which scan whole tables.
+"""
+import re
+
+from django.db import connection as default_connection
+
+
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?(.*)$')
+POSTGRESQL_SCAN = re.compile(r'Seq Scan on "?(\w+)"?')
+
+
+def query_plan(sql, connection=None):
+    """
+    Returns the lines of the plan of the (already interpolated) ``sql`` query.
+    """
+    connection = connection or default_connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+        elif connection.vendor == 'postgresql':
+            cursor.execute('EXPLAIN ' + sql)
+            return [row[0] for row in cursor.fetchall()]
+    raise NotImplementedError("No query plan reader for %s" % connection.vendor)
+
+
+def sequential_scans(sql, connection=None):
+    """
+    Returns the set of the tables read without index by the ``sql`` query.
+    """
+    connection = connection or default_connection
+    tables = set()
+    for line in query_plan(sql, connection):
+        if connection.vendor == 'sqlite':
+            match = SQLITE_SCAN.match(line.strip())
+            if match and 'USING' not in match.group(2):
+                tables.add(match.group(1))
+        else:
+            tables.update(POSTGRESQL_SCAN.findall(line))
+    return tables
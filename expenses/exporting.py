@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming export of the atoms, with the data of their bill, user and categories.
+
+The atoms are read by chunks of increasing ids and each chunk is written as soon as it
+is fetched, so the memory used doesn't depend on the size of the export.
+
+An incremental export (``since``) lists the atoms written since then, and the atoms of the bills and users
+modified since then (title, date, amount or categories, nickname or username), followed by a ``deleted`` row
+for each atom deleted since then (from the ```DeletedAtom``` tombstones, with only the atom and bill ids and
+dates): applying both to the previous exports gives the current atoms. An atom may be both written and deleted within
+the period, so a ``deleted`` row may name an atom never exported. A full export, without ``since``, has no
+``deleted`` rows and replaces the previous ones.
+"""
+import csv
+import io
+import json
+from collections import defaultdict
+
+from django.db.models import Q
+
+from expenses.models import Atom, Bill, DeletedAtom
+
+
+COLUMNS = (
+    'atom_id', 'bill_id', 'bill_title', 'bill_date', 'bill_amount', 'refund', 'categories',
+    'username', 'nickname', 'role', 'amount', 'atom_date',
+)
+
+FIELDS = (
+    'pk', 'child_of_bill_id', 'child_of_bill__title', 'child_of_bill__date', 'child_of_bill__amount',
+    'child_of_bill__refund', 'user__user__username', 'user__nickname', 'amount', 'date',
+)
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'columns': 'application/x-ndjson',
+}
+
+
+def atoms_to_export(start=None, end=None, since=None):
+    """
+    Returns the atoms of the bills dated between ``start`` and ``end``, written since ``since``
+    or whose bill or user was modified since ``since``.
+    """
+    queryset = Atom.objects.all()
+    if start is not None:
+        queryset = queryset.filter(child_of_bill__date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(child_of_bill__date__lt=end)
+    if since is not None:
+        queryset = queryset.filter(Q(date__gte=since) | Q(child_of_bill__modified__gte=since) | Q(user__modified__gte=since))
+    return queryset
+
+
+def deletions_to_export(start=None, end=None, since=None):
+    """
+    Returns the tombstones of the atoms of the bills dated between ``start`` and ``end``, deleted since ``since``.
+    None without ``since``: a full export has nothing to delete.
+    """
+    if since is None:
+        return DeletedAtom.objects.none()
+    queryset = DeletedAtom.objects.filter(date__gte=since)
+    if start is not None:
+        queryset = queryset.filter(bill_date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(bill_date__lt=end)
+    return queryset
+
+
+def export_chunks(start=None, end=None, since=None, chunk_size=2000):
+    """
+    Yields the chunks of the export described by ``start``, ``end`` and ``since``: the atoms, then the deletions.
+    """
+    yield from iter_chunks(atoms_to_export(start, end, since), chunk_size)
+    yield from iter_deletion_chunks(deletions_to_export(start, end, since), chunk_size)
+
+
+def iter_chunks(queryset, chunk_size=2000):
+    """
+    Yields lists of rows (tuples ordered as ``COLUMNS``), using two queries per chunk.
+    """
+    rows = queryset.order_by('pk').values_list(*FIELDS)
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        categories = defaultdict(list)
+        bill_ids = {row[1] for row in chunk}
+        for bill_id, name in (Bill.category.through.objects.filter(bill_id__in=bill_ids)
+                              .order_by('category__name').values_list('bill_id', 'category__name')):
+            categories[bill_id].append(name)
+        yield [
+            (pk, bill_id, title, bill_date.isoformat(), str(bill_amount), refund, ';'.join(categories[bill_id]),
+             username, nickname, 'buyer' if amount > 0 else 'participant', str(amount), date.isoformat())
+            for pk, bill_id, title, bill_date, bill_amount, refund, username, nickname, amount, date in chunk
+        ]
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1][0]
+
+
+def iter_deletion_chunks(queryset, chunk_size=2000):
+    """
+    Yields lists of ``deleted`` rows (tuples ordered as ``COLUMNS``), using one query per chunk.
+    """
+    rows = queryset.order_by('pk').values_list('pk', 'atom_id', 'bill_id', 'bill_date', 'date')
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        yield [(atom_id, bill_id, '', bill_date.isoformat(), '', '', '', '', '', 'deleted', '', date.isoformat())
+               for pk, atom_id, bill_id, bill_date, date in chunk]
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1][0]
+
+
+def write_chunks(chunks, format):
+    """
+    Yields the text of the export in the given format, one piece per chunk.
+    ``columns`` writes one JSON object per chunk, mapping each column to its list of values.
+    """
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    elif format == 'jsonl':
+        for chunk in chunks:
+            yield ''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in chunk)
+    elif format == 'columns':
+        yield json.dumps({'columns': COLUMNS}) + '\n'
+        for chunk in chunks:
+            yield json.dumps(dict(zip(COLUMNS, zip(*chunk)))) + '\n'
+    else:
+        raise ValueError("Unknown format: %s" % format)
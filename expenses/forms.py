@@ -2,21 +2,28 @@
 # -*- coding: utf-8 -*-
 
 from django import forms
+from expenses.groups import members
 from expenses.models import Atom, Bill, ExtendedUser
+from expenses.widgets import ParticipantWidget
 
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 
-from django.contrib.admin.widgets import FilteredSelectMultiple
+
+def clean_positive_amount(amount):
+    if amount is not None and amount <= 0:
+        raise forms.ValidationError(_("The amount must be positive."))
+    return amount
 
 
 class BillForm(forms.ModelForm):
     """
     Form for non-refund ```Bill```.
     """
-    buyer = forms.ModelChoiceField(label=_("Buyer"), queryset=ExtendedUser.objects.all(), empty_label=None)
-    participants = forms.ModelMultipleChoiceField(queryset=ExtendedUser.objects.all(), widget=FilteredSelectMultiple("users", False))
+    buyer = forms.ModelChoiceField(label=_("Buyer"), queryset=ExtendedUser.objects.all(), empty_label=None,
+                                   widget=ParticipantWidget(multiple=False))
+    participants = forms.ModelMultipleChoiceField(queryset=ExtendedUser.objects.all(), widget=ParticipantWidget())
 
     error_css_class = 'error'
     required_css_class = 'required'
@@ -25,15 +32,9 @@ class BillForm(forms.ModelForm):
         model = Bill
         exclude = ['creator', 'date', 'refund', 'category']
 
-    class Media:
-        css = {
-            'all':['admin/css/widgets.css',]
-        }
-        # Adding this javascript is crucial
-        js = ['/admin/jsi18n/']
-
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, group=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields['buyer'].queryset = self.fields['participants'].queryset = members(group)
 #       self.fields['category'].widget.attrs['class'] = 'u-full-width'
         self.fields['amount'].widget.attrs['class'] = 'u-full-width'
         self.fields['title'].widget.attrs['class'] = 'u-full-width'
@@ -41,6 +42,9 @@ class BillForm(forms.ModelForm):
         self.fields['buyer'].widget.attrs['class'] = 'u-full-width'
         self.fields['participants'].widget.attrs['class'] = 'u-full-width'
 
+    def clean_amount(self):
+        return clean_positive_amount(self.cleaned_data['amount'])
+
 
 class CustomSplitForm(forms.ModelForm):
     class Meta:
@@ -51,6 +55,13 @@ class CustomSplitForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.user = None
 
+    def clean_amount(self):
+        # A negative share would make a second positive atom for the buyer
+        amount = self.cleaned_data['amount']
+        if amount is not None and amount < 0:
+            raise forms.ValidationError(_("The share can't be negative."))
+        return amount
+
     def save(self, commit=True, *args, **kwargs):
         if commit == False:
             model = super().save(commit=False, *args, **kwargs)
@@ -63,6 +74,8 @@ class CustomSplitForm(forms.ModelForm):
 class CustomSplitFormSet(forms.formsets.BaseFormSet):
     def clean(self, *args, **kwargs):
         super().clean(*args, **kwargs)
+        if any(self.errors):
+            return
         total_amount = sum([form.cleaned_data['amount'] for form in self.forms])
         if self.total_amount != total_amount:
             validation_message = "Sum of user amounts (%(total_amount_user)s) doesn't match the bill amount (%(total_amount)s)" % {
@@ -84,8 +97,9 @@ class RepaymentForm(forms.ModelForm):
     """
     Form for refund ```Bill```.
     """
-    buyer = forms.ModelChoiceField(label='From', queryset=ExtendedUser.objects.all(), empty_label=None)
-    participant = forms.ModelChoiceField(label='To', queryset=ExtendedUser.objects.all())
+    buyer = forms.ModelChoiceField(label='From', queryset=ExtendedUser.objects.all(), empty_label=None,
+                                   widget=ParticipantWidget(multiple=False))
+    participant = forms.ModelChoiceField(label='To', queryset=ExtendedUser.objects.all(), widget=ParticipantWidget(multiple=False))
 
     error_css_class = 'error'
     required_css_class = 'required'
@@ -94,12 +108,16 @@ class RepaymentForm(forms.ModelForm):
         model = Bill
         fields = ['amount']
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, group=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields['buyer'].queryset = self.fields['participant'].queryset = members(group)
         self.fields['amount'].widget.attrs['class'] = 'u-full-width'
         self.fields['buyer'].widget.attrs['class'] = 'u-full-width'
         self.fields['participant'].widget.attrs['class'] = 'u-full-width'
 
+    def clean_amount(self):
+        return clean_positive_amount(self.cleaned_data['amount'])
+
 
 class ExtendedUserCreationForm(UserCreationForm):
     error_css_class = 'error'
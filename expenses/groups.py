@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scopes the pages to the ```ExpenseGroup``` selected by the user.
+
+A user outside of any group has no scope: the scoped pages redirect to the groups page, see ```group_required```,
+and no user can be picked or settled with. The bills of a former deployment without groups are moved into a group
+by the ``assign_group`` command.
+"""
+from functools import wraps
+
+from django.db import transaction
+from django.db.models import Sum
+from django.shortcuts import redirect
+from django.utils.functional import SimpleLazyObject
+
+from expenses import caching
+from expenses.models import Atom, Bill, ExpenseGroup, ExtendedUser, Membership, enqueue_spending
+
+
+SESSION_KEY = 'expenses_group'
+
+
+def current_group(request):
+    """
+    Returns the ```ExpenseGroup``` selected in the session of ``request``, by default the first group
+    of the user, None if he belongs to no group. Cached on the request.
+    """
+    if not hasattr(request, '_expenses_group'):
+        groups = ExpenseGroup.objects.filter(memberships__user__user_id=request.user.pk).order_by('pk')
+        group_id = request.session.get(SESSION_KEY)
+        group = groups.filter(pk=group_id).first() if group_id is not None else None
+        request._expenses_group = group or groups.first()
+    return request._expenses_group
+
+
+def select_group(request, group):
+    """
+    Makes ``group`` the current group of ``request``.
+    """
+    request.session[SESSION_KEY] = group.pk
+    request._expenses_group = group
+
+
+def group_required(view):
+    """
+    Redirects the users outside of any group to the groups page instead of calling ``view``.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if current_group(request) is None:
+            return redirect('groups')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def members(group):
+    """
+    Returns the ```ExtendedUser``` who can take part in the bills of ``group``, nobody without group.
+    """
+    if group is None:
+        return ExtendedUser.objects.none()
+    return group.members.all()
+
+
+def balance_rows(group):
+    """
+    Returns the ```BalanceRow``` of the members of ``group``, with their balance within the group.
+    """
+    if group is None:
+        return []
+    return group.memberships.balance_rows()
+
+
+def assign_orphans(group):
+    """
+    Moves the bills without group into ``group``, whose members become the users of these bills and the users
+    outside of any group. Returns the number of moved bills.
+    """
+    with transaction.atomic():
+        bills = Bill.objects.filter(group__isnull=True)
+        dates = list(bills.filter(refund=False).values_list('date', flat=True))
+        moved = dict(Atom.objects.filter(child_of_bill__in=bills).order_by().values_list('user_id').annotate(Sum('amount')))
+        users = set(moved) | set(ExtendedUser.objects.filter(memberships__isnull=True).values_list('pk', flat=True))
+        users -= set(group.memberships.values_list('user_id', flat=True))
+        Membership.objects.bulk_create([Membership(group=group, user_id=user_id) for user_id in users])
+        Membership.objects.shift({(group.pk, user_id): amount for user_id, amount in moved.items()}, create=False)
+        count = bills.update(group=group)
+        enqueue_spending(dates)
+        caching.bump_ledger([group.pk])
+    return count
+
+
+def context_processor(request):
+    """
+    Adds the lazily fetched ``current_group`` to the template context.
+    """
+    if not request.user.is_authenticated():
+        return {}
+    return {'current_group': SimpleLazyObject(lambda: current_group(request))}
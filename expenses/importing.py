@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk import of bills from CSV or JSONL records.
+
+A record has the keys ``title``, ``amount``, ``buyer``, ``participants`` and optionally
+``date`` (ISO 8601 date or datetime), ``creator`` (the buyer by default), ``description``, ``categories``
+and ``refund``. Users are designated by username or nickname. The bills go into the ```ExpenseGroup```
+given to the importer, whose members the users must be, or outside of any group (see ``assign_group``).
+
+In CSV, ``participants`` is either ``alice;bob`` (equal split) or ``alice:12.50;bob:7.50``,
+and ``categories`` is ``food;trip``. In JSONL, they can also be a list of names, or an
+object mapping names to amounts for ``participants``.
+"""
+import csv
+import json
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from expenses import splitting
+from expenses.management.commands._dates import parse_moment
+from expenses.models import Atom, Bill, Category, ExtendedUser
+
+
+ImportedBill = namedtuple('ImportedBill', ['bill', 'atoms', 'categories'])
+# The largest amount the ``max_digits`` of ``Bill.amount`` and ``Atom.amount`` can hold
+MAX_AMOUNT = min(Decimal(10) ** (field.max_digits - field.decimal_places) - splitting.CENT
+                 for field in (Bill._meta.get_field('amount'), Atom._meta.get_field('amount')))
+
+
+class InvalidRecord(ValueError):
+    def __init__(self, line, message):
+        super().__init__("Record %d: %s" % (line, message))
+        self.line = line
+
+
+def read_records(stream, format):
+    """
+    Yields the records of ``stream`` one at a time, as dicts.
+    """
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+    elif format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError("Unknown format: %s" % format)
+
+
+class BillImporter:
+    """
+    Converts records to bills and writes them by batches.
+    """
+    def __init__(self, seed=None, group=None):
+        rows = list(ExtendedUser.objects.values_list('pk', 'user__username', 'nickname'))
+        self.usernames = {pk: username for pk, username, nickname in rows}
+        nicknames = defaultdict(set)
+        for pk, username, nickname in rows:
+            nicknames[nickname].add(pk)
+        # Ambiguous nicknames are mapped to None, usernames take precedence over nicknames
+        self.users = {nickname: pks.pop() if len(pks) == 1 else None for nickname, pks in nicknames.items()}
+        self.users.update((username, pk) for pk, username, nickname in rows)
+        self.categories = dict(Category.objects.values_list('name', 'pk'))
+        self.seed = seed
+        self.group = group
+        self.members = set(group.memberships.values_list('user_id', flat=True)) if group is not None else None
+
+    def user(self, line, name):
+        name = name.strip()
+        if name not in self.users:
+            raise InvalidRecord(line, "unknown user %r" % name)
+        if self.users[name] is None:
+            raise InvalidRecord(line, "ambiguous nickname %r" % name)
+        return self.users[name]
+
+    def convert(self, line, record):
+        """
+        Returns the ```ImportedBill``` of ``record``, with unsaved models.
+        """
+        try:
+            amount = Decimal(str(record['amount']))
+            title = record['title']
+            buyer = self.user(line, record['buyer'])
+            participants = record['participants']
+        except KeyError as error:
+            raise InvalidRecord(line, "missing %s" % error)
+        except InvalidOperation:
+            raise InvalidRecord(line, "invalid amount %r" % record['amount'])
+        if amount <= 0 or amount != amount.quantize(splitting.CENT):
+            raise InvalidRecord(line, "invalid amount %r" % record['amount'])
+        if amount > MAX_AMOUNT:
+            raise InvalidRecord(line, "amount %s over %s" % (amount, MAX_AMOUNT))
+
+        date = timezone.now()
+        if record.get('date'):
+            try:
+                date = parse_moment(record['date'])
+            except CommandError as error:
+                raise InvalidRecord(line, str(error))
+
+        if isinstance(participants, str):
+            participants = [participant for participant in participants.split(';') if participant.strip()]
+            if any(':' in participant for participant in participants):
+                participants = dict(participant.rsplit(':', 1) for participant in participants)
+        if not participants:
+            raise InvalidRecord(line, "no participants")
+        try:
+            if isinstance(participants, dict):
+                shares = [(self.user(line, name), Decimal(str(share))) for name, share in participants.items()]
+            else:
+                cents = splitting.equal_split(splitting.to_cents(amount), len(participants), self.seed)
+                shares = [(self.user(line, name), splitting.from_cents(part)) for name, part in zip(participants, cents)]
+        except InvalidRecord:
+            raise
+        except (InvalidOperation, ValueError) as error:
+            raise InvalidRecord(line, "invalid participants (%s)" % error)
+
+        if len({user for user, share in shares}) != len(shares):
+            raise InvalidRecord(line, "duplicate participants")
+        if any(abs(share) > MAX_AMOUNT for user, share in shares):
+            raise InvalidRecord(line, "participant amount over %s" % MAX_AMOUNT)
+        # Only the bill is dated in the past: the date of the atoms is their write time
+        atoms = [Atom(user_id=user, amount=-share) for user, share in shares if share]
+        atoms.append(Atom(user_id=buyer, amount=amount))
+        if not Bill.atoms_match_amount(amount, [atom.amount for atom in atoms]):
+            raise InvalidRecord(line, "the participants amounts don't sum to %s" % amount)
+
+        creator = self.user(line, record['creator']) if record.get('creator') else buyer
+        if self.members is not None:
+            outsiders = ({creator} | {atom.user_id for atom in atoms}) - self.members
+            if outsiders:
+                raise InvalidRecord(line, "not members of %s: %s" % (
+                    self.group, ', '.join(sorted(self.usernames[pk] for pk in outsiders))))
+
+        refund = record.get('refund', False)
+        if isinstance(refund, str):
+            refund = refund.strip().lower() in ('1', 'true', 'yes')
+        bill = Bill(
+            title=title, amount=amount, date=date, refund=refund, description=record.get('description') or '',
+            creator_id=creator, group=self.group,
+        )
+        categories = record.get('categories') or []
+        if isinstance(categories, str):
+            categories = categories.split(';')
+        return ImportedBill(bill, atoms, [category.strip() for category in categories if category.strip()])
+
+    def write(self, imported_bills):
+        """
+        Writes a batch of ```ImportedBill``` with bulk inserts, in one transaction.
+        """
+        with transaction.atomic():
+            bills = [imported.bill for imported in imported_bills]
+            if connection.features.can_return_ids_from_bulk_insert:
+                Bill.objects.bulk_create(bills)
+            else:
+                for bill in bills:
+                    bill.save()
+
+            for name in {name for imported in imported_bills for name in imported.categories}:
+                if name not in self.categories:
+                    self.categories[name] = Category.objects.get_or_create(name=name)[0].pk
+
+            atoms, categories = [], []
+            Through = Bill.category.through
+            for imported in imported_bills:
+                for atom in imported.atoms:
+                    atom.child_of_bill = imported.bill
+                    atoms.append(atom)
+                for name in set(imported.categories):
+                    categories.append(Through(bill_id=imported.bill.pk, category_id=self.categories[name]))
+            # Categories first, so that the atoms are counted in the category spending
+            Through.objects.bulk_create(categories)
+            Atom.objects.bulk_create(atoms)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-request instrumentation: number and duration of the queries, template rendering time and the most
+repeated SQL statements. Cheap enough to stay enabled in production: the SQL is neither logged nor formatted,
+the statements are only counted by their text with placeholders.
+
+The totals are sent in a ``Server-Timing`` header, and the slowest requests are kept in the cache
+``EXPENSES_SLOW_REQUESTS_CACHE``, see ```view_slow_requests``` and the ``slow_requests`` command. This cache must be
+shared by the server processes and the command (a file, database or memcached cache, not a local memory one)
+and hold nothing else, so that the buffer is never culled to make room for other entries.
+"""
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.template.backends import django as django_backend
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+
+
+SLOW_REQUESTS_KEY = 'expenses:slow_requests'
+
+_local = threading.local()
+
+
+def fingerprint(sql):
+    """
+    Returns ``sql`` with its literals and lists of placeholders collapsed, to group the similar statements.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    return re.sub(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)', '(...)', sql)
+
+
+class Recorder:
+    """
+    Totals of one request.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.statements = defaultdict(lambda: [0, 0.0])
+
+    def add_query(self, sql, elapsed, count=1):
+        self.queries += count
+        self.db_time += elapsed
+        statement = self.statements[sql]
+        statement[0] += count
+        statement[1] += elapsed
+
+    def top_statements(self, number):
+        """
+        Returns the ``number`` most repeated (fingerprint, count, milliseconds) of the request.
+        """
+        grouped = defaultdict(lambda: [0, 0.0])
+        for sql, (count, elapsed) in self.statements.items():
+            statement = grouped[fingerprint(sql)]
+            statement[0] += count
+            statement[1] += elapsed
+        top = sorted(grouped.items(), key=lambda item: (-item[1][0], -item[1][1]))[:number]
+        return [(sql, count, round(elapsed * 1000, 3)) for sql, (count, elapsed) in top]
+
+
+class TimedCursorWrapper(CursorWrapper):
+    """
+    Wraps the cursor made by the connection to time its statements.
+    """
+    def __init__(self, cursor, db, recorder):
+        super().__init__(cursor, db)
+        self.recorder = recorder
+
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.recorder.add_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.recorder.add_query(sql, time.perf_counter() - start)
+
+
+def instrument_connection(connection, recorder):
+    """
+    Makes the cursors of ``connection`` record their statements in ``recorder``, until ```restore_connection```.
+    """
+    make_cursor, make_debug_cursor = type(connection).make_cursor, type(connection).make_debug_cursor
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(make_cursor(connection, cursor), connection, recorder)
+    connection.make_debug_cursor = lambda cursor: TimedCursorWrapper(make_debug_cursor(connection, cursor), connection, recorder)
+
+
+def restore_connection(connection):
+    for name in ('make_cursor', 'make_debug_cursor'):
+        connection.__dict__.pop(name, None)
+
+
+def patch_templates():
+    """
+    Times the rendering of the templates of the Django backend, included templates being counted once.
+    """
+    render = django_backend.Template.render
+    if getattr(render, 'instrumented', False):
+        return
+
+    def timed_render(self, context=None, request=None):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is None:
+            return render(self, context, request)
+        recorder.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            recorder.template_depth -= 1
+            if not recorder.template_depth:
+                recorder.template_time += time.perf_counter() - start
+    timed_render.instrumented = True
+    django_backend.Template.render = timed_render
+
+
+def get_cache():
+    return caches[getattr(settings, 'EXPENSES_SLOW_REQUESTS_CACHE', 'instrumentation')]
+
+
+class SlowRequests:
+    """
+    The ``size`` slowest requests, shared by the processes through the cache. Each process remembers
+    the fastest of the kept requests, so that faster requests don't even read the cache, for ``THRESHOLD_TTL``
+    seconds as another process may clear the buffer. The concurrent offers of two processes may lose one
+    of the entries: only the threads are serialized.
+    """
+    THRESHOLD_TTL = 60
+
+    def __init__(self, size):
+        self.size = size
+        self.threshold = 0.0
+        self.threshold_time = 0.0
+        self.lock = threading.Lock()
+
+    def wants(self, duration):
+        """
+        Returns whether a request of ``duration`` milliseconds may be kept.
+        """
+        return duration > self.threshold or time.monotonic() - self.threshold_time >= self.THRESHOLD_TTL
+
+    def offer(self, entry):
+        if not self.wants(entry['duration']):
+            return
+        with self.lock:
+            entries = self.entries()
+            entries.append(entry)
+            entries.sort(key=lambda entry: entry['duration'], reverse=True)
+            del entries[self.size:]
+            get_cache().set(SLOW_REQUESTS_KEY, entries, None)
+            self.threshold = entries[-1]['duration'] if len(entries) == self.size else 0.0
+            self.threshold_time = time.monotonic()
+
+    def entries(self):
+        return get_cache().get(SLOW_REQUESTS_KEY, [])
+
+    def clear(self):
+        with self.lock:
+            get_cache().delete(SLOW_REQUESTS_KEY)
+            self.threshold = 0.0
+
+
+slow_requests = SlowRequests(getattr(settings, 'EXPENSES_SLOW_REQUESTS_SIZE', 50))
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    """
+    Records the queries and rendering time of each request, see the module documentation.
+    """
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        patch_templates()
+
+    def process_request(self, request):
+        recorder = _local.recorder = Recorder()
+        for connection in connections.all():
+            instrument_connection(connection, recorder)
+
+    def stop(self):
+        recorder, _local.recorder = getattr(_local, 'recorder', None), None
+        for connection in connections.all():
+            restore_connection(connection)
+        return recorder
+
+    def process_exception(self, request, exception):
+        self.stop()  # The response middlewares won't run if the exception isn't handled
+
+    def process_response(self, request, response):
+        recorder = self.stop()
+        if recorder is None:
+            return response
+
+        duration = (time.perf_counter() - recorder.start) * 1000
+        response['Server-Timing'] = 'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f, total;dur=%.1f' % (
+            recorder.db_time * 1000, recorder.queries, recorder.template_time * 1000, duration)
+        if slow_requests.wants(duration):
+            slow_requests.offer({
+                'date': timezone.now().isoformat(),
+                'method': request.method,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'duration': round(duration, 3),
+                'queries': recorder.queries,
+                'db': round(recorder.db_time * 1000, 3),
+                'templates': round(recorder.template_time * 1000, 3),
+                'statements': recorder.top_statements(getattr(settings, 'EXPENSES_SLOW_REQUESTS_STATEMENTS', 5)),
+            })
+        return response
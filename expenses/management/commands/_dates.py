@@ -0,0 +1,27 @@
+import datetime
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from pytz.exceptions import InvalidTimeError
+
+
+def parse_moment(value):
+    """
+    Parses a date or a datetime option as an aware datetime, a date meaning its midnight.
+    """
+    if not value:
+        return None
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError("Invalid date: %s" % value)
+            moment = datetime.datetime.combine(day, datetime.time())
+    except ValueError:  # Well formatted, but out of range
+        raise CommandError("Invalid date: %s" % value)
+    try:
+        return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+    except InvalidTimeError:
+        raise CommandError("Ambiguous or non-existent time in %s: %s" % (timezone.get_current_timezone_name(), value))
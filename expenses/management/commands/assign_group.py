@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from expenses import groups
+from expenses.models import ExpenseGroup
+
+
+class Command(BaseCommand):
+    help = "Moves the bills without group and the users outside of any group into a group, created if needed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help="Name of the group.")
+
+    def handle(self, *args, **options):
+        group, created = ExpenseGroup.objects.get_or_create(name=options['name'])
+        count = groups.assign_orphans(group)
+        self.stdout.write(self.style.SUCCESS("%d bill(s) moved into %s" % (count, group)))
@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from expenses.benchmarks import data, suite
+
+
+class Command(BaseCommand):
+    help = "Runs the benchmarks on a generated dataset, in a throwaway test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--bills', type=int, default=20000)
+        parser.add_argument('--groups', type=int, default=1, help="Spread the users in this number of groups.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs of each benchmark.")
+        parser.add_argument('--only', nargs='+', help="Benchmarks to run, all by default.")
+        parser.add_argument('--baseline', default=suite.BASELINE,
+                            help="JSON file of a previous run to compare with (default: the committed baseline).")
+        parser.add_argument('--no-baseline', dest='baseline', action='store_const', const=None,
+                            help="Don't compare with a baseline.")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Accepted growth ratio of the latencies and memory (default 0.2).")
+        parser.add_argument('--save', help="Writes the results to this JSON file, to be used as a baseline.")
+
+    def handle(self, *args, **options):
+        parameters = {name: options[name] for name in ('users', 'bills', 'groups', 'seed', 'repeat')}
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            users = data.generate(options['users'], options['bills'], options['groups'], seed=options['seed'])
+            results = suite.Benchmarks(users, options['seed']).run(options['repeat'], options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write("%-25s %10s %10s %10s %8s %10s" % ("benchmark", "p50 ms", "p90 ms", "p99 ms", "queries", "peak KiB"))
+        for name, stats in results.items():
+            self.stdout.write("%-25s %10.2f %10.2f %10.2f %8d %10.1f" % (
+                name, stats['p50'], stats['p90'], stats['p99'], stats['queries'], stats['peak_kib']))
+        if options['save']:
+            suite.save_baseline(options['save'], results, parameters)
+
+        if options['baseline']:
+            reference_parameters, reference = suite.load_baseline(options['baseline'])
+            if reference_parameters != parameters:
+                self.stdout.write(self.style.WARNING("The baseline was run with %s" % json.dumps(reference_parameters, sort_keys=True)))
+            regressions = suite.compare(results, reference, options['tolerance'])
+            for name, metric, reference, value in regressions:
+                self.stdout.write(self.style.WARNING("%s: %s went from %s to %s" % (name, metric, reference, value)))
+            if regressions:
+                raise CommandError("%d regression(s) against %s" % (len(regressions), options['baseline']))
+            self.stdout.write(self.style.SUCCESS("No regression against %s" % options['baseline']))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from expenses.models import BalanceSnapshot, ExtendedUser
+
+
+class Command(BaseCommand):
+    help = ("Creates the missing daily balance snapshots, by chunks of users. "
+            "Each chunk is committed on its own, so an interrupted run can simply be started again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200, help="Number of users processed per transaction.")
+        parser.add_argument('--until', help="Last day to snapshot (YYYY-MM-DD), before today. Yesterday by default.")
+
+    def handle(self, *args, **options):
+        until = None
+        if options['until']:
+            until = parse_date(options['until'])
+            if until is None:
+                raise CommandError("Invalid --until value: %s" % options['until'])
+            if until >= timezone.localdate():
+                raise CommandError("--until must be before today: the snapshots of today would never be invalidated")
+
+        users = list(ExtendedUser.objects.order_by('pk').values_list('pk', flat=True))
+        chunk_size = options['chunk_size']
+        created = 0
+        for index in range(0, len(users), chunk_size):
+            chunk = users[index:index + chunk_size]
+            with transaction.atomic():
+                created += BalanceSnapshot.objects.build(users=chunk, until=until)
+            self.stdout.write("%d/%d users, %d snapshots created" % (index + len(chunk), len(users), created))
+        self.stdout.write(self.style.SUCCESS("%d snapshots created" % created))
@@ -0,0 +1,36 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from expenses.management.commands._dates import parse_moment
+from expenses.models import Bill
+
+
+class Command(BaseCommand):
+    help = "Reports the bills whose atoms don't match their amount, one JSON object per line."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only check the bills created or modified since this date or datetime.")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of bills fetched per query.")
+
+    def handle(self, *args, **options):
+        queryset = Bill.objects.all()
+        if options['since']:
+            queryset = queryset.touched_since(parse_moment(options['since']))
+
+        start = time.monotonic()
+        failures = 0
+        for failure in queryset.iter_inconsistent(options['chunk_size']):
+            failures += 1
+            self.stdout.write(json.dumps({
+                'bill': failure['pk'],
+                'title': failure['title'],
+                'date': failure['date'].isoformat(),
+                'amount': str(failure['amount']),
+                'positive_sum': str(failure['positive_sum']),
+                'net_sum': str(failure['net_sum']),
+            }))
+        self.stdout.write(json.dumps({
+            'summary': {'failures': failures, 'since': options['since'], 'seconds': round(time.monotonic() - start, 3)},
+        }))
@@ -0,0 +1,45 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from expenses import exporting
+from expenses.management.commands._dates import parse_moment
+
+
+class Command(BaseCommand):
+    help = "Exports the atoms with their bill, user and categories, streaming them by chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(exporting.FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help="Output file, - for the standard output.")
+        parser.add_argument('--start', help="Only export the bills dated from this datetime.")
+        parser.add_argument('--end', help="Only export the bills dated before this datetime.")
+        parser.add_argument('--since-last', metavar='STATE_FILE',
+                            help="Only export the atoms written or deleted since the run which recorded this file.")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        run_start = timezone.now()
+        since = None
+        state = options['since_last']
+        if state and os.path.exists(state):
+            with open(state) as state_file:
+                since = parse_moment(state_file.read().strip())
+
+        chunks = exporting.export_chunks(parse_moment(options['start']), parse_moment(options['end']), since,
+                                         options['chunk_size'])
+        output = self.stdout if options['output'] == '-' else open(options['output'], 'w', newline='', encoding='utf-8')
+        try:
+            for text in exporting.write_chunks(chunks, options['format']):
+                if output is self.stdout:
+                    output.write(text, ending='')
+                else:
+                    output.write(text)
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+        if state:
+            with open(state, 'w') as state_file:
+                state_file.write(run_start.isoformat())
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import importing
+from expenses.models import ExpenseGroup
+
+
+class Command(BaseCommand):
+    help = ("Imports bills from a CSV or JSONL file (see expenses.importing for the format). "
+            "Each batch is committed on its own; with --checkpoint, a failed import resumes after the last batch.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, - for the standard input.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Guessed from the extension by default.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Number of bills per transaction.")
+        parser.add_argument('--checkpoint', help="File storing the number of records already imported.")
+        parser.add_argument('--seed', type=int, help="Seed of the equal splits remainders.")
+        parser.add_argument('--group', help="Name of the group of the bills, whose members the users must be. "
+                                            "Without it, the bills stay outside of any group until assign_group.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if format not in ('csv', 'jsonl'):
+            raise CommandError("Unknown format, use --format")
+        checkpoint = options['checkpoint']
+        done = 0
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as checkpoint_file:
+                done = int(checkpoint_file.read().strip() or 0)
+            self.stdout.write("Resuming after %d records" % done)
+
+        group = None
+        if options['group']:
+            try:
+                group = ExpenseGroup.objects.get(name=options['group'])
+            except ExpenseGroup.DoesNotExist:
+                raise CommandError("Unknown group: %s" % options['group'])
+            except ExpenseGroup.MultipleObjectsReturned:
+                raise CommandError("Several groups are named %s" % options['group'])
+
+        importer = importing.BillImporter(seed=options['seed'], group=group)
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        start = time.monotonic()
+        imported = 0
+        try:
+            records = enumerate(importing.read_records(stream, format), start=1)
+            records = islice(records, done, None)
+            while True:
+                batch = list(islice(records, options['batch_size']))
+                if not batch:
+                    break
+                try:
+                    importer.write([importer.convert(line, record) for line, record in batch])
+                except importing.InvalidRecord as error:
+                    raise CommandError("%s (%d records imported before)" % (error, done))
+                done = batch[-1][0]
+                imported += len(batch)
+                if checkpoint:
+                    with open(checkpoint, 'w') as checkpoint_file:
+                        checkpoint_file.write(str(done))
+                elapsed = time.monotonic() - start
+                self.stdout.write("%d records imported (%.0f bills/s)" % (done, imported / max(elapsed, 1e-6)))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(self.style.SUCCESS("%d bills imported in %.1fs" % (imported, time.monotonic() - start)))
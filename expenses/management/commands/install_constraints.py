@@ -0,0 +1,33 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from expenses import constraints
+
+
+class Command(BaseCommand):
+    help = ("Reports the rows preventing the creation of the constraints of expenses.constraints, "
+            "and installs the other ones. With --fix, cleans these rows up first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help="Delete the null atoms and merge the atoms of a user on the same side of a bill.")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help="Database to install the constraints on.")
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if not constraints.tables_exist(connection):
+            raise CommandError("The expenses tables don't exist, run migrate first")
+        if options['fix']:
+            try:
+                deleted, merged = constraints.cleanup(options['database'])
+            except ValidationError as exception:
+                raise CommandError("Cleanup aborted, nothing was changed: %s" % '; '.join(exception.messages))
+            self.stdout.write("Deleted %d null atom(s) and merged %d duplicate atom(s)" % (deleted, merged))
+        skipped = constraints.install(connection)
+        for name, count in skipped:
+            self.stdout.write("%s: %d offending row(s)" % (name, count))
+        if skipped:
+            self.stdout.write(self.style.WARNING("%d constraint(s) not installed" % len(skipped)))
+        else:
+            self.stdout.write(self.style.SUCCESS("All constraints are installed"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from expenses.models import ExtendedUser
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the stored balance of each user from his atoms and reports the drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report the drift.")
+
+    def handle(self, *args, **options):
+        drifts = ExtendedUser.rebuild_balances(dry_run=options['dry_run'])
+        for user, stored, computed in drifts:
+            self.stdout.write("%s: stored %s, computed %s (drift %s)" % (user, stored, computed, stored - computed))
+        if drifts:
+            self.stdout.write(self.style.WARNING("%d balance(s) drifting" % len(drifts)))
+        else:
+            self.stdout.write(self.style.SUCCESS("All balances are consistent"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from expenses.models import Bill
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the summary columns (buyers, participants, totals) of each bill from its atoms."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of bills refreshed per transaction.")
+
+    def handle(self, *args, **options):
+        count = Bill.objects.rebuild_summaries(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS("%d bill summaries rebuilt" % count))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from expenses import analytics
+
+
+class Command(BaseCommand):
+    help = "Checks the spending rollups against the bills and atoms, and rebuilds them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Only report the differences.")
+
+    def handle(self, *args, **options):
+        for by in sorted(analytics.ROLLUPS):
+            differences = analytics.check(by)
+            for day, group_id, key_id, rollup, raw in differences:
+                self.stdout.write("%s %s of group %s on %s: rollup %s, computed %s" % (by, key_id, group_id, day, rollup, raw))
+            if not options['check']:
+                analytics.rebuild(by)
+            style = self.style.WARNING if differences else self.style.SUCCESS
+            self.stdout.write(style("%s spending: %d difference(s)" % (by, len(differences))))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from expenses import tasks
+
+
+class Command(BaseCommand):
+    help = "Runs the queued tasks (spending rollups, balance snapshots, notifications) until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drain', action='store_true', help="Stop once no task is due.")
+        parser.add_argument('--batch-size', type=int, default=100, help="Number of tasks taken at once.")
+        parser.add_argument('--sleep', type=float, default=2, help="Seconds to wait when no task is due.")
+
+    def handle(self, *args, **options):
+        if options['drain']:
+            count = tasks.drain(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS("%d task(s) run" % count))
+            return
+        while True:
+            if not tasks.work(options['batch_size']):
+                time.sleep(options['sleep'])
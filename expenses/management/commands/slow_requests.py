@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from expenses.instrumentation import slow_requests
+
+
+class Command(BaseCommand):
+    help = "Dumps the slowest requests recorded by the instrumentation middleware."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help="Dump the entries as JSON.")
+        parser.add_argument('--statements', action='store_true', help="Show the most repeated statements.")
+        parser.add_argument('--clear', action='store_true', help="Forget the recorded requests afterwards.")
+
+    def handle(self, *args, **options):
+        entries = slow_requests.entries()
+        if options['json']:
+            self.stdout.write(json.dumps(entries, indent=2))
+        else:
+            for entry in entries:
+                self.stdout.write("%9.1f ms %4d queries %9.1f ms db %9.1f ms tpl  %s %s (%s)" % (
+                    entry['duration'], entry['queries'], entry['db'], entry['templates'],
+                    entry['method'], entry['path'], entry['status']))
+                if options['statements']:
+                    for sql, count, elapsed in entry['statements']:
+                        self.stdout.write("    %4d× %9.1f ms  %s" % (count, elapsed, sql))
+        if options['clear']:
+            slow_requests.clear()
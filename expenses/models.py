@@ -1,11 +1,166 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, DecimalField, Exists, F, Func, OuterRef, ProtectedError, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-import decimal
+import datetime
+import json
+import operator
+from collections import OrderedDict, defaultdict, namedtuple
 from decimal import Decimal
-from random import shuffle
+from functools import reduce
+
+from expenses import caching, splitting
+
+
+BalanceRow = namedtuple('BalanceRow', ['pk', 'user_id', 'nickname', 'balance'])
+BalanceRow.__doc__ = """
+Lightweight presentation of the balance of an ```ExtendedUser```.
+"""
+
+
+class SummaryEntry(namedtuple('SummaryEntry', ['user_id', 'nickname', 'amount'])):
+    """
+    A buyer or a participant of a ```Bill```, as stored in its summary columns.
+    """
+    def localised_amount(self):
+        return "%s €" % (abs(self.amount),)
+
+
+AtomChange = namedtuple('AtomChange', ['user_id', 'bill_id', 'amount', 'date', 'factor'])
+AtomChange.__doc__ = """
+Describes an ```Atom``` being written (``factor`` = 1) or removed (``factor`` = -1).
+"""
+
+
+def start_of_day(day):
+    """
+    Returns the aware datetime at which ``day`` starts in the current time zone.
+    """
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time()))
+
+
+def record_atom_changes(changes):
+    """
+    Propagates a list of ```AtomChange``` to the data derived from atoms.
+    Must be called inside the transaction that writes the atoms.
+    """
+    if not changes:
+        return
+    bills = {pk: (date, refund, group_id) for pk, date, refund, group_id in
+             Bill.objects.filter(pk__in={change.bill_id for change in changes})
+             .values_list('pk', 'date', 'refund', 'group_id')}
+
+    deltas, group_deltas = defaultdict(Decimal), defaultdict(Decimal)
+    for change in changes:
+        deltas[change.user_id] += change.factor * change.amount
+        group_id = bills.get(change.bill_id, (None, None, None))[2]
+        if group_id is not None:
+            group_deltas[group_id, change.user_id] += change.factor * change.amount
+    ExtendedUser.shift_balances(deltas)
+    # The forms only offer the members of the group: an atom of a non-member is refused
+    Membership.objects.shift(group_deltas, create=False)
+    Bill.objects.refresh_summaries(bills)
+    users = BalanceSnapshot.objects.invalidate(changes)
+    Task.objects.enqueue('build_snapshots', {user_id: {'user': user_id} for user_id in users})
+    spending_bills = {change.bill_id for change in changes if change.amount < 0}
+    enqueue_spending(date for pk, (date, refund, group_id) in bills.items() if pk in spending_bills and not refund)
+    caching.bump_ledger(group_id for date, refund, group_id in bills.values())
+
+
+def enqueue_spending(dates):
+    """
+    Queues the refresh of the spending rollups of the days of ``dates``, see ```expenses.tasks```.
+    """
+    days = {timezone.localdate(date).isoformat() for date in dates}
+    Task.objects.enqueue('refresh_spending', {day: {'day': day} for day in days})
+
+
+def add_deltas(queryset, field, deltas):
+    """
+    Adds to ``field`` the amounts of the ``deltas`` list of (```Q``` selecting a row, amount),
+    in one ``UPDATE ... SET field = field + CASE ... END`` query. Returns the number of updated rows.
+    """
+    deltas = [(lookup, delta) for lookup, delta in deltas if delta]
+    if not deltas:
+        return 0
+    output_field = DecimalField(max_digits=12, decimal_places=2)
+    shift = Case(*[When(lookup, then=Value(delta)) for lookup, delta in deltas], default=Value(0), output_field=output_field)
+    return queryset.filter(reduce(operator.or_, [lookup for lookup, delta in deltas])).update(**{field: F(field) + shift})
+
+
+class CounterQuerySet(models.QuerySet):
+    """
+    Rows holding a sum (the ``counter_field`` of the model) for each value of the ``counter_keys`` fields.
+    """
+    def shift(self, deltas, create=True):
+        """
+        Adds the amounts of the ``deltas`` dict (keys values -> amount) to the rows, creating the missing ones,
+        or raising a ```ValidationError``` without writing anything if ``create`` is False.
+        The existing rows are updated by one query, the missing ones inserted by another one.
+        """
+        keys, field = self.model.counter_keys, self.model.counter_field
+        deltas = {values: delta for values, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        lookups = {values: Q(**dict(zip(keys, values))) for values in deltas}
+        existing = set(self.filter(reduce(operator.or_, lookups.values())).values_list(*keys))
+        missing = {values: delta for values, delta in deltas.items() if values not in existing}
+        if missing and not create:
+            raise ValidationError("No %s for %s" % (self.model._meta.verbose_name, ', '.join(
+                '(%s)' % ', '.join('%s=%s' % pair for pair in zip(keys, values)) for values in sorted(missing))))
+        add_deltas(self, field, [(lookups[values], delta) for values, delta in deltas.items() if values in existing])
+        if not missing:
+            return
+        try:
+            with transaction.atomic():
+                self.bulk_create([self.model(**dict(zip(keys, values), **{field: delta}))
+                                  for values, delta in missing.items()])
+        except IntegrityError:
+            # Some rows were created concurrently
+            for values, delta in missing.items():
+                lookup = dict(zip(keys, values))
+                self.get_or_create(**lookup)
+                self.filter(**lookup).update(**{field: F(field) + delta})
+
+
+class AtomQuerySet(models.QuerySet):
+    """
+    Keeps the derived data up to date on bulk writes of ```Atom```.
+    """
+    def changes(self, factor):
+        """
+        Returns the ```AtomChange``` list matching the atoms of the queryset.
+        """
+        return [AtomChange(*values, factor=factor) for values in
+                self.order_by().values_list('user_id', 'child_of_bill_id', 'amount', 'date')]
+
+    def removals(self):
+        """
+        Returns the ```AtomChange``` list (``factor`` = -1) and the ```DeletedAtom``` tombstones of the atoms
+        of the queryset, read by one query.
+        """
+        rows = list(self.order_by().values_list('pk', 'user_id', 'child_of_bill_id', 'amount', 'date', 'child_of_bill__date'))
+        return ([AtomChange(user_id, bill_id, amount, date, factor=-1) for pk, user_id, bill_id, amount, date, bill_date in rows],
+                [DeletedAtom(atom_id=pk, bill_id=bill_id, bill_date=bill_date) for pk, user_id, bill_id, amount, date, bill_date in rows])
+
+    def delete(self):
+        with transaction.atomic():
+            changes, tombstones = self.removals()
+            result = super().delete()
+            DeletedAtom.objects.bulk_create(tombstones)
+            record_atom_changes(changes)
+        return result
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic():
+            objs = super().bulk_create(objs, *args, **kwargs)
+            record_atom_changes([atom.change(1) for atom in objs])
+        return objs
 
 
 class Atom(models.Model):
@@ -14,9 +169,11 @@ class Atom(models.Model):
     """
     user = models.ForeignKey('ExtendedUser', related_name='atoms')
     amount = models.DecimalField(verbose_name=_("Amount"), max_digits=6, decimal_places=2)
-    date = models.DateTimeField(auto_now=True)
+    date = models.DateTimeField(default=timezone.now, editable=False)  # Stamped on each save, see ```save```
     child_of_bill = models.ForeignKey('Bill', related_name='atoms')
 
+    objects = AtomQuerySet.as_manager()
+
     def __str__(self):  # TODO: code actual localisation
         return _("%(user)s: %(amount)s for %(bill)s") % {
             'user': self.user,
@@ -28,10 +185,137 @@ class Atom(models.Model):
         # TODO
         return "%s €" % (abs(self.amount),)
 
+    def change(self, factor):
+        """
+        Returns the ```AtomChange``` describing the current ```Atom``` instance.
+        """
+        return AtomChange(self.user_id, self.child_of_bill_id, self.amount, self.date, factor)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            changes = []
+            if self.pk is not None:
+                changes = Atom.objects.filter(pk=self.pk).changes(-1)
+            self.date = timezone.now()
+            super().save(*args, **kwargs)
+            record_atom_changes(changes + [self.change(1)])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            changes, tombstones = Atom.objects.filter(pk=self.pk).removals()
+            result = super().delete(*args, **kwargs)
+            DeletedAtom.objects.bulk_create(tombstones)
+            record_atom_changes(changes)
+        return result
+
     class Meta:
-        # TODO unique_together ('user', 'child_of_bill', 'amount>0')
-        #unique_together = ('user', 'child_of_bill', )
-        pass
+        # One positive and one negative atom at most per user and bill, and no null atom:
+        # partial indexes and checks, see ```expenses.constraints```
+        indexes = [
+            models.Index(fields=['user', 'date'], name='expenses_atom_user_date'),
+        ]
+
+
+class DeletedAtom(models.Model):
+    """
+    Tombstone of a deleted ```Atom```, so that the incremental exports report the deletion,
+    see ```expenses.exporting```.
+    """
+    atom_id = models.IntegerField()
+    bill_id = models.IntegerField()
+    bill_date = models.DateTimeField()
+    date = models.DateTimeField(default=timezone.now, db_index=True)  # Deletion time
+
+    def __str__(self):
+        return "Atom %s of bill %s, deleted on %s" % (self.atom_id, self.bill_id, self.date)
+
+
+class BillQuerySet(models.QuerySet):
+    def with_atoms(self):
+        """
+        Fetches the creator, the atoms and their users along with the bills, in a fixed number of queries.
+        """
+        atoms = Atom.objects.select_related('user__user')
+        return self.select_related('creator').prefetch_related(models.Prefetch('atoms', queryset=atoms))
+
+    def with_atom_sums(self):
+        """
+        Annotates each ```Bill``` with the sum of its positive atoms and the sum of all its atoms.
+        """
+        output_field = DecimalField(max_digits=12, decimal_places=2)
+        positive = Case(When(atoms__amount__gt=0, then=F('atoms__amount')), default=Value(0), output_field=output_field)
+        # Rounded, as SQLite sums decimals as floats
+        return self.annotate(
+            positive_sum=Coalesce(Func(Sum(positive), Value(2), function='ROUND', output_field=output_field), Value(0)),
+            net_sum=Coalesce(Func(Sum('atoms__amount'), Value(2), function='ROUND', output_field=output_field), Value(0)),
+        )
+
+    def touched_since(self, since):
+        """
+        Filters the bills created, or whose atoms were written, since the datetime ``since``.
+        """
+        atoms = Atom.objects.filter(date__gte=since).values('child_of_bill_id')
+        return self.filter(Q(date__gte=since) | Q(pk__in=atoms))
+
+    def inconsistent(self):
+        """
+        Filters the bills failing ```Bill.check_integrity```, with one grouped query.
+        """
+        return self.with_atom_sums().exclude(positive_sum=F('amount'), net_sum=0)
+
+    def iter_inconsistent(self, chunk_size=1000):
+        """
+        Yields the inconsistent bills as dicts, fetching them by chunks of increasing ids.
+        """
+        queryset = self.inconsistent().order_by('pk').values('pk', 'title', 'date', 'amount', 'positive_sum', 'net_sum')
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            last_pk = chunk[-1]['pk']
+
+    def refresh_summaries(self, pks=None):
+        """
+        Recomputes the summary columns of the bills (those of ``pks`` when given) from their atoms,
+        with one query reading the atoms and one ``UPDATE ... SET ... = CASE ... END`` query.
+        """
+        if pks is None:
+            pks = self.values_list('pk', flat=True)
+        summaries = {pk: ([], []) for pk in pks}
+        if not summaries:
+            return 0
+        atoms = (Atom.objects.filter(child_of_bill_id__in=summaries).order_by('pk')
+                 .values_list('child_of_bill_id', 'user_id', 'user__nickname', 'amount'))
+        for bill_id, user_id, nickname, amount in atoms:
+            summaries[bill_id][amount < 0].append([user_id, nickname, str(amount)])
+
+        def column(value, output_field):
+            return Case(*[When(pk=pk, then=Value(value(buyers, participants)))
+                          for pk, (buyers, participants) in summaries.items()], output_field=output_field)
+        total = DecimalField(max_digits=12, decimal_places=2)
+        Bill.objects.filter(pk__in=summaries).update(
+            participant_count=column(lambda buyers, participants: len(participants), models.PositiveIntegerField()),
+            positive_total=column(lambda buyers, participants: sum(Decimal(entry[2]) for entry in buyers), total),
+            negative_total=column(lambda buyers, participants: sum(Decimal(entry[2]) for entry in participants), total),
+            buyers_summary=column(lambda buyers, participants: json.dumps(buyers), models.TextField()),
+            participants_summary=column(lambda buyers, participants: json.dumps(participants), models.TextField()),
+        )
+        return len(summaries)
+
+    def rebuild_summaries(self, chunk_size=1000):
+        """
+        Refreshes the summary columns of all the bills, by chunks of increasing ids. Returns the number of bills.
+        """
+        total, last_pk = 0, 0
+        while True:
+            pks = list(self.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return total
+            with transaction.atomic():
+                total += Bill.objects.refresh_summaries(pks)
+            last_pk = pks[-1]
 
 
 class Bill(models.Model):
@@ -41,10 +325,28 @@ class Bill(models.Model):
     creator = models.ForeignKey('ExtendedUser')
     category = models.ManyToManyField('Category', blank=True)
     amount = models.DecimalField(verbose_name=_("Amount"), max_digits=6, decimal_places=2)
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(default=timezone.now, editable=False)
     title = models.CharField(verbose_name=_("Title"), max_length=100)
     description = models.TextField(blank=True)
     refund = models.BooleanField(editable=False, default=False)
+    group = models.ForeignKey('ExpenseGroup', null=True, blank=True, editable=False, related_name='bills')
+    modified = models.DateTimeField(auto_now=True, db_index=True)  # Write time of the exported columns, see ```save```
+    # Summary of the atoms, maintained by the ```Atom``` write paths, see ```BillQuerySet.refresh_summaries```
+    participant_count = models.PositiveIntegerField(default=0, editable=False)
+    positive_total = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    negative_total = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    buyers_summary = models.TextField(default='[]', editable=False)  # JSON list of [user id, nickname, amount]
+    participants_summary = models.TextField(default='[]', editable=False)
+
+    objects = BillQuerySet.as_manager()
+
+    SUMMARY_FIELDS = ('participant_count', 'positive_total', 'negative_total', 'buyers_summary', 'participants_summary')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', '-date', '-id'], name='expenses_bill_group_date_id'),
+            models.Index(fields=['date', 'id'], name='expenses_bill_date_id'),
+        ]
 
     def __str__(self):
         return _("%(time)s - %(title)s: %(amount)s €") % {
@@ -68,8 +370,16 @@ class Bill(models.Model):
         Checks if the amount of the ```Bill``` instance match the sum of his atoms amount.
         Useful to check if some atoms were modified manually.
         """
-        is_equal = self.calculate_positive_amount() == self.amount
-        is_null = (self.calculate_positive_amount() + self.calculate_negative_amount()) == 0
+        return self.atoms_match_amount(self.amount, [atom.amount for atom in self.atoms.all()])
+
+    @staticmethod
+    def atoms_match_amount(amount, atom_amounts):
+        """
+        Checks if a bill ``amount`` is the sum of the positive ``atom_amounts`` and if these sum to zero.
+        """
+        positive_amount = sum(atom_amount for atom_amount in atom_amounts if atom_amount > 0)
+        is_equal = positive_amount == amount
+        is_null = sum(atom_amounts) == 0
         return is_equal and is_null
 
     @classmethod
@@ -77,7 +387,7 @@ class Bill(models.Model):
         """
         Integrity check of all instances of ```Bill``` model.
         """
-        return [failure for failure in cls.objects.all() if not failure.check_integrity()]
+        return list(cls.objects.inconsistent().order_by('pk'))
 
     def refund_name(self):
         """
@@ -97,25 +407,23 @@ class Bill(models.Model):
         """
         return sum(atom.amount for atom in self.atoms.all() if atom.amount < 0)
 
-    def update_amount(self):
+    def update_amount(self, atoms=None):
         """
         Updates the field ```amount``` with the sum of positive atoms amount.
+        The sum is computed from ``atoms`` when given, instead of reloading the atoms.
         """
-        self.amount = self.calculate_positive_amount()
+        if atoms is None:
+            self.amount = self.calculate_positive_amount()
+        else:
+            self.amount = sum(atom.amount for atom in atoms if atom.amount > 0)
 
-    def equal_split(self, participants):
+    def equal_split(self, participants, seed=None):
         """
         Returns an (almost) equally repartition of expenditures among the
         ``participants`` list. The result is a list of pairs (participant,amount)
         """
-        decimal.getcontext().rounding = decimal.ROUND_DOWN
-        nb_of_participants = len(participants)
-        missing_cents = int(self.amount*100 % nb_of_participants)
-        base_amount = (-self.amount/nb_of_participants).quantize(Decimal('.01'))
-        amount_list = [base_amount - Decimal('0.01')]*missing_cents
-        amount_list += [base_amount]*(nb_of_participants - missing_cents)
-        shuffle(amount_list)
-        return zip(participants, amount_list)
+        shares = splitting.equal_split(splitting.to_cents(self.amount), len(participants), seed)
+        return zip(participants, [-splitting.from_cents(cents) for cents in shares])
 
     def create_atoms(self, buyer, participants, is_refund=False):
         """
@@ -123,24 +431,114 @@ class Bill(models.Model):
         If the amount is not a number of ```participants``` multiple, gives the remaining cents to random ```participants```.
         """
         if is_refund:
-            participant_atom = Atom()
-            participant_atom.user = participants
-            participant_atom.amount = -self.amount
-            participant_atom.child_of_bill = self
-            participant_atom.save()
+            atoms = [Atom(user=participants, amount=-self.amount)]
         else:
-            for participant, amount in amount_list:
-                participant_atom = Atom()
-                participant_atom.amount = amount
-                participant_atom.user = participant
-                participant_atom.child_of_bill = self
-                participant_atom.save()
-
-        buyer_atom = Atom()
-        buyer_atom.amount = self.amount
-        buyer_atom.user = buyer
-        buyer_atom.child_of_bill = self
-        buyer_atom.save()
+            atoms = [Atom(user=participant, amount=amount) for participant, amount in self.equal_split(participants)]
+        atoms.append(Atom(user=buyer, amount=self.amount))
+        self.add_atoms(atoms)
+
+    def add_atoms(self, atoms):
+        """
+        Inserts ``atoms`` for the current ```Bill``` instance in one query and updates the amount from them.
+        Null atoms, which the database refuses, are skipped. The instance must be saved beforehand.
+        """
+        atoms = [atom for atom in atoms if atom.amount]
+        for atom in atoms:
+            atom.child_of_bill = self
+        Atom.objects.bulk_create(atoms)
+        amount = self.amount
+        self.update_amount(atoms)
+        if self.amount != amount:
+            self.save(update_fields=['amount'])
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Never overwrite the summary maintained by ```refresh_summaries``` with a stale value
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.SUMMARY_FIELDS]
+        elif kwargs.get('update_fields') is not None and 'modified' not in kwargs['update_fields']:
+            # The incremental exports re-export the atoms of the bills modified since, see ```expenses.exporting```
+            kwargs['update_fields'] = list(kwargs['update_fields']) + ['modified']
+        return super().save(*args, **kwargs)
+
+    def summary_buyers(self):
+        """
+        Returns the ```SummaryEntry``` of the buyers, read from the summary columns without any query.
+        """
+        return [SummaryEntry(user_id, nickname, Decimal(amount)) for user_id, nickname, amount in json.loads(self.buyers_summary)]
+
+    def summary_participants(self):
+        """
+        Returns the ```SummaryEntry``` of the participants, read from the summary columns without any query.
+        """
+        return [SummaryEntry(user_id, nickname, Decimal(amount))
+                for user_id, nickname, amount in json.loads(self.participants_summary)]
+
+    def buyer_nicknames(self):
+        return ', '.join(entry.nickname for entry in self.summary_buyers())
+
+    def participant_nicknames(self):
+        return ', '.join(entry.nickname for entry in self.summary_participants())
+
+    def involved_ids(self):
+        """
+        Returns the set of the ids of the users involved in the bill, from the summary columns.
+        """
+        return {entry.user_id for entry in self.summary_buyers() + self.summary_participants()}
+
+    def atom_map(self):
+        """
+        Returns the atoms of the current ```Bill``` instance keyed by (user id, is positive), in one query.
+        """
+        if self.pk is None:
+            return {}
+        return {(atom.user_id, atom.amount > 0): atom for atom in Atom.objects.filter(child_of_bill=self)}
+
+    def sync_atoms(self, atoms, existing=None):
+        """
+        Makes the atoms of the current ```Bill``` instance match the unsaved ``atoms`` (one per user and sign,
+        a ```ValueError``` is raised otherwise) with the fewest writes: the missing atoms are inserted in one query, the changed amounts updated
+        in one query and the others deleted in one query. The unchanged atoms are not written at all.
+        ``existing`` is the ```atom_map``` when already loaded. Updates the amount like ```add_atoms```.
+        """
+        if existing is None:
+            existing = self.atom_map()
+        wanted = {}
+        for atom in atoms:
+            key = (atom.user_id, atom.amount > 0)
+            if not atom.amount:
+                continue
+            if key in wanted:
+                raise ValueError("Several %s atoms of the user %s" % ('positive' if key[1] else 'negative', atom.user_id))
+            wanted[key] = atom
+        removed = [atom.pk for key, atom in existing.items() if key not in wanted]
+        changed = [(existing[key], atom.amount) for key, atom in wanted.items()
+                   if key in existing and existing[key].amount != atom.amount]
+        added = [atom for key, atom in wanted.items() if key not in existing]
+        with transaction.atomic():
+            if removed:
+                Atom.objects.filter(pk__in=removed).delete()
+            if changed:
+                now = timezone.now()
+                output_field = DecimalField(max_digits=6, decimal_places=2)
+                Atom.objects.filter(pk__in=[atom.pk for atom, amount in changed]).update(
+                    amount=Case(*[When(pk=atom.pk, then=Value(amount)) for atom, amount in changed], output_field=output_field),
+                    date=now,
+                )
+                # ```QuerySet.update``` bypasses the write paths
+                record_atom_changes([atom.change(-1) for atom, amount in changed] +
+                                    [AtomChange(atom.user_id, self.pk, amount, now, 1) for atom, amount in changed])
+                for atom, amount in changed:
+                    atom.amount, atom.date = amount, now
+            if added:
+                for atom in added:
+                    atom.child_of_bill = self
+                Atom.objects.bulk_create(added)
+            amount = self.amount
+            self.update_amount(wanted.values())
+            if self.amount != amount:
+                self.save(update_fields=['amount'])
+        return added, changed, removed
 
     def list_of_positive_atoms(self):
         """
@@ -170,7 +568,7 @@ class Bill(models.Model):
         """
         Returns the list of user involved in the current ```Bill``` instance.
         """
-        return list(set(self.list_of_buyers() + self.list_of_participants()))
+        return list(OrderedDict.fromkeys(self.list_of_buyers() + self.list_of_participants()))
 
     def __enter__(self):
         return self
@@ -180,81 +578,207 @@ class Bill(models.Model):
             self.delete()
 
 
+@receiver(models.signals.m2m_changed, sender=Bill.category.through)
+def update_bill_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Refreshes the spending of the days of the bills whose categories change, and stamps them as modified.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        bills = instance.bill_set.all() if action == 'pre_clear' else Bill.objects.filter(pk__in=pk_set or ())
+    else:
+        bills = Bill.objects.filter(pk=instance.pk)
+    enqueue_spending(bills.filter(refund=False).values_list('date', flat=True))
+    Bill.objects.filter(pk__in=list(bills.values_list('pk', flat=True))).update(modified=timezone.now())
+
+
+@receiver(models.signals.pre_delete, sender=Bill)
+def delete_bill_atoms(sender, instance, **kwargs):
+    """
+    Deletes the atoms of a ```Bill``` before the cascade so that the derived data is updated.
+    """
+    instance.atoms.all().delete()
+
+
+@receiver(models.signals.post_save, sender=Bill)
+@receiver(models.signals.post_delete, sender=Bill)
+def bump_bill_versions(sender, instance, **kwargs):
+    caching.bump_ledger([instance.group_id])
+
+
+class ExtendedUserQuerySet(models.QuerySet):
+    def with_atoms_balance(self):
+        """
+        Annotates each ```ExtendedUser``` with the balance computed from his atoms.
+        """
+        return self.annotate(atoms_balance=Coalesce(Sum('atoms__amount'), Value(0)))
+
+    def balance_rows(self, from_atoms=False):
+        """
+        Returns the list of ```BalanceRow``` ordered by decreasing balance, in one query.
+        By default reads the stored balances, ``from_atoms`` aggregates the atoms instead.
+        """
+        queryset = self.with_atoms_balance() if from_atoms else self
+        balance = 'atoms_balance' if from_atoms else 'ledger_balance'
+        rows = queryset.order_by('-' + balance, 'nickname').values_list('pk', 'user_id', 'nickname', balance)
+        return [BalanceRow(*row) for row in rows]
+
+
 class ExtendedUser(models.Model):
     """
     Extension of Django's User model with a one to one link.
     """
     user = models.OneToOneField(User)
-    nickname = models.CharField(max_length=20, help_text="name to be displayed")
+    nickname = models.CharField(max_length=20, help_text="name to be displayed")  # Searched on lower(nickname), see ```expenses.constraints```
+    ledger_balance = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    modified = models.DateTimeField(auto_now=True, db_index=True)  # Write time of the nickname or of the username
+
+    objects = ExtendedUserQuerySet.as_manager()
 
     @property
     def balance(self):
         """
-        Calculates the balance of the current ```ExtendedUser``` instance.
+        Returns the balance of the current ```ExtendedUser``` instance.
+        The value is maintained by the ```Atom``` write paths, see ```rebuild_balances```.
+        """
+        return self.ledger_balance
+
+    @classmethod
+    def shift_balances(cls, deltas):
+        """
+        Adds the amounts of the ``deltas`` dict (user id -> amount) to the stored balances.
         """
-        return sum([atom.amount for atom in self.atoms.all()])
+        add_deltas(cls.objects.all(), 'ledger_balance', [(Q(pk=user_id), delta) for user_id, delta in deltas.items()])
+
+    @classmethod
+    def rebuild_balances(cls, dry_run=False):
+        """
+        Recomputes the stored balances from the atoms.
+        Returns the list of (user, stored balance, atoms balance) that were drifting.
+        """
+        with transaction.atomic():
+            drifts = [(user, user.ledger_balance, user.atoms_balance)
+                      for user in cls.objects.with_atoms_balance()
+                      if user.ledger_balance != user.atoms_balance]
+            if not dry_run:
+                for user, stored, computed in drifts:
+                    cls.objects.filter(pk=user.pk).update(ledger_balance=computed)
+        return drifts
 
     def __str__(self):
         return self.nickname
 
-    def __lt__(self, other):
-        if type(self) == type(other) or type(other) == int:
-            if type(other) == int:
-                return self.balance < other
-            else:
-                return self.balance < other.balance
-        else:
-            return NotImplemented
-
-    def __le__(self, other):
-        if type(self) == type(other) or type(other) == int:
-            if type(other) == int:
-                return self.balance <= other
-            else:
-                return self.balance <= other.balance
-        else:
-            return NotImplemented
-
-    def __eq__(self, other):
-        if type(self) == type(other) or type(other) == int:
-            if type(other) == int:
-                return self.balance == other
-            else:
-                return self.balance == other.balance
-        else:
-            return NotImplemented
-
-    def __ne__(self, other):
-        if type(self) == type(other) or type(other) == int:
-            if type(other) == int:
-                return self.balance != other
-            else:
-                return self.balance != other.balance
-        else:
-            return NotImplemented
-
-    def __gt__(self, other):
-        if type(self) == type(other) or type(other) == int:
-            if type(other) == int:
-                return self.balance > other
-            else:
-                return self.balance > other.balance
-        else:
-            return NotImplemented
-
-    def __ge__(self, other):
-        if type(self) == type(other) or type(other) == int:
-            if type(other) == int:
-                return self.balance >= other
-            else:
-                return self.balance >= other.balance
-        else:
-            return NotImplemented
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_nickname = instance.__dict__.get('nickname')
+        return instance
 
     def save(self, *args, **kwargs):
         if not self.nickname:
             self.nickname = self.user.username
-        return super().save(*args, **kwargs)
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Never overwrite the balance maintained by ```shift_balances``` with a stale value
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'ledger_balance']
+        renamed = not self._state.adding and getattr(self, '_loaded_nickname', None) != self.nickname
+        with transaction.atomic():
+            result = super().save(*args, **kwargs)
+            if renamed:
+                # The nickname is copied in the summary of the bills, refreshed by chunks out of the request
+                Task.objects.enqueue('refresh_user_summaries', {self.pk: {'user': self.pk}})
+        self._loaded_nickname = self.nickname
+        return result
+
+
+class ExpenseGroup(models.Model):
+    """
+    A flatshare, a trip...: the ```ExtendedUser``` sharing a set of ```Bill```.
+    """
+    name = models.CharField(max_length=100)
+    members = models.ManyToManyField('ExtendedUser', through='Membership', related_name='expense_groups')
+
+    def __str__(self):
+        return self.name
+
+
+class MembershipQuerySet(CounterQuerySet):
+    def balance_rows(self):
+        """
+        Returns the list of ```BalanceRow``` of the members, ordered by decreasing balance, in one query.
+        """
+        rows = self.order_by('-balance', 'user__nickname').values_list('user_id', 'user__user_id', 'user__nickname', 'balance')
+        return [BalanceRow(*row) for row in rows]
+
+    def with_atoms(self):
+        """
+        Filters the memberships whose user has atoms in the bills of the group.
+        """
+        atoms = Atom.objects.filter(user_id=OuterRef('user_id'), child_of_bill__group_id=OuterRef('group_id'))
+        return self.annotate(has_atoms=Exists(atoms)).filter(has_atoms=True)
+
+    def protect(self):
+        """
+        Raises a ```ProtectedError``` if a user of the memberships has atoms in the bills of the group:
+        the balance would be lost, and the next write of these atoms couldn't be applied.
+        """
+        protected = list(self.with_atoms())
+        if protected:
+            raise ProtectedError("Members with bills in the group: %s" % ', '.join(map(str, protected)), protected)
+
+    def delete(self):
+        with transaction.atomic():
+            self.protect()
+            return super().delete()
+
+
+class Membership(models.Model):
+    """
+    Link between an ```ExpenseGroup``` and an ```ExtendedUser```, with the balance of the user
+    within the group, maintained like ``ExtendedUser.ledger_balance``. Kept while the user has atoms
+    in the bills of the group, see ```MembershipQuerySet.protect```.
+    """
+    counter_keys = ('group_id', 'user_id')
+    counter_field = 'balance'
+    group = models.ForeignKey('ExpenseGroup', related_name='memberships')
+    user = models.ForeignKey('ExtendedUser', related_name='memberships')
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+
+    objects = MembershipQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('group', 'user')
+
+    def __str__(self):
+        return "%s in %s" % (self.user, self.group)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            Membership.objects.filter(pk=self.pk).protect()
+            return super().delete(*args, **kwargs)
+
+
+@receiver(models.signals.post_save, sender=ExtendedUser)
+@receiver(models.signals.post_delete, sender=ExtendedUser)
+def bump_users_version(sender, **kwargs):
+    caching.bump_users()
+
+
+@receiver(models.signals.post_save, sender=User)
+def touch_extended_user(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Stamps the ```ExtendedUser``` of a ```User``` whose username may have changed, for the incremental exports.
+    """
+    if not created and (update_fields is None or 'username' in update_fields):
+        ExtendedUser.objects.filter(user=instance).update(modified=timezone.now())
+
+
+@receiver(models.signals.post_save, sender=ExpenseGroup)
+@receiver(models.signals.post_save, sender=Membership)
+@receiver(models.signals.post_delete, sender=Membership)
+def bump_group_version(sender, instance, **kwargs):
+    caching.bump_ledger([instance.pk if sender is ExpenseGroup else instance.group_id])
 
 
 class Category(models.Model):
@@ -266,3 +790,222 @@ class Category(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class BalanceSnapshotQuerySet(models.QuerySet):
+    def invalidate(self, changes):
+        """
+        Deletes the snapshots made obsolete by a list of ```AtomChange``` dated before today.
+        Returns the ids of the users who lost snapshots.
+        """
+        today = timezone.localdate()
+        first_days = {}
+        for change in changes:
+            if change.date is not None:
+                day = timezone.localdate(change.date)
+                if day < today and day < first_days.get(change.user_id, today):
+                    first_days[change.user_id] = day
+        if first_days:
+            obsolete = Q()
+            for user_id, day in first_days.items():
+                obsolete |= Q(user_id=user_id, day__gte=day)
+            users = set(self.filter(obsolete).values_list('user_id', flat=True).distinct())
+            self.filter(obsolete).delete()
+            return users
+        return set()
+
+    def latest(self):
+        """
+        Filters the last snapshot of each user.
+        """
+        latest_day = BalanceSnapshot.objects.filter(user_id=OuterRef('user_id')).order_by('-day').values('day')[:1]
+        return self.filter(day=Subquery(latest_day))
+
+    def build(self, users=None, until=None):
+        """
+        Creates the missing snapshots of ``users`` (a list of ids, everybody by default) up to the day ``until``,
+        yesterday at most, as ```invalidate``` ignores the changes of today. Only the atoms written after
+        the last snapshot of each user are read. Returns the number of snapshots created.
+        """
+        if users is None:
+            users = list(ExtendedUser.objects.values_list('pk', flat=True))
+        yesterday = timezone.localdate() - datetime.timedelta(days=1)
+        until = yesterday if until is None else min(until, yesterday)
+
+        last_snapshots = {user_id: (day, balance) for user_id, day, balance in
+                          self.latest().filter(user_id__in=users).values_list('user_id', 'day', 'balance')}
+        new_users = [user_id for user_id in users if user_id not in last_snapshots]
+        atoms_filter = Q(user_id__in=new_users)
+        if last_snapshots:
+            start = min(day for day, balance in last_snapshots.values()) + datetime.timedelta(days=1)
+            atoms_filter |= Q(user_id__in=list(last_snapshots), date__gte=start_of_day(start))
+        atoms = Atom.objects.filter(atoms_filter, date__lt=start_of_day(until + datetime.timedelta(days=1)))
+        daily_totals = (atoms.annotate(day=TruncDate('date')).order_by('user_id', 'day')
+                        .values_list('user_id', 'day').annotate(total=Sum('amount')))
+
+        snapshots = []
+        for user_id, day, total in daily_totals.iterator():
+            last_day, balance = last_snapshots.get(user_id, (None, 0))
+            if last_day is not None and day <= last_day:
+                continue
+            last_snapshots[user_id] = (day, balance + total)
+            snapshots.append(BalanceSnapshot(user_id=user_id, day=day, balance=balance + total))
+        self.bulk_create(snapshots, batch_size=1000)
+        return len(snapshots)
+
+    def series(self, user, start, end):
+        """
+        Returns the list of (day, balance) of ``user`` for each day from ``start`` to ``end``.
+        Reads one snapshot per day with atoms in the window; the balance of today is the live one.
+        """
+        previous = self.filter(user=user, day__lt=start).order_by('-day').values_list('balance', flat=True).first()
+        balances = dict(self.filter(user=user, day__gte=start, day__lte=end).values_list('day', 'balance'))
+        today = timezone.localdate()
+        balance = previous or Decimal(0)
+        series = []
+        day = start
+        while day <= end:
+            if day == today:
+                balance = ExtendedUser.objects.values_list('ledger_balance', flat=True).get(pk=user.pk)
+            elif day > today:
+                break
+            balance = balances.get(day, balance)
+            series.append((day, balance))
+            day += datetime.timedelta(days=1)
+        return series
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Balance of an ```ExtendedUser``` at the end of a day. Only the days with atoms are stored.
+    """
+    user = models.ForeignKey('ExtendedUser', related_name='snapshots')
+    day = models.DateField()
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+
+    objects = BalanceSnapshotQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('user', 'day')
+
+    def __str__(self):
+        return "%s: %s € on %s" % (self.user, self.balance, self.day)
+
+
+class UserSpending(models.Model):
+    """
+    Rollup of the shares of an ```ExtendedUser``` in the bills of an ```ExpenseGroup``` of a day, refunds excluded.
+    """
+    counter_keys = ('day', 'group_id', 'user_id')
+    counter_field = 'amount'
+    day = models.DateField()
+    group = models.ForeignKey('ExpenseGroup', null=True, related_name='+')
+    user = models.ForeignKey('ExtendedUser', related_name='+')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = CounterQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('user', 'group', 'day')
+
+
+class CategorySpending(models.Model):
+    """
+    Rollup of the amounts of the bills of an ```ExpenseGroup``` of a day in a ```Category```, refunds excluded.
+    """
+    counter_keys = ('day', 'group_id', 'category_id')
+    counter_field = 'amount'
+    day = models.DateField()
+    group = models.ForeignKey('ExpenseGroup', null=True, related_name='+')
+    category = models.ForeignKey('Category', related_name='+')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    objects = CounterQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('category', 'group', 'day')
+
+
+class TaskQuerySet(models.QuerySet):
+    def enqueue(self, name, jobs):
+        """
+        Queues the ``jobs`` of the task ``name``, a dict (coalescing key -> payload dict).
+        The jobs whose key is already waiting are skipped, as they would do the same work.
+        """
+        if not jobs:
+            return
+        keys = {'%s:%s' % (name, key): payload for key, payload in jobs.items()}
+        waiting = set(self.waiting().filter(key__in=keys).values_list('key', flat=True))
+        self.bulk_create([Task(name=name, key=key, payload=json.dumps(payload))
+                          for key, payload in keys.items() if key not in waiting])
+
+    def waiting(self):
+        """
+        Filters the tasks not taken by a worker yet.
+        """
+        return self.filter(failed=False, locked_until__isnull=True)
+
+    def due(self):
+        """
+        Filters the tasks a worker can take: waiting ones whose time has come, or whose worker got stuck.
+        """
+        now = timezone.now()
+        return self.filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now), failed=False, run_after__lte=now)
+
+
+class Task(models.Model):
+    """
+    A job of the queue run by the ``run_tasks`` command, see ```expenses.tasks```.
+    """
+    name = models.CharField(max_length=50)
+    key = models.CharField(max_length=200, db_index=True)
+    payload = models.TextField(default='{}')  # JSON
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+
+    objects = TaskQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed', 'run_after'], name='expenses_task_due'),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
+class CacheVersionQuerySet(models.QuerySet):
+    def current(self, names):
+        """
+        Returns the dict of the tokens of ``names``, seeding the missing ones.
+        """
+        tokens = dict(self.filter(name__in=names).values_list('name', 'token'))
+        for name in set(names) - set(tokens):
+            tokens[name] = self.get_or_create(name=name, defaults={'token': caching.new_version()})[0].token
+        return tokens
+
+    def bump(self, names):
+        """
+        Gives new tokens to ``names``, in the current transaction.
+        """
+        token = caching.new_version()
+        if self.filter(name__in=names).update(token=token) < len(names):
+            for name in names:
+                self.update_or_create(name=name, defaults={'token': token})
+
+
+class CacheVersion(models.Model):
+    """
+    Version of the pages cached under ``name``, see ```expenses.caching```. Kept in the database, where
+    the server processes, the commands and the ``run_tasks`` worker all see the bumps of each other.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    token = models.CharField(max_length=32)
+
+    objects = CacheVersionQuerySet.as_manager()
+
+    def __str__(self):
+        return self.name
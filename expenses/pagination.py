@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keyset (cursor) pagination over querysets ordered by decreasing ``(date, id)``.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+Page = namedtuple('Page', ['items', 'previous_cursor', 'next_cursor'])
+Page.__doc__ = """
+A page of items, with the cursors of the neighbouring pages (``None`` when there is no such page).
+"""
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(item):
+    """
+    Returns the opaque cursor pointing to ``item``.
+    """
+    key = "%s|%d" % (item.date.isoformat(), item.pk)
+    return urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(date, id)`` pair encoded in ``cursor``.
+    """
+    try:
+        date, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        date, pk = parse_datetime(date), int(pk)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if date is None:
+        raise InvalidCursor(cursor)
+    return date, pk
+
+
+def keyset_page(queryset, size, before=None, after=None):
+    """
+    Returns the ```Page``` of ``size`` items of ``queryset`` older than the cursor ``before``,
+    or newer than the cursor ``after``, or the most recent ones if no cursor is given.
+    Only one query is run: one extra item is fetched to know if there is a further page.
+    """
+    if after is not None:
+        date, pk = decode_cursor(after)
+        newer = Q(date__gt=date) | Q(date=date, pk__gt=pk)
+        items = list(queryset.filter(newer).order_by('date', 'id')[:size + 1])
+        has_previous = len(items) > size
+        items = items[:size][::-1]
+        has_next = True
+    else:
+        if before is not None:
+            date, pk = decode_cursor(before)
+            queryset = queryset.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+        items = list(queryset.order_by('-date', '-id')[:size + 1])
+        has_next = len(items) > size
+        items = items[:size]
+        has_previous = before is not None
+    return Page(
+        items,
+        encode_cursor(items[0]) if has_previous and items else None,
+        encode_cursor(items[-1]) if has_next and items else None,
+    )
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lookups of the participant picker, see ```expenses.widgets.ParticipantWidget```.
+
+The search matches the start of the nickname or of the username whatever the case, on ``lower()`` of the columns
+so that the expression indexes of ```expenses.constraints``` apply, and returns a bounded number of members.
+The suggestions (recent and frequent co-participants of a user) are computed from their latest atoms and cached per user under the ledger version of the group, see ```expenses.caching```.
+"""
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.db.models.functions import Lower
+
+from expenses import caching, groups
+from expenses.models import Atom, ExtendedUser
+
+
+HISTORY_SIZE = 200  # Latest bills of the user the suggestions are computed from
+
+
+def search_limit(size=None):
+    """
+    Returns ``size`` bounded by ``EXPENSES_PARTICIPANT_SEARCH_LIMIT``, which is also the default.
+    """
+    limit = getattr(settings, 'EXPENSES_PARTICIPANT_SEARCH_LIMIT', 20)
+    return limit if size is None else min(max(size, 1), limit)
+
+
+def search(group, prefix, size=None):
+    """
+    Returns the (id, nickname) of the members of ``group`` whose nickname or username starts with ``prefix``
+    case-insensitively, ordered by nickname.
+    """
+    if not prefix:
+        return []
+    # ``istartswith`` compares UPPER() on PostgreSQL, which wouldn't use the lower() indexes
+    prefix = prefix.lower()
+    users = (groups.members(group).annotate(nickname_lower=Lower('nickname'), username_lower=Lower('user__username'))
+             .filter(Q(nickname_lower__startswith=prefix) | Q(username_lower__startswith=prefix)))
+    return list(users.order_by('nickname', 'pk').values_list('pk', 'nickname')[:search_limit(size)])
+
+
+def compute_suggestions(user_id, group):
+    """
+    Returns the lists of (id, nickname) of the users who shared the latest bills of ``user_id`` in ``group``:
+    ``recent`` by last shared bill and ``frequent`` by number of shared bills.
+    """
+    size = getattr(settings, 'EXPENSES_PARTICIPANT_SUGGESTIONS', 8)
+    bills = list(Atom.objects.filter(user_id=user_id, child_of_bill__group=group)
+                 .order_by('-date').values_list('child_of_bill_id', flat=True)[:HISTORY_SIZE])
+    rows = list(Atom.objects.filter(child_of_bill_id__in=set(bills)).exclude(user_id=user_id).order_by()
+                .values_list('user_id').annotate(last=Max('date'), shared=Count('child_of_bill', distinct=True)))
+    recent = [pk for pk, last, shared in sorted(rows, key=lambda row: (row[1], row[0]), reverse=True)][:size]
+    frequent = [pk for pk, last, shared in sorted(rows, key=lambda row: (-row[2], row[0]))][:size]
+    nicknames = dict(ExtendedUser.objects.filter(pk__in=set(recent + frequent)).values_list('pk', 'nickname'))
+    return {
+        'recent': [(pk, nicknames[pk]) for pk in recent],
+        'frequent': [(pk, nicknames[pk]) for pk in frequent],
+    }
+
+
+def suggestions(user_id, group):
+    """
+    Returns the result of ```compute_suggestions```, cached until a bill of ``group`` or a user changes.
+    """
+    return caching.cached_page('participant_suggestions', group, lambda: compute_suggestions(user_id, group), user_id)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ranking of the users by balance, read from the cached ```BalanceRow``` of a group.
+
+```ExtendedUser``` instances compare by primary key like any model: comparing balances goes through
+a ```Leaderboard```, which answers from the rows it was built with, without any query.
+"""
+from expenses import caching, groups
+
+
+def _pk(user):
+    return getattr(user, 'pk', user)
+
+
+class Leaderboard:
+    """
+    The ```BalanceRow``` of a group ordered by decreasing balance. The users can be given as
+    ```ExtendedUser``` instances or ids.
+    """
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.balances = {row.pk: row.balance for row in self.rows}
+        self.ranks = {}
+        for position, row in enumerate(self.rows, 1):
+            # Equal balances share the rank of the first of them
+            previous = self.rows[position - 2] if position > 1 else None
+            same = previous is not None and previous.balance == row.balance
+            self.ranks[row.pk] = self.ranks[previous.pk] if same else position
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, user):
+        return _pk(user) in self.balances
+
+    def balance(self, user):
+        return self.balances[_pk(user)]
+
+    def rank(self, user):
+        """
+        Returns the rank of ``user``, 1 for the highest balance.
+        """
+        return self.ranks[_pk(user)]
+
+    def compare(self, user, other):
+        """
+        Returns -1, 0 or 1 as the balance of ``user`` is lower than, equal to or greater than the balance of ``other``.
+        """
+        balance, other_balance = self.balance(user), self.balance(other)
+        return (balance > other_balance) - (balance < other_balance)
+
+    def top(self, number):
+        return self.rows[:number]
+
+    def creditors(self):
+        return [row for row in self.rows if row.balance > 0]
+
+    def debtors(self):
+        return [row for row in reversed(self.rows) if row.balance < 0]
+
+
+def leaderboard(group):
+    """
+    Returns the ```Leaderboard``` of ``group``, cached under the ledger versions like the balances page.
+    """
+    return Leaderboard(caching.cached_page('balances', group, lambda: groups.balance_rows(group)))
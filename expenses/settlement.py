@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Computes the transfers ("who pays whom") that settle the balances of the users.
+"""
+import heapq
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from expenses.models import Atom, Bill, ExtendedUser, Membership
+
+
+Transfer = namedtuple('Transfer', ['debtor', 'creditor', 'amount'])
+Transfer.__doc__ = """
+A payment of ``amount`` from the user id ``debtor`` to the user id ``creditor``.
+"""
+
+CENT = Decimal('0.01')
+
+
+def settle(balances):
+    """
+    Returns a short list of ```Transfer``` which zeroes the ``balances`` dict (user id -> amount).
+    The largest debt is repeatedly paid to the largest credit, which gives at most n - 1 transfers.
+    If the balances don't sum to zero, the remainder is left unsettled.
+    """
+    creditors, debtors = [], []
+    for user, amount in balances.items():
+        cents = int(amount / CENT)
+        if cents > 0:
+            creditors.append((-cents, user))
+        elif cents < 0:
+            debtors.append((cents, user))
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        cents = min(-credit, -debt)
+        transfers.append(Transfer(debtor, creditor, cents * CENT))
+        if credit + cents:
+            heapq.heappush(creditors, (credit + cents, creditor))
+        if debt + cents:
+            heapq.heappush(debtors, (debt + cents, debtor))
+    return transfers
+
+
+def current_balances(users=None, category=None, group=None):
+    """
+    Returns the balances (user id -> amount) of ``users``, or of everybody.
+    With a ``category``, only the bills of that ```Category``` are taken into account.
+    With a ``group``, the balances within that ```ExpenseGroup``` are returned.
+    """
+    if category is None and group is not None:
+        queryset = Membership.objects.filter(group=group).values_list('user_id', 'balance')
+        if users is not None:
+            queryset = queryset.filter(user__in=users)
+    elif category is None:
+        queryset = ExtendedUser.objects.values_list('pk', 'ledger_balance')
+        if users is not None:
+            queryset = queryset.filter(pk__in=users)
+    else:
+        queryset = Atom.objects.filter(child_of_bill__category=category)
+        if group is not None:
+            queryset = queryset.filter(child_of_bill__group=group)
+        if users is not None:
+            queryset = queryset.filter(user__in=users)
+        queryset = queryset.order_by().values_list('user').annotate(Sum('amount'))
+    return dict(queryset)
+
+
+def create_refunds(transfers, creator, group=None, category=None):
+    """
+    Creates the refund ```Bill``` of each ```Transfer``` and their atoms, in one transaction.
+    The transfers settling the balances of a ``category`` give refunds of that ```Category```,
+    so that its balances are settled afterwards.
+    """
+    bills = []
+    for transfer in transfers:
+        bill = Bill(creator=creator, amount=transfer.amount, refund=True, group=group)
+        bill.title = bill.refund_name()
+        bills.append(bill)
+
+    with transaction.atomic():
+        if connection.features.can_return_ids_from_bulk_insert:
+            bills = Bill.objects.bulk_create(bills)
+        else:
+            for bill in bills:
+                bill.save()
+        if category is not None:
+            Through = Bill.category.through
+            Through.objects.bulk_create([Through(bill_id=bill.pk, category_id=category.pk) for bill in bills])
+        atoms = []
+        for bill, transfer in zip(bills, transfers):
+            atoms.append(Atom(user_id=transfer.debtor, amount=transfer.amount, child_of_bill=bill))
+            atoms.append(Atom(user_id=transfer.creditor, amount=-transfer.amount, child_of_bill=bill))
+        Atom.objects.bulk_create(atoms)
+    return bills
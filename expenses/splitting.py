@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Splitting of an amount among participants, in integer cents.
+
+Every function returns a list of cents summing exactly to the total. The cents which can't
+be split evenly are given to participants drawn with ``random.Random(seed)``: a given seed
+always gives the same result, and no global state (random generator, decimal context) is used.
+"""
+import random
+from decimal import Decimal
+
+
+CENT = Decimal('0.01')
+
+
+def to_cents(amount):
+    """
+    Converts a ```Decimal``` amount to an integer number of cents.
+    """
+    cents = Decimal(amount) * 100
+    if cents != cents.to_integral_value():
+        raise ValueError("%s is not a whole number of cents" % (amount,))
+    return int(cents)
+
+
+def from_cents(cents):
+    """
+    Converts an integer number of cents to a ```Decimal``` amount.
+    """
+    return cents * CENT
+
+
+def _rotation(count, rng):
+    """
+    Returns the indices ``0..count-1`` rotated by a random offset: a single draw gives
+    each index the same chance to come first.
+    """
+    offset = rng.randrange(count)
+    return list(range(offset, count)) + list(range(offset))
+
+
+def _equal_parts(total, count, rng):
+    """
+    Returns ``count`` parts of ``total`` cents, the extra cents going to consecutive parts
+    from a random offset.
+    """
+    quotient, remainder = divmod(total, count)
+    parts = [quotient] * count
+    if remainder:
+        for index in _rotation(count, rng)[:remainder]:
+            parts[index] += 1
+    return parts
+
+
+def equal_split(total, count, seed=None):
+    """
+    Splits ``total`` cents in ``count`` parts differing by at most one cent.
+    """
+    if count <= 0:
+        raise ValueError("Cannot split among %s participants" % count)
+    if not total % count:
+        return [total // count] * count
+    return _equal_parts(total, count, random.Random(seed))
+
+
+def weighted_split(total, shares, seed=None):
+    """
+    Splits ``total`` cents proportionally to the integer ``shares`` (largest remainder method).
+    The remaining cents go to the parts with the largest remainders, ties being drawn at random.
+    """
+    weight = sum(shares)
+    if weight <= 0 or any(share < 0 for share in shares):
+        raise ValueError("Shares must be positive")
+    parts, remainders = [], []
+    for share in shares:
+        quotient, remainder = divmod(total * share, weight)
+        parts.append(quotient)
+        remainders.append(remainder)
+    missing = total - sum(parts)
+    if missing:
+        order = sorted(_rotation(len(shares), random.Random(seed)), key=remainders.__getitem__, reverse=True)
+        for index in order[:missing]:
+            parts[index] += 1
+    return parts
+
+
+def percentage_split(total, percentages, seed=None):
+    """
+    Splits ``total`` cents according to ``percentages`` (```Decimal``` or int), which must sum to 100.
+    """
+    percentages = [Decimal(percentage) for percentage in percentages]
+    if sum(percentages) != 100:
+        raise ValueError("Percentages must sum to 100")
+    scale = max(-percentage.as_tuple().exponent for percentage in percentages + [Decimal(0)])
+    return weighted_split(total, [int(percentage.scaleb(scale)) for percentage in percentages], seed)
+
+
+def fixed_split(total, fixed, seed=None):
+    """
+    Gives their amount to the parts of ``fixed`` which are set (in cents), and splits
+    the remainder equally among the parts which are ``None``.
+    """
+    remainder = total - sum(part for part in fixed if part is not None)
+    free = [index for index, part in enumerate(fixed) if part is None]
+    if remainder < 0 or (remainder and not free):
+        raise ValueError("Fixed parts don't match the total")
+    parts = [part or 0 for part in fixed]
+    if free:
+        for index, cents in zip(free, equal_split(remainder, len(free), seed)):
+            parts[index] = cents
+    return parts
+
+
+def batch_equal_split(bills, seed=None):
+    """
+    Splits many bills at once: ``bills`` is an iterable of (total cents, count) pairs.
+    Yields the list of parts of each bill, all the draws coming from one generator.
+    """
+    rng = random.Random(seed)
+    for total, count in bills:
+        if count <= 0:
+            raise ValueError("Cannot split among %s participants" % count)
+        yield _equal_parts(total, count, rng)
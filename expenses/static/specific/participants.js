@@ -0,0 +1,102 @@
+// Participant picker, see expenses.widgets.ParticipantWidget
+(function () {
+    'use strict';
+
+    function request(url, callback) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', url);
+        xhr.onload = function () {
+            if (xhr.status === 200) {
+                callback(JSON.parse(xhr.responseText));
+            }
+        };
+        xhr.send();
+    }
+
+    function setUp(picker) {
+        var name = picker.dataset.name;
+        var multiple = picker.dataset.multiple === 'true';
+        var selection = picker.querySelector('.participant-selection');
+        var results = picker.querySelector('.participant-results');
+        var search = picker.querySelector('input[type=search]');
+        var timer = null;
+
+        function selected(id) {
+            return selection.querySelector('input[value="' + id + '"]') !== null;
+        }
+
+        function select(id, nickname) {
+            if (selected(id)) {
+                return;
+            }
+            if (!multiple) {
+                selection.innerHTML = '';
+            }
+            var item = document.createElement('li');
+            var input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = name;
+            input.value = id;
+            var remove = document.createElement('button');
+            remove.type = 'button';
+            remove.className = 'participant-remove';
+            remove.innerHTML = '&times;';
+            item.appendChild(input);
+            item.appendChild(document.createTextNode(nickname + ' '));
+            item.appendChild(remove);
+            selection.appendChild(item);
+        }
+
+        function show(users) {
+            results.innerHTML = '';
+            users.forEach(function (user) {
+                var item = document.createElement('li');
+                item.textContent = user.nickname;
+                item.addEventListener('click', function () {
+                    select(user.id, user.nickname);
+                    search.value = '';
+                    results.innerHTML = '';
+                });
+                results.appendChild(item);
+            });
+        }
+
+        function suggest() {
+            request(picker.dataset.suggestionsUrl, function (data) {
+                var seen = {};
+                show(data.recent.concat(data.frequent).filter(function (user) {
+                    var fresh = !seen[user.id] && !selected(user.id);
+                    seen[user.id] = true;
+                    return fresh;
+                }));
+            });
+        }
+
+        selection.addEventListener('click', function (event) {
+            if (event.target.classList.contains('participant-remove')) {
+                selection.removeChild(event.target.parentNode);
+            }
+        });
+        search.addEventListener('focus', function () {
+            if (!search.value) {
+                suggest();
+            }
+        });
+        search.addEventListener('input', function () {
+            clearTimeout(timer);
+            if (!search.value) {
+                suggest();
+                return;
+            }
+            timer = setTimeout(function () {
+                request(picker.dataset.searchUrl + '?q=' + encodeURIComponent(search.value), function (data) {
+                    show(data.results);
+                });
+            }, 150);
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        Array.prototype.forEach.call(document.querySelectorAll('.participant-picker'), setUp);
+    });
+}());
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Database-backed queue of the derived work, run by the ``run_tasks`` command out of the requests.
+
+The write paths only queue ```Task``` rows, with a coalescing key: a job already waiting is not queued
+again. Jobs must therefore be idempotent: they recompute their result from the data instead of applying
+a delta. A failing job is retried later, up to ``EXPENSES_TASK_MAX_ATTEMPTS`` times.
+"""
+import datetime
+import json
+import traceback
+
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.translation import ugettext as _
+
+from expenses import analytics
+from expenses.models import BalanceSnapshot, Bill, Task
+
+
+JOBS = {}
+LOCK_DURATION = datetime.timedelta(minutes=10)
+RETRY_DELAY = datetime.timedelta(seconds=30)
+
+
+def job(name):
+    """
+    Registers the decorated function as the job ``name``, called with the payload as keyword arguments.
+    """
+    def register(function):
+        JOBS[name] = function
+        return function
+    return register
+
+
+@job('refresh_spending')
+def refresh_spending(day):
+    analytics.refresh_day(parse_date(day))
+
+
+@job('build_snapshots')
+def build_snapshots(user):
+    BalanceSnapshot.objects.build(users=[user])
+
+
+@job('refresh_user_summaries')
+def refresh_user_summaries(user):
+    """
+    Refreshes the summary of the bills of ``user``, which hold their nickname.
+    """
+    Bill.objects.filter(atoms__user=user).distinct().rebuild_summaries()
+
+
+@job('notify_bill')
+def notify_bill(bill):
+    """
+    Mails the people involved in the bill ``bill``, but its creator, their share of it.
+    """
+    try:
+        bill = Bill.objects.with_atoms().get(pk=bill)
+    except Bill.DoesNotExist:
+        return
+    users, shares = {}, {}
+    for atom in bill.atoms.all():
+        users[atom.user_id] = atom.user
+        shares[atom.user_id] = shares.get(atom.user_id, 0) + atom.amount
+    messages = []
+    for user_id, share in shares.items():
+        user = users[user_id]
+        if user_id != bill.creator_id and user.user.email:
+            body = _("%(creator)s wrote the bill \"%(title)s\" (%(amount)s €): your balance changes by %(share)s €.") % {
+                'creator': bill.creator, 'title': bill.title, 'amount': bill.amount, 'share': share,
+            }
+            messages.append((bill.title, body, None, [user.user.email]))
+    send_mass_mail(messages)
+
+
+def notify_involved(bill):
+    """
+    Queues the notification of the people involved in ``bill``, when ``EXPENSES_NOTIFY_BY_EMAIL`` is set.
+    """
+    if getattr(settings, 'EXPENSES_NOTIFY_BY_EMAIL', False):
+        Task.objects.enqueue('notify_bill', {bill.pk: {'bill': bill.pk}})
+
+
+def claim(limit):
+    """
+    Locks and returns up to ``limit`` due tasks, which other workers will skip.
+    """
+    with transaction.atomic():
+        due = Task.objects.due().order_by('run_after', 'pk')
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        tasks = list(due[:limit])
+        locked_until = timezone.now() + LOCK_DURATION
+        Task.objects.filter(pk__in=[task.pk for task in tasks]).update(locked_until=locked_until)
+    return tasks
+
+
+def run(task):
+    """
+    Runs ``task``: deletes it on success, schedules a retry or marks it as failed otherwise.
+    Returns whether it succeeded.
+    """
+    try:
+        with transaction.atomic():
+            JOBS[task.name](**json.loads(task.payload))
+            Task.objects.filter(pk=task.pk).delete()
+        return True
+    except Exception:
+        task.attempts += 1
+        task.last_error = traceback.format_exc()
+        task.locked_until = None
+        if task.attempts >= getattr(settings, 'EXPENSES_TASK_MAX_ATTEMPTS', 5):
+            task.failed = True
+        elif Task.objects.waiting().filter(key=task.key).exists():
+            # The same job was queued again meanwhile, it will do the work
+            task.delete()
+            return False
+        else:
+            task.run_after = timezone.now() + RETRY_DELAY * 2 ** (task.attempts - 1)
+        task.save()
+        return False
+
+
+def work(limit=100):
+    """
+    Runs a batch of up to ``limit`` due tasks. Returns the number of tasks run.
+    """
+    tasks = claim(limit)
+    for task in tasks:
+        run(task)
+    return len(tasks)
+
+
+def drain(limit=100):
+    """
+    Runs the due tasks until there is none left, e.g. in tests. Returns the number of tasks run.
+    """
+    total = 0
+    while True:
+        count = work(limit)
+        if not count:
+            return total
+        total += count
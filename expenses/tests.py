@@ -1,8 +1,53 @@
-from django.test import TestCase, Client
-from expenses.models import ExtendedUser
+from django.db import IntegrityError, connection, transaction
+from django.db.models import ProtectedError
+from django.test import SimpleTestCase, TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from expenses import analytics, caching, debts, explain, exporting, instrumentation, participants, ranking, splitting, tasks, wizard_storage
+from expenses.benchmarks import data as benchmark_data, suite as benchmark_suite
+from expenses.constraints import EXPRESSION_INDEXES, PARTIAL_INDEXES, create_constraints, missing
+from expenses.models import Atom, BalanceSnapshot, BalanceSnapshotQuerySet, Bill, Category, CategorySpending, ExpenseGroup, ExtendedUser, Membership, Task
+from expenses.pagination import keyset_page
+from expenses.settlement import create_refunds, current_balances, settle
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import datetime
+import decimal
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+
+class TestCase(TestCase):
+    """
+    Starts each test with an empty cache: the cached pages would outlive the rolled back test data.
+    """
+    def _pre_setup(self):
+        super()._pre_setup()
+        cache.clear()
+
+
+def join_group(users, name='flat'):
+    """
+    Returns a new ```ExpenseGroup``` whose members are ``users``.
+    """
+    group = ExpenseGroup.objects.create(name=name)
+    Membership.objects.bulk_create([Membership(group=group, user=user) for user in users])
+    return group
 
 
 class OneUserTestCase(TestCase):
@@ -36,3 +81,1117 @@ class OneUserTestCase(TestCase):
         password = self.user_password
         response = client.post(reverse('login'), {'username': username, 'password': password})
         self.assertEqual(response.status_code, 302)
+
+
+class BalanceLedgerTestCase(TestCase):
+    def setUp(self):
+        self.alice = ExtendedUser.objects.create(user=User.objects.create(username='alice'))
+        self.bob = ExtendedUser.objects.create(user=User.objects.create(username='bob'))
+        self.bill = Bill.objects.create(creator=self.alice, amount=Decimal('10.00'), title='Groceries')
+
+    def assertBalances(self, alice, bob):
+        self.assertEqual(ExtendedUser.objects.get(pk=self.alice.pk).balance, Decimal(alice))
+        self.assertEqual(ExtendedUser.objects.get(pk=self.bob.pk).balance, Decimal(bob))
+
+    def test_atom_writes_update_balances(self):
+        Atom.objects.create(user=self.alice, amount=Decimal('10.00'), child_of_bill=self.bill)
+        atom = Atom.objects.create(user=self.bob, amount=Decimal('-10.00'), child_of_bill=self.bill)
+        self.assertBalances('10.00', '-10.00')
+        atom.user = self.alice
+        atom.save()
+        self.assertBalances('0.00', '0.00')
+        atom.delete()
+        self.assertBalances('10.00', '0.00')
+
+    def test_bulk_writes_update_balances(self):
+        Atom.objects.bulk_create([
+            Atom(user=self.alice, amount=Decimal('10.00'), child_of_bill=self.bill),
+            Atom(user=self.bob, amount=Decimal('-10.00'), child_of_bill=self.bill),
+        ])
+        self.assertBalances('10.00', '-10.00')
+        self.bill.delete()
+        self.assertBalances('0.00', '0.00')
+
+    def test_rebuild_balances(self):
+        Atom.objects.create(user=self.alice, amount=Decimal('10.00'), child_of_bill=self.bill)
+        ExtendedUser.objects.filter(pk=self.alice.pk).update(ledger_balance=Decimal('3.00'))
+        drifts = ExtendedUser.rebuild_balances()
+        self.assertEqual([(user.pk, stored, computed) for user, stored, computed in drifts],
+                         [(self.alice.pk, Decimal('3.00'), Decimal('10.00'))])
+        self.assertBalances('10.00', '0.00')
+        self.assertEqual(ExtendedUser.rebuild_balances(), [])
+
+
+class RankingTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob', 'carol')]
+        self.group = join_group(self.users)
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal('4.00'), title='Bill', group=self.group)
+        bill.create_atoms(self.users[0], self.users[1:])
+
+    def test_identity(self):
+        alice, bob, carol = self.users
+        self.assertNotEqual(bob, carol)
+        self.assertEqual(bob, ExtendedUser.objects.get(pk=bob.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(len({alice, bob, carol, ExtendedUser(pk=alice.pk)}), 3)
+
+    def test_leaderboard(self):
+        alice, bob, carol = self.users
+        board = ranking.leaderboard(self.group)
+        with self.assertNumQueries(1):  # versions
+            self.assertEqual([row.nickname for row in board], ['alice', 'bob', 'carol'])
+            self.assertEqual((board.rank(alice), board.rank(bob), board.rank(carol.pk)), (1, 2, 2))
+            self.assertEqual(board.compare(alice, bob), 1)
+            self.assertEqual(board.compare(bob, carol), 0)
+            self.assertEqual([row.pk for row in board.debtors()], [carol.pk, bob.pk])
+            ranking.leaderboard(self.group)
+
+
+class BalancesViewTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name))
+                      for name in ('alice', 'bob', 'carol')]
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal('9.00'), title='Pizza', group=join_group(self.users))
+        Atom.objects.bulk_create([
+            Atom(user=self.users[1], amount=Decimal('9.00'), child_of_bill=bill),
+            Atom(user=self.users[2], amount=Decimal('-9.00'), child_of_bill=bill),
+        ])
+        self.client.force_login(self.users[0].user)
+
+    def test_balance_rows(self):
+        rows = ExtendedUser.objects.balance_rows()
+        self.assertEqual([(row.nickname, row.balance) for row in rows],
+                         [('bob', Decimal('9.00')), ('alice', Decimal('0.00')), ('carol', Decimal('-9.00'))])
+        self.assertEqual(ExtendedUser.objects.balance_rows(from_atoms=True), rows)
+
+    def test_balances_json(self):
+        with self.assertNumQueries(5):  # session, user, group, versions, balances
+            response = self.client.get(reverse('balances_json'))
+        self.assertEqual(response.json()['balances'][0], {'id': self.users[1].pk, 'nickname': 'bob', 'balance': '9.00'})
+
+
+class ListingQueriesTestCase(TestCase):
+    """
+    The listing views must run a fixed number of queries, whatever the number of bills.
+    """
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username='user%d' % i))
+                      for i in range(4)]
+        self.group = join_group(self.users)
+        self.client.force_login(self.users[0].user)
+
+    def create_bills(self, number):
+        for i in range(number):
+            bill = Bill.objects.create(creator=self.users[i % 4], amount=Decimal('3.00'), title='Bill %d' % i, group=self.group)
+            Atom.objects.bulk_create([Atom(user=self.users[(i + 1) % 4], amount=Decimal('3.00'), child_of_bill=bill)] +
+                                     [Atom(user=user, amount=Decimal('-1.00'), child_of_bill=bill) for user in self.users[1:]])
+
+    def assertConstantQueries(self, url, num):
+        self.create_bills(2)
+        with self.assertNumQueries(num):
+            self.client.get(url)
+        self.create_bills(20)
+        with self.assertNumQueries(num):
+            self.client.get(url)
+
+    def test_home(self):
+        self.assertConstantQueries(reverse('home'), 7)  # session, user, group, versions, membership, bills, extended user
+
+    def test_history(self):
+        self.assertConstantQueries(reverse('history_page'), 5)  # session, user, group, versions, bills
+
+    def test_history_offset(self):
+        self.assertConstantQueries(reverse('history', args=[0]), 4)  # session, user, group, bills
+
+    def test_whats_new(self):
+        self.assertConstantQueries('/whatsnew', 6)  # session, user, extended user, group, versions, bills
+
+    def test_account_history(self):
+        self.assertConstantQueries(reverse('account_history'), 5)  # session, user, extended user, atoms x2
+
+    def test_display_bill(self):
+        self.create_bills(1)
+        url = reverse('display_bill', args=[Bill.objects.get().pk])
+        with self.assertNumQueries(4):  # session, user, group, bill
+            self.client.get(url)
+
+
+class BillSummaryTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob', 'carol')]
+        self.bill = Bill.objects.create(creator=self.users[0], amount=Decimal('10.00'), title='Cinema')
+        self.bill.create_atoms(self.users[0], self.users[1:])
+
+    def test_summary(self):
+        bill = Bill.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual((bill.participant_count, bill.positive_total, bill.negative_total), (2, Decimal('10.00'), Decimal('-10.00')))
+            self.assertEqual(bill.buyer_nicknames(), 'alice')
+            self.assertEqual(bill.participant_nicknames(), 'bob, carol')
+            self.assertEqual(bill.involved_ids(), {user.pk for user in self.users})
+        self.bill.title = 'Theatre'
+        self.bill.save()  # A stale instance doesn't overwrite the summary
+        self.assertEqual(Bill.objects.get().participant_count, 2)
+        self.bill.atoms.filter(user=self.users[2]).delete()
+        self.assertEqual(Bill.objects.get().participant_nicknames(), 'bob')
+
+    def test_one_update_for_many_bills(self):
+        for title in ('Bus', 'Train'):
+            bill = Bill.objects.create(creator=self.users[1], amount=Decimal('3.00'), title=title)
+            bill.create_atoms(self.users[1], self.users)
+        Bill.objects.update(participants_summary='[]')
+        with self.assertNumQueries(3):  # bills, atoms, update
+            self.assertEqual(Bill.objects.all().refresh_summaries(), 3)
+        self.assertEqual([bill.participant_nicknames() for bill in Bill.objects.order_by('pk')],
+                         ['bob, carol', 'alice, bob, carol', 'alice, bob, carol'])
+
+    def test_nickname_and_rebuild(self):
+        bob = ExtendedUser.objects.get(pk=self.users[1].pk)
+        bob.nickname = 'bobby'
+        bob.save()
+        self.assertEqual(Bill.objects.get().participant_nicknames(), 'bob, carol')
+        self.assertTrue(Task.objects.filter(name='refresh_user_summaries').exists())
+        tasks.drain()
+        self.assertEqual(Bill.objects.get().participant_nicknames(), 'bobby, carol')
+        Bill.objects.update(participant_count=0, participants_summary='[]')
+        call_command('rebuild_bill_summaries', stdout=StringIO())
+        bill = Bill.objects.get()
+        self.assertEqual((bill.participant_count, bill.participant_nicknames()), (2, 'bobby, carol'))
+
+
+class HistoryPaginationTestCase(TestCase):
+    def setUp(self):
+        creator = ExtendedUser.objects.create(user=User.objects.create(username='alice'))
+        group = join_group([creator])
+        self.bills = [Bill.objects.create(creator=creator, amount=Decimal('1.00'), title='Bill %d' % i, group=group)
+                      for i in range(25)][::-1]
+        self.client.force_login(creator.user)
+
+    def test_keyset_pages(self):
+        first = keyset_page(Bill.objects.all(), 10)
+        self.assertEqual(first.items, self.bills[:10])
+        self.assertIsNone(first.previous_cursor)
+        second = keyset_page(Bill.objects.all(), 10, before=first.next_cursor)
+        self.assertEqual(second.items, self.bills[10:20])
+        Bill.objects.create(creator=self.bills[0].creator, amount=Decimal('1.00'), title='New bill')
+        third = keyset_page(Bill.objects.all(), 10, before=second.next_cursor)
+        self.assertEqual(third.items, self.bills[20:])
+        self.assertIsNone(third.next_cursor)
+        self.assertEqual(keyset_page(Bill.objects.all(), 10, after=third.previous_cursor).items, self.bills[10:20])
+
+    def test_history_views(self):
+        response = self.client.get(reverse('history_page'), {'size': 5})
+        self.assertEqual(list(response.context['bills']), self.bills[:5])
+        response = self.client.get(reverse('history_page'), {'before': response.context['next_cursor'], 'size': 5})
+        self.assertEqual(list(response.context['bills']), self.bills[5:10])
+        response = self.client.get(reverse('history', args=[2]))
+        self.assertEqual(list(response.context['bills']), self.bills[20:])
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertEqual(self.client.get(reverse('history_page'), {'before': 'garbage'}).status_code, 404)
+
+
+class BillWriteTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name))
+                      for name in ('alice', 'bob', 'carol')]
+        self.group = join_group(self.users)
+        self.client.force_login(self.users[0].user)
+
+    def post_wizard(self, url, title, amount, buyer, split):
+        prefix = 'wizard_bill_view'
+        self.post_step(url, {
+            prefix + '-current_step': '0', '0-title': title, '0-amount': amount,
+            '0-buyer': buyer.pk, '0-participants': [user.pk for user, share in split],
+        })
+        data = {prefix + '-current_step': '1', 'form-TOTAL_FORMS': len(split), 'form-INITIAL_FORMS': 0,
+                'form-MIN_NUM_FORMS': len(split), 'form-MAX_NUM_FORMS': len(split)}
+        data.update({'form-%d-amount' % i: share for i, (user, share) in enumerate(split)})
+        self.post_step(url, data)
+        return self.post_step(url, {prefix + '-current_step': '2'})
+
+    def post_step(self, url, data):
+        response = self.client.post(url, data)
+        # The browsers drop bigger cookies
+        self.assertLess(max(len(cookie.OutputString()) for cookie in response.cookies.values()), 4096)
+        return response
+
+    def test_create_atoms(self):
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal('10.00'), title='Cinema')
+        with CaptureQueriesContext(connection) as queries:
+            bill.create_atoms(self.users[0], self.users)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT INTO "expenses_atom"')]), 1)
+        self.assertTrue(bill.check_integrity())
+        self.assertEqual(sorted(atom.amount for atom in bill.atoms.all()),
+                         [Decimal('-3.34'), Decimal('-3.33'), Decimal('-3.33'), Decimal('10.00')])
+
+    def test_create_atoms_round_trips(self):
+        users = [ExtendedUser.objects.create(user=User.objects.create(username='user%d' % i)) for i in range(41)]
+        group = ExpenseGroup.objects.create(name='trip')
+        Membership.objects.bulk_create([Membership(group=group, user=user) for user in users])
+        bill = Bill.objects.create(creator=users[0], amount=Decimal('100.00'), title='Trip', group=group)
+        # Savepoint (2), atoms, bill, balances, memberships (select and update), summary (2), tasks (select and insert),
+        # versions
+        with self.assertNumQueries(12):
+            bill.create_atoms(users[0], users[1:])
+        self.assertEqual(ExtendedUser.objects.balance_rows(), ExtendedUser.objects.balance_rows(from_atoms=True))
+        self.assertEqual(Membership.objects.get(group=group, user=users[1]).balance, Decimal('-2.50'))
+
+    def test_refund(self):
+        response = self.client.post(reverse('refund_form'), {
+            'amount': '4.50', 'buyer': self.users[1].pk, 'participant': self.users[2].pk,
+        })
+        self.assertRedirects(response, reverse('home'))
+        refund = Bill.objects.get(refund=True)
+        self.assertEqual(refund.amount, Decimal('4.50'))
+        self.assertTrue(refund.check_integrity())
+        self.assertEqual(ExtendedUser.objects.get(pk=self.users[2].pk).balance, Decimal('-4.50'))
+
+    def test_wizard_create_and_edit(self):
+        response = self.post_wizard(reverse('wizard_bill_form'), 'Dinner', '30.00', self.users[0],
+                                    [(self.users[1], '10.00'), (self.users[2], '20.00')])
+        self.assertRedirects(response, reverse('home'))
+        bill = Bill.objects.get()
+        self.assertTrue(bill.check_integrity())
+        self.post_wizard(reverse('wizard_bill_form_edit', args=[bill.pk]), 'Dinner', '30.00', self.users[1],
+                         [(self.users[0], '15.00'), (self.users[2], '15.00')])
+        bill = Bill.objects.get()
+        self.assertTrue(bill.check_integrity())
+        self.assertEqual([user.pk for user in bill.list_of_buyers()], [self.users[1].pk])
+        self.assertEqual(ExtendedUser.objects.balance_rows(), ExtendedUser.objects.balance_rows(from_atoms=True))
+
+    def test_wizard_edit_writes_the_difference(self):
+        self.post_wizard(reverse('wizard_bill_form'), 'Dinner', '30.00', self.users[0],
+                         [(self.users[1], '10.00'), (self.users[2], '20.00')])
+        bill = Bill.objects.get()
+        atoms = {atom.pk: atom.date for atom in bill.atoms.all()}
+        url = reverse('wizard_bill_form_edit', args=[bill.pk])
+        with CaptureQueriesContext(connection) as queries:
+            self.post_wizard(url, 'Late dinner', '30.00', self.users[0], [(self.users[1], '10.00'), (self.users[2], '20.00')])
+        self.assertEqual(Bill.objects.get().title, 'Late dinner')
+        self.assertEqual({atom.pk: atom.date for atom in bill.atoms.all()}, atoms)
+        self.assertFalse([query for query in queries if 'expenses_atom"' in query['sql'].split(' WHERE')[0]
+                          and not query['sql'].startswith('SELECT')])
+
+        self.post_wizard(url, 'Late dinner', '30.00', self.users[0], [(self.users[0], '25.00'), (self.users[1], '5.00')])
+        self.assertEqual(sorted((atom.user_id, atom.amount) for atom in bill.atoms.all()), [
+            (self.users[0].pk, Decimal('-25.00')), (self.users[0].pk, Decimal('30.00')), (self.users[1].pk, Decimal('-5.00')),
+        ])
+        self.assertIn(bill.atoms.get(user=self.users[0], amount__gt=0).pk, atoms)
+        self.assertEqual(ExtendedUser.objects.balance_rows(), ExtendedUser.objects.balance_rows(from_atoms=True))
+        self.assertEqual(Bill.objects.get().participant_nicknames(), 'bob, alice')
+
+
+    def test_wizard_refuses_negative_shares(self):
+        url, prefix = reverse('wizard_bill_form'), 'wizard_bill_view'
+        self.post_step(url, {prefix + '-current_step': '0', '0-title': 'Dinner', '0-amount': '30.00',
+                             '0-buyer': self.users[0].pk, '0-participants': [self.users[0].pk, self.users[1].pk]})
+        response = self.post_step(url, {prefix + '-current_step': '1', 'form-TOTAL_FORMS': 2, 'form-INITIAL_FORMS': 0,
+                                        'form-MIN_NUM_FORMS': 2, 'form-MAX_NUM_FORMS': 2,
+                                        'form-0-amount': '-10.00', 'form-1-amount': '40.00'})
+        self.assertContains(response, "The share can&#39;t be negative.")
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal('30.00'), title='Dinner', group=self.group)
+        with self.assertRaises(ValueError):
+            bill.sync_atoms([Atom(user=self.users[0], amount=Decimal('30.00')), Atom(user=self.users[0], amount=Decimal('10.00')),
+                             Atom(user=self.users[1], amount=Decimal('-40.00'))])
+        self.assertFalse(bill.atoms.exists())
+
+    def test_wizard_with_many_participants(self):
+        users = [ExtendedUser.objects.create(user=User.objects.create(username='user%d' % i)) for i in range(150)]
+        Membership.objects.bulk_create([Membership(group=self.group, user=user) for user in users])
+        response = self.post_wizard(reverse('wizard_bill_form'), 'Party', '300.00', self.users[0],
+                                    [(user, '2.00') for user in users])
+        self.assertRedirects(response, reverse('home'))
+        self.assertEqual(Bill.objects.get().participant_count, 150)
+
+    def test_compact_storage(self):
+        data = {'csrfmiddlewaretoken': ['x'], 'wizard_bill_view-current_step': ['1'], '0-participants': ['1', '2'],
+                '0-buyer': ['1'], 'form-0-amount': ['12.5'], 'form-1-amount': ['oops']}
+        compacted = wizard_storage.compact(data)
+        self.assertEqual(compacted, {'0-participants': ['1', '2'], '0-buyer': '1', 'form-0-amount': 1250, 'form-1-amount': 'oops'})
+        self.assertEqual(wizard_storage.expand(json.loads(json.dumps(compacted))),
+                         {'0-participants': ['1', '2'], '0-buyer': ['1'], 'form-0-amount': ['12.50'], 'form-1-amount': ['oops']})
+
+    def test_wizard_storages_leave_the_session(self):
+        for storage in ('CompactCookieStorage', 'CompactCacheStorage'):
+            with self.subTest(storage=storage), self.settings(EXPENSES_WIZARD_STORAGE='expenses.wizard_storage.' + storage):
+                with CaptureQueriesContext(connection) as queries:
+                    self.post_wizard(reverse('wizard_bill_form'), storage, '30.00', self.users[0],
+                                     [(self.users[1], '10.00'), (self.users[2], '20.00')])
+                self.assertFalse([query for query in queries if 'django_session' in query['sql'] and 'UPDATE' in query['sql']])
+                bill = Bill.objects.get(title=storage)
+                self.assertEqual(bill.participant_nicknames(), 'bob, carol')
+                self.assertEqual(bill.negative_total, Decimal('-30.00'))
+
+    def test_wizard_cache(self):
+        url, prefix = reverse('wizard_bill_form'), 'wizard_bill_view'
+        self.post_step(url, {prefix + '-current_step': '0', '0-title': 'Dinner', '0-amount': '30.00',
+                             '0-buyer': self.users[0].pk, '0-participants': [self.users[1].pk]})
+        cache.clear()  # e.g. culled by the cached pages, or another server process
+        response = self.post_step(url, {prefix + '-current_step': '1', 'form-TOTAL_FORMS': 1, 'form-INITIAL_FORMS': 0,
+                                        'form-MIN_NUM_FORMS': 1, 'form-MAX_NUM_FORMS': 1, 'form-0-amount': '30.00'})
+        self.assertEqual(response.context['wizard']['steps'].current, '2')
+        with self.settings(EXPENSES_WIZARD_CACHE='default'), self.assertRaises(ImproperlyConfigured):
+            self.client.get(url)
+
+
+class IntegrityTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob')]
+        self.bills = [Bill.objects.create(creator=self.users[0], amount=Decimal('8.00'), title='Bill %d' % i)
+                      for i in range(5)]
+        for bill in self.bills:
+            bill.create_atoms(self.users[0], self.users)
+
+    def test_check_global_integrity(self):
+        self.assertEqual(Bill.check_global_integrity(), [])
+        Bill.objects.filter(pk=self.bills[1].pk).update(amount=Decimal('9.00'))
+        Atom.objects.filter(child_of_bill=self.bills[3], amount__lt=0).update(amount=Decimal('-1.00'))
+        self.assertEqual(Bill.check_global_integrity(), [self.bills[1], self.bills[3]])
+        self.assertEqual([bill for bill in Bill.objects.all() if not bill.check_integrity()], [self.bills[1], self.bills[3]])
+
+    def test_check_integrity_command(self):
+        Bill.objects.filter(pk=self.bills[2].pk).update(amount=Decimal('9.00'))
+        out = StringIO()
+        call_command('check_integrity', '--chunk-size', '1', stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines[0]['bill'], self.bills[2].pk)
+        self.assertEqual(lines[0]['positive_sum'], '8.00')
+        self.assertEqual(lines[-1]['summary']['failures'], 1)
+        out = StringIO()
+        call_command('check_integrity', '--since', '2999-01-01', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['summary']['failures'], 0)
+
+
+class SettlementTestCase(TestCase):
+    def test_settle(self):
+        balances = {1: Decimal('-30.00'), 2: Decimal('10.00'), 3: Decimal('25.01'), 4: Decimal('-5.01')}
+        transfers = settle(balances)
+        self.assertEqual(len(transfers), 3)
+        for debtor, creditor, amount in transfers:
+            balances[debtor] += amount
+            balances[creditor] -= amount
+        self.assertEqual(set(balances.values()), {0})
+
+    def test_create_refunds(self):
+        users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob', 'carol')]
+        group = join_group(users)
+        bill = Bill.objects.create(creator=users[0], amount=Decimal('10.00'), title='Taxi', group=group)
+        bill.create_atoms(users[0], users)
+        # The balances of another group are left alone
+        other = join_group([users[1], users[2]], 'other')
+        bill = Bill.objects.create(creator=users[1], amount=Decimal('4.00'), title='Bus', group=other)
+        bill.create_atoms(users[1], [users[2]])
+        self.client.force_login(users[0].user)
+        self.client.post(reverse('settlement'))
+        self.assertEqual(set(Membership.objects.filter(group=group).values_list('balance', flat=True)), {0})
+        self.assertEqual(Bill.objects.filter(refund=True, group=group).count(), 2)
+        self.assertEqual(Membership.objects.get(group=other, user=users[2]).balance, Decimal('-4.00'))
+        self.assertEqual(Bill.check_global_integrity(), [])
+        self.assertEqual(settle(current_balances(group=group)), [])
+
+    def test_settle_a_category(self):
+        users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob')]
+        group, food = join_group(users), Category.objects.create(name='food')
+        for buyer, amount in ((users[0], '10.00'), (users[1], '4.00')):
+            bill = Bill.objects.create(creator=buyer, amount=Decimal(amount), title='Bill', group=group)
+            bill.create_atoms(buyer, users)
+        bill.category.add(food)
+        transfers = settle(current_balances(category=food, group=group))
+        self.assertEqual(transfers, [(users[0].pk, users[1].pk, Decimal('2.00'))])
+        self.assertEqual(list(create_refunds(transfers, users[0], group, food)[0].category.all()), [food])
+        self.assertEqual(settle(current_balances(category=food, group=group)), [])
+
+
+class BalanceSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob')]
+        self.today = timezone.localdate()
+        for days_ago, amount in ((10, '4.00'), (10, '2.00'), (5, '6.00'), (0, '1.00')):
+            bill = Bill.objects.create(creator=self.users[0], amount=Decimal(amount), title='Bill')
+            bill.create_atoms(self.users[0], self.users[1:])
+            bill.atoms.update(date=timezone.now() - datetime.timedelta(days=days_ago))
+
+    def test_build_and_series(self):
+        self.assertEqual(BalanceSnapshot.objects.build(), 4)
+        self.assertEqual(BalanceSnapshot.objects.build(), 0)
+        day = datetime.timedelta(days=1)
+        series = BalanceSnapshot.objects.series(self.users[0], self.today - 11 * day, self.today)
+        self.assertEqual(len(series), 12)
+        self.assertEqual([series[0][1], series[6][1], series[11][1]], [0, Decimal('12.00'), Decimal('13.00')])
+        self.assertEqual(series[1], (self.today - 10 * day, Decimal('6.00')))
+
+    def test_invalidation(self):
+        BalanceSnapshot.objects.build()
+        Atom.objects.filter(amount=Decimal('6.00')).delete()
+        self.assertFalse(BalanceSnapshot.objects.filter(user=self.users[0], day__gte=self.today - datetime.timedelta(days=5)))
+        self.assertEqual(BalanceSnapshot.objects.build(), 0)
+        Atom.objects.filter(amount=Decimal('-4.00')).delete()
+        self.assertEqual(BalanceSnapshot.objects.build(), 2)
+        self.assertEqual(list(BalanceSnapshot.objects.filter(user=self.users[1]).order_by('day').values_list('balance', flat=True)),
+                         [Decimal('-2.00'), Decimal('-8.00')])
+
+    def test_balance_history_view(self):
+        self.client.force_login(self.users[1].user)
+        response = self.client.get(reverse('balance_history_json'), {'start': str(self.today - datetime.timedelta(days=6))})
+        balances = [row['balance'] for row in response.json()['balances']]
+        self.assertEqual(balances, ['-6.00'] + ['-12.00'] * 5 + ['-13.00'])
+        BalanceSnapshot.objects.all().delete()
+        with mock.patch.object(BalanceSnapshotQuerySet, 'bulk_create', side_effect=IntegrityError):
+            response = self.client.get(reverse('balance_history_json'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_command_stops_before_today(self):
+        with self.assertRaises(CommandError):
+            call_command('build_balance_snapshots', until=str(self.today), stdout=StringIO())
+        self.assertEqual(BalanceSnapshot.objects.build(until=self.today + datetime.timedelta(days=1)), 4)
+        self.assertFalse(BalanceSnapshot.objects.filter(day__gte=self.today).exists())
+
+
+class SplittingTestCase(SimpleTestCase):
+    def test_equal_split(self):
+        self.assertEqual(splitting.equal_split(1000, 4), [250] * 4)
+        parts = splitting.equal_split(1000, 3, seed=42)
+        self.assertEqual(sorted(parts), [333, 333, 334])
+        self.assertEqual(parts, splitting.equal_split(1000, 3, seed=42))
+        self.assertEqual(list(splitting.batch_equal_split([(1000, 4), (1, 3)], seed=1))[0], [250] * 4)
+
+    def test_weighted_splits(self):
+        self.assertEqual(splitting.weighted_split(1000, [1, 1, 2]), [250, 250, 500])
+        self.assertEqual(sorted(splitting.weighted_split(100, [1, 1, 1], seed=3)), [33, 33, 34])
+        self.assertEqual(splitting.percentage_split(1000, ['12.5', '37.5', 50]), [125, 375, 500])
+        self.assertEqual(splitting.fixed_split(1000, [400, None, None]), [400, 300, 300])
+        with self.assertRaises(ValueError):
+            splitting.fixed_split(1000, [1200, None])
+
+    def test_bill_equal_split(self):
+        rounding = decimal.getcontext().rounding
+        amounts = [amount for _, amount in Bill(amount=Decimal('10.00')).equal_split('abc', seed=0)]
+        self.assertEqual(sorted(amounts), [Decimal('-3.34'), Decimal('-3.33'), Decimal('-3.33')])
+        self.assertEqual(decimal.getcontext().rounding, rounding)
+
+
+class ImportBillsTestCase(TestCase):
+    records = (
+        'title,amount,date,buyer,participants,categories\n'
+        'Rent,900.00,2015-03-01T10:00:00,alice,alice;bob;carol_nick,home\n'
+        'Train,30.00,2015-03-02T08:00:00,bob,alice:20.00;carol:10.00,trip;home\n'
+        'Broken,10.00,2015-03-03T08:00:00,bob,nobody,\n'
+        'Snack,3.00,2015-03-04T08:00:00,carol,bob,\n'
+    )
+
+    def setUp(self):
+        for name in ('alice', 'bob', 'carol'):
+            ExtendedUser.objects.create(user=User.objects.create(username=name), nickname=name + '_nick')
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'bills.csv')
+        self.checkpoint = os.path.join(self.directory, 'checkpoint')
+        with open(self.path, 'w') as csv_file:
+            csv_file.write(self.records)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def import_bills(self):
+        call_command('import_bills', self.path, '--batch-size', '1', '--checkpoint', self.checkpoint, stdout=StringIO())
+
+    def test_import_and_resume(self):
+        with self.assertRaisesRegex(CommandError, 'Record 3: unknown user'):
+            self.import_bills()
+        self.assertEqual(Bill.objects.count(), 2)
+        self.assertEqual(Bill.objects.get(title='Rent').date.year, 2015)
+        self.assertEqual(set(Bill.objects.get(title='Train').category.values_list('name', flat=True)), {'trip', 'home'})
+        self.assertEqual(Bill.check_global_integrity(), [])
+
+        with open(self.path, 'w') as csv_file:
+            csv_file.write(self.records.replace('nobody', 'alice'))
+        self.import_bills()
+        self.assertEqual(Bill.objects.count(), 4)
+        self.assertEqual(ExtendedUser.rebuild_balances(dry_run=True), [])
+        self.assertEqual(ExtendedUser.objects.get(nickname='carol_nick').balance, Decimal('-307.00'))
+        # Only the bills are backdated: the atoms are seen by the incremental checks and exports
+        self.assertEqual(Bill.objects.touched_since(timezone.now() - datetime.timedelta(minutes=1)).count(), 4)
+
+    def test_amount_out_of_range(self):
+        with open(self.path, 'w') as csv_file:
+            csv_file.write('title,amount,buyer,participants\nCar,12000.00,alice,bob\nTrain,30.00,bob,alice:10000.00;carol:-9970.00\n')
+        with self.assertRaisesRegex(CommandError, 'Record 1: amount 12000.00 over 9999.99'):
+            self.import_bills()
+        with open(self.path, 'w') as csv_file:
+            csv_file.write('title,amount,buyer,participants\nTrain,30.00,bob,alice:10000.00;carol:-9970.00\n')
+        with self.assertRaisesRegex(CommandError, 'Record 1: participant amount over 9999.99'):
+            self.import_bills()
+        self.assertFalse(Bill.objects.exists())
+
+    def test_dates(self):
+        for date, error in (('2020-13-45T00:00', 'Record 1: Invalid date'),
+                            ('2015-10-25T02:30:00', 'Record 1: Ambiguous or non-existent time in Europe/Paris')):
+            with open(self.path, 'w') as csv_file:
+                csv_file.write('title,amount,date,buyer,participants\nTrain,30.00,%s,bob,alice\n' % date)
+            with self.assertRaisesRegex(CommandError, error), self.settings(TIME_ZONE='Europe/Paris'):
+                self.import_bills()
+        with open(self.path, 'w') as csv_file:
+            csv_file.write('title,amount,date,buyer,participants\nTrain,30.00,2015-03-05,bob,alice\n')
+        self.import_bills()
+        self.assertEqual(timezone.localtime(Bill.objects.get().date).date(), datetime.date(2015, 3, 5))
+
+    def test_group(self):
+        users = list(ExtendedUser.objects.order_by('pk'))
+        group = join_group(users[:2])
+        with self.assertRaisesRegex(CommandError, 'Record 1: not members of flat: carol'):
+            call_command('import_bills', self.path, '--group', 'flat', stdout=StringIO())
+        with open(self.path, 'w') as csv_file:
+            csv_file.write('title,amount,buyer,participants\nTrain,30.00,bob,alice;bob\n')
+        call_command('import_bills', self.path, '--group', 'flat', stdout=StringIO())
+        self.assertEqual(Bill.objects.get().group, group)
+        self.assertEqual(group.memberships.get(user=users[0]).balance, Decimal('-15.00'))
+        with self.assertRaisesRegex(CommandError, 'Unknown group: trip'):
+            call_command('import_bills', self.path, '--group', 'trip', stdout=StringIO())
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name, is_staff=True))
+                      for name in ('alice', 'bob')]
+        for i in range(3):
+            bill = Bill.objects.create(creator=self.users[0], amount=Decimal('5.00'), title='Bill %d' % i)
+            bill.create_atoms(self.users[0], self.users)
+        bill.category.add(Category.objects.create(name='food'), Category.objects.create(name='bar'))
+
+    def test_chunks(self):
+        chunks = list(exporting.iter_chunks(exporting.atoms_to_export(), chunk_size=4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 1])
+        row = dict(zip(exporting.COLUMNS, chunks[-1][-1]))
+        self.assertEqual((row['bill_title'], row['categories'], row['role']), ('Bill 2', 'bar;food', 'buyer'))
+        columns = [json.loads(line) for line in exporting.write_chunks(chunks, 'columns')]
+        self.assertEqual(columns[1]['amount'], ['-2.50', '-2.50', '5.00', '-2.50'])
+
+    def test_streaming_view(self):
+        self.client.force_login(self.users[0].user)
+        response = self.client.get(reverse('export_atoms', args=['csv']))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(','), list(exporting.COLUMNS))
+        self.assertEqual(len(lines), 10)
+        response = self.client.get(reverse('export_atoms', args=['jsonl']), {'since': '2999-01-01T00:00:00'})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_incremental_export(self):
+        state = os.path.join(tempfile.mkdtemp(), 'state')
+        self.addCleanup(shutil.rmtree, os.path.dirname(state))
+        output = StringIO()
+        call_command('export_atoms', '--format', 'jsonl', '--since-last', state, stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 9)
+        bill = Bill.objects.order_by('pk').first()
+        deleted = set(bill.atoms.values_list('pk', flat=True))
+        bill.delete()
+        Atom.objects.filter(amount__lt=0, user=self.users[1]).order_by('pk').first().delete()
+        output = StringIO()
+        call_command('export_atoms', '--format', 'jsonl', '--since-last', state, stdout=output)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual({row['role'] for row in rows}, {'deleted'})
+        self.assertLess(deleted, {row['atom_id'] for row in rows})
+        self.assertEqual(len(rows), 4)
+
+        first, second = Bill.objects.order_by('pk')
+        first.title = 'Renamed'
+        first.save()
+        second.category.clear()
+        self.users[1].nickname = 'bobby'
+        self.users[1].save()
+        output = StringIO()
+        call_command('export_atoms', '--format', 'jsonl', '--since-last', state, stdout=output)
+        rows = {row['atom_id']: row for row in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(set(rows), set(Atom.objects.values_list('pk', flat=True)))
+        self.assertEqual({row['bill_title'] for row in rows.values()}, {'Renamed', 'Bill 2'})
+        self.assertEqual({row['categories'] for row in rows.values()}, {''})
+        self.assertIn('bobby', {row['nickname'] for row in rows.values()})
+
+
+class DebtsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name))
+                      for name in ('alice', 'bob', 'carol')]
+        self.group = join_group(self.users)
+
+    def create_bill(self, amount, buyer, participants, group=None):
+        bill = Bill.objects.create(creator=buyer, amount=Decimal(amount), title='Bill', group=group or self.group)
+        bill.create_atoms(buyer, participants)
+        return bill
+
+    def test_pairwise_debts(self):
+        alice, bob, carol = self.users
+        self.create_bill('30.00', alice, self.users)
+        self.create_bill('4.00', bob, [alice])
+        self.assertEqual(debts.pairwise_debts(self.group), {
+            (bob.pk, alice.pk): Decimal('6.00'),
+            (carol.pk, alice.pk): Decimal('10.00'),
+        })
+        with self.assertNumQueries(1):  # versions
+            debts.pairwise_debts(self.group)
+        bill = self.create_bill('12.00', carol, [bob])
+        self.assertEqual(debts.debts_of(bob.pk, self.group), ([(carol.pk, Decimal('12.00')), (alice.pk, Decimal('6.00'))], []))
+        bill.delete()
+        self.assertEqual(debts.debts_of(carol.pk, self.group), ([(alice.pk, Decimal('10.00'))], []))
+
+    def test_debts_view(self):
+        self.create_bill('30.00', self.users[0], self.users)
+        self.create_bill('8.00', self.users[0], self.users[1:], join_group(self.users, 'trip'))
+        self.client.force_login(self.users[0].user)
+        response = self.client.get(reverse('debts'))
+        self.assertEqual(response.context['owed'], [('bob', Decimal('10.00')), ('carol', Decimal('10.00'))])
+
+
+class SpendingTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob')]
+        self.groceries = Category.objects.create(name='groceries')
+        self.group = join_group(self.users)
+        self.bills = []
+        for month, amount in ((1, '10.00'), (1, '4.00'), (2, '6.00')):
+            bill = Bill.objects.create(creator=self.users[0], amount=Decimal(amount), title='Shop', group=self.group,
+                                       date=timezone.make_aware(datetime.datetime(2016, month, 15, 12)))
+            bill.category.add(self.groceries)
+            bill.create_atoms(self.users[0], self.users)
+            self.bills.append(bill)
+        tasks.drain()
+
+    def test_rollups(self):
+        report = analytics.spending('category', 'month', datetime.date(2016, 1, 1), datetime.date(2016, 12, 31), group=self.group)
+        self.assertEqual(list(report.items()), [
+            (datetime.date(2016, 1, 1), {self.groceries.pk: Decimal('14.00')}),
+            (datetime.date(2016, 2, 1), {self.groceries.pk: Decimal('6.00')}),
+        ])
+        self.bills[1].category.clear()
+        self.bills[0].delete()
+        tasks.drain()
+        report = analytics.spending('user', 'week', group=self.group)
+        self.assertEqual(report[datetime.date(2016, 1, 11)], {self.users[0].pk: Decimal('2.00'), self.users[1].pk: Decimal('2.00')})
+        self.assertEqual(analytics.check('user'), [])
+        self.assertEqual(analytics.check('category'), [])
+
+    def test_rebuild(self):
+        CategorySpending.objects.update(amount=0)
+        self.assertEqual(len(analytics.check('category')), 2)
+        call_command('rebuild_spending', stdout=StringIO())
+        self.assertEqual(analytics.check('category'), [])
+
+    def test_analytics_json(self):
+        # The spending of another group stays out of the report
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal('50.00'), title='Hotel',
+                                   group=join_group(self.users, 'trip'), date=self.bills[0].date)
+        bill.category.add(self.groceries)
+        bill.create_atoms(self.users[0], self.users)
+        tasks.drain()
+        self.client.force_login(self.users[0].user)
+        response = self.client.get(reverse('analytics_json'), {'start': '2016-01-01', 'end': '2016-12-31', 'category': 'groceries'})
+        self.assertEqual(response.json()['spending'][0], {'period': '2016-01-01', 'totals': {'groceries': '14.00'}})
+
+
+class TaskTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name, email='%s@null.null' % name))
+                      for name in ('alice', 'bob')]
+        self.groceries = Category.objects.create(name='groceries')
+        join_group(self.users)
+
+    def create_bill(self, amount, day=15):
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal(amount), title='Shop',
+                                   date=timezone.make_aware(datetime.datetime(2016, 1, day, 12)))
+        bill.category.add(self.groceries)
+        bill.create_atoms(self.users[0], self.users)
+        return bill
+
+    def test_coalescing(self):
+        self.create_bill('10.00')
+        self.create_bill('4.00')
+        self.create_bill('6.00', day=16)
+        self.assertEqual(sorted(Task.objects.filter(name='refresh_spending').values_list('key', flat=True)),
+                         ['refresh_spending:2016-01-15', 'refresh_spending:2016-01-16'])
+        self.assertFalse(CategorySpending.objects.exists())
+        self.assertEqual(tasks.drain(), 2)
+        self.assertFalse(Task.objects.exists())
+        self.assertEqual(analytics.check('category'), [])
+        self.assertEqual(analytics.check('user'), [])
+
+    def test_retry_and_failure(self):
+        Task.objects.enqueue('unknown_job', {'a': {}})
+        self.assertEqual(tasks.drain(), 1)
+        task = Task.objects.get()
+        self.assertEqual((task.attempts, task.failed), (1, False))
+        self.assertGreater(task.run_after, timezone.now())
+        with override_settings(EXPENSES_TASK_MAX_ATTEMPTS=2):
+            Task.objects.update(run_after=timezone.now())
+            tasks.drain()
+        task = Task.objects.get()
+        self.assertEqual((task.attempts, task.failed), (2, True))
+        self.assertIn('KeyError', task.last_error)
+        self.assertEqual(tasks.drain(), 0)
+
+    @override_settings(EXPENSES_NOTIFY_BY_EMAIL=True)
+    def test_notification(self):
+        self.client.force_login(self.users[0].user)
+        self.client.post(reverse('api_bills'), {
+            'title': 'Taxi', 'amount': '9.00', 'buyer': self.users[0].pk, 'participants': [user.pk for user in self.users],
+        })
+        self.assertEqual(len(mail.outbox), 0)
+        tasks.drain()
+        self.assertEqual([message.to for message in mail.outbox], [['bob@null.null']])
+        self.assertIn('-4.50', mail.outbox[0].body)
+
+
+class GroupTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob', 'carol')]
+        self.flat, self.trip = ExpenseGroup.objects.create(name='flat'), ExpenseGroup.objects.create(name='trip')
+        for user in self.users[:2]:
+            Membership.objects.create(group=self.flat, user=user)
+        for user in self.users[::2]:
+            Membership.objects.create(group=self.trip, user=user)
+        self.client.force_login(self.users[0].user)
+
+    def create_bill(self, group, amount, participants):
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal(amount), title='Bill', group=group)
+        bill.create_atoms(self.users[0], participants)
+        return bill
+
+    def test_group_balances(self):
+        self.create_bill(self.flat, '10.00', self.users[:2])
+        self.create_bill(self.trip, '30.00', self.users[::2])
+        self.assertEqual(dict(self.flat.memberships.values_list('user__nickname', 'balance')),
+                         {'alice': Decimal('5.00'), 'bob': Decimal('-5.00')})
+        self.assertEqual(current_balances(group=self.trip), {self.users[0].pk: Decimal('15.00'), self.users[2].pk: Decimal('-15.00')})
+        self.assertEqual(ExtendedUser.objects.get(pk=self.users[0].pk).ledger_balance, Decimal('20.00'))
+
+    def test_scoped_pages(self):
+        flat_bill, trip_bill = self.create_bill(self.flat, '10.00', self.users[:2]), self.create_bill(self.trip, '30.00', self.users[::2])
+        response = self.client.get(reverse('home'))
+        self.assertEqual(list(response.context['last_bills']), [flat_bill])
+        self.assertEqual(response.context['balance'], Decimal('5.00'))
+        self.assertEqual(self.client.get(reverse('display_bill', args=[trip_bill.pk])).status_code, 404)
+
+        self.client.post(reverse('groups'), {'group': self.trip.pk})
+        self.assertEqual(list(self.client.get(reverse('history_page')).context['bills']), [trip_bill])
+        rows = self.client.get(reverse('balances')).context['rows']
+        self.assertEqual([row.nickname for row in rows], ['alice', 'carol'])
+        participants = self.client.get(reverse('refund_form')).context['form'].fields['participant'].queryset
+        self.assertEqual({user.pk for user in participants}, {self.users[0].pk, self.users[2].pk})
+
+    def test_foreign_group(self):
+        group = ExpenseGroup.objects.create(name='other')
+        self.assertEqual(self.client.post(reverse('groups'), {'group': group.pk}).status_code, 400)
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.create_bill(self.flat, '10.00', self.users)
+        self.assertFalse(Membership.objects.filter(group=self.flat, user=self.users[2]).exists())
+
+    def test_members_with_bills_stay(self):
+        bill = self.create_bill(self.flat, '10.00', self.users[:2])
+        bob = Membership.objects.get(group=self.flat, user=self.users[1])
+        with self.assertRaises(ProtectedError):
+            bob.delete()
+        with self.assertRaises(ProtectedError):
+            self.flat.memberships.all().delete()
+        User.objects.filter(pk=self.users[0].user_id).update(is_staff=True, is_superuser=True)
+        memberships = list(self.flat.memberships.order_by('pk'))
+        data = {'name': 'flat', 'memberships-TOTAL_FORMS': 2, 'memberships-INITIAL_FORMS': 2}
+        for i, membership in enumerate(memberships):
+            data.update({'memberships-%d-id' % i: membership.pk, 'memberships-%d-group' % i: self.flat.pk,
+                         'memberships-%d-user' % i: membership.user_id})
+        data['memberships-1-DELETE'] = 'on'
+        response = self.client.post(reverse('admin:expenses_expensegroup_change', args=[self.flat.pk]), data)
+        self.assertContains(response, 'These members have bills in the group: bob')
+        Membership.objects.get(group=self.trip, user=self.users[2]).delete()
+        bill.delete()
+        bob.delete()
+        self.assertEqual(list(self.flat.memberships.values_list('user__nickname', 'balance')), [('alice', Decimal('0.00'))])
+
+    def test_without_group(self):
+        self.create_bill(self.flat, '10.00', self.users[:2])
+        outsider = ExtendedUser.objects.create(user=User.objects.create(username='dave'))
+        self.client.force_login(outsider.user)
+        for name in ('home', 'balances', 'settlement', 'debts', 'analytics', 'refund_form'):
+            self.assertRedirects(self.client.get(reverse(name)), reverse('groups'))
+        self.assertRedirects(self.client.post(reverse('settlement')), reverse('groups'))
+        self.assertEqual(self.client.get(reverse('api_participants'), {'q': 'a'}).status_code, 403)
+        self.assertFalse(Bill.objects.filter(refund=True).exists())
+
+    def test_assign_group(self):
+        self.create_bill(self.flat, '10.00', self.users[:2])
+        legacy = self.create_bill(None, '9.00', self.users)
+        outsider = ExtendedUser.objects.create(user=User.objects.create(username='dave'))
+        call_command('assign_group', 'flat', stdout=StringIO())
+        self.assertEqual(Bill.objects.get(pk=legacy.pk).group, self.flat)
+        self.assertEqual(dict(self.flat.memberships.values_list('user__nickname', 'balance')), {
+            'alice': Decimal('11.00'), 'bob': Decimal('-8.00'), 'carol': Decimal('-3.00'), 'dave': Decimal('0.00'),
+        })
+        self.assertEqual(list(outsider.expense_groups.all()), [self.flat])
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    The main views must keep reading the atoms and bills through indexes on a large dataset.
+    """
+    LARGE_TABLES = {Atom._meta.db_table, Bill._meta.db_table}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [ExtendedUser.objects.create(user=User.objects.create(username='user%d' % i)) for i in range(20)]
+        group = join_group(cls.users)
+        bills = [Bill(creator=cls.users[i % 20], amount=Decimal('4.00'), title='Bill %d' % i, group=group) for i in range(2000)]
+        for bill in bills:
+            bill.save()
+        Atom.objects.bulk_create([atom for i, bill in enumerate(bills) for atom in
+                                  [Atom(user=cls.users[i % 20], amount=Decimal('4.00'), child_of_bill=bill)] +
+                                  [Atom(user=cls.users[(i + j) % 20], amount=Decimal('-1.00'), child_of_bill=bill)
+                                   for j in range(1, 5)]])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertNoSequentialScan(self, url):
+        self.client.force_login(self.users[0].user)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for query in context.captured_queries:
+            if query['sql'].startswith('SELECT'):
+                self.assertFalse(explain.sequential_scans(query['sql']) & self.LARGE_TABLES, query['sql'])
+
+    def test_views(self):
+        bill = Bill.objects.order_by('pk')[1000]
+        for url in (reverse('home'), reverse('history_page'), reverse('history', args=[3]), '/whatsnew',
+                    reverse('account_history'), reverse('display_bill', args=[bill.pk])):
+            self.assertNoSequentialScan(url)
+
+    def test_constraints(self):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+                self.assertLessEqual({index[0] for index in PARTIAL_INDEXES + EXPRESSION_INDEXES}, {row[0] for row in cursor.fetchall()})
+        bill = Bill.objects.order_by('pk').first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Atom.objects.bulk_create([Atom(user=self.users[0], amount=Decimal('1.00'), child_of_bill=bill)])
+
+    def test_constraints_on_existing_data(self):
+        bill = Bill.objects.order_by('pk').first()
+        with connection.cursor() as cursor:
+            for index in PARTIAL_INDEXES + EXPRESSION_INDEXES:
+                cursor.execute('DROP INDEX IF EXISTS %s' % connection.ops.quote_name(index[0]))
+        Atom.objects.bulk_create([Atom(user=self.users[0], amount=Decimal('1.00'), child_of_bill=bill),
+                                  Atom(user=self.users[1], amount=Decimal('0.00'), child_of_bill=bill)])
+        atoms = sorted(bill.atoms.values_list('user_id', 'amount'))
+        create_constraints(sender=None, using='default', verbosity=0)
+        self.assertEqual([index[0] for index in missing(connection)[0]], ['expenses_atom_credit_uniq'])
+        self.assertEqual(missing(connection)[1], [])
+        self.assertEqual(sorted(bill.atoms.values_list('user_id', 'amount')), atoms)
+        output = StringIO()
+        call_command('install_constraints', stdout=output)
+        self.assertIn('expenses_atom_credit_uniq: 1 offending row(s)', output.getvalue())
+        self.assertEqual(sorted(bill.atoms.values_list('user_id', 'amount')), atoms)
+
+        call_command('install_constraints', fix=True, stdout=output)
+        self.assertIn('Deleted 1 null atom(s) and merged 1 duplicate atom(s)', output.getvalue())
+        self.assertEqual(missing(connection)[:2], ([], []))
+        self.assertEqual(sorted(bill.atoms.values_list('user_id', 'amount')), sorted(
+            [(self.users[0].pk, Decimal('5.00'))] + [(self.users[j].pk, Decimal('-1.00')) for j in range(1, 5)]))
+        self.assertEqual(ExtendedUser.objects.balance_rows(), ExtendedUser.objects.balance_rows(from_atoms=True))
+        with self.assertNumQueries(2):  # Tables and indexes only, once everything is installed
+            create_constraints(sender=None, using='default', verbosity=0)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_generate(self):
+        users = benchmark_data.generate(6, 30, groups=2, seed=1)
+        self.assertEqual(len(users), 6)
+        self.assertEqual(Bill.objects.count(), 30)
+        self.assertEqual(Bill.check_global_integrity(), [])
+        self.assertEqual(ExtendedUser.objects.balance_rows(), ExtendedUser.objects.balance_rows(from_atoms=True))
+
+    def test_run_and_compare(self):
+        users = benchmark_data.generate(4, 10)
+        results = benchmark_suite.Benchmarks(users).run(2, only=['view_home', 'wizard_bill'])
+        self.assertEqual(list(results), ['view_home', 'wizard_bill'])
+        self.assertEqual(results['view_home']['queries'], 7)  # Computed, not read from the page cache
+        baseline = {'view_home': dict(results['view_home'], queries=results['view_home']['queries'] - 1)}
+        self.assertEqual(benchmark_suite.compare(results, baseline),
+                         [('view_home', 'queries', results['view_home']['queries'] - 1, results['view_home']['queries'])])
+        parameters, baseline = benchmark_suite.load_baseline(benchmark_suite.BASELINE)
+        self.assertEqual(parameters['bills'], 20000)
+        self.assertEqual(set(baseline), set(benchmark_suite.Benchmarks(users).names()))
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.user = ExtendedUser.objects.create(user=User.objects.create(username='alice', is_staff=True))
+        join_group([self.user])
+        self.client.force_login(self.user.user)
+        instrumentation.slow_requests.clear()
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('home'))
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="7 queries", tpl;dur=[\d.]+, total;dur=[\d.]+$')
+        entry = instrumentation.slow_requests.entries()[0]
+        self.assertEqual((entry['path'], entry['queries']), (reverse('home'), 7))  # session, user, group, versions, membership, bills, extended user
+        self.assertGreater(entry['templates'], 0)
+
+    def test_fingerprint(self):
+        self.assertEqual(instrumentation.fingerprint("SELECT * FROM t WHERE a = 'x' AND id IN (%s, %s, %s) LIMIT 21"),
+                         "SELECT * FROM t WHERE a = ? AND id IN (...) LIMIT ?")
+
+    def test_slowest_requests(self):
+        for _ in range(3):
+            self.client.get(reverse('balances'))
+        self.assertEqual(self.client.get(reverse('slow_requests')).status_code, 200)
+        durations = [entry['duration'] for entry in instrumentation.slow_requests.entries()]
+        self.assertEqual(durations, sorted(durations, reverse=True))
+        output = StringIO()
+        call_command('slow_requests', '--clear', stdout=output)
+        self.assertIn(reverse('balances'), output.getvalue())
+        self.assertEqual(instrumentation.slow_requests.entries(), [])
+
+    def test_command_in_another_process(self):
+        self.client.get(reverse('balances'))
+        manage = os.path.join(os.path.abspath(settings.BASE_DIR), 'manage.py')
+        output = subprocess.check_output([sys.executable, manage, 'slow_requests', '--json'], cwd=os.path.dirname(manage))
+        self.assertIn(reverse('balances'), [entry['path'] for entry in json.loads(output.decode())])
+
+
+class CachingTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob')]
+        self.group = join_group(self.users)
+        self.client.force_login(self.users[0].user)
+
+    def create_bill(self, title, group=None):
+        bill = Bill.objects.create(creator=self.users[0], amount=Decimal('4.00'), title=title, group=group or self.group)
+        bill.create_atoms(self.users[0], self.users)
+        return bill
+
+    def test_pages_are_cached_until_a_write(self):
+        self.create_bill('Cinema')
+        self.client.get(reverse('home'))
+        with self.assertNumQueries(5):  # session, user, group, versions, nickname in the template
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['balance'], Decimal('2.00'))
+
+        self.client.post(reverse('refund_form'), {'amount': '2.00', 'buyer': self.users[1].pk, 'participant': self.users[0].pk})
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['balance'], Decimal('0.00'))
+        self.assertEqual(len(response.context['last_bills']), 2)
+
+        self.client.get(reverse('balances'))
+        ExtendedUser.objects.filter(pk=self.users[1].pk).get().save()  # e.g. a new nickname
+        with self.assertNumQueries(5):  # session, user, group, versions, balances
+            self.client.get(reverse('balances'))
+
+    def test_versions_are_shared(self):
+        self.create_bill('Cinema')
+        self.assertEqual(self.client.get(reverse('home')).context['balance'], Decimal('2.00'))
+        # A bill written by another process with its own local-memory cache, e.g. by import_bills
+        other_cache = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'other'}
+        with override_settings(CACHES=dict(settings.CACHES, other=other_cache), EXPENSES_CACHE='other'):
+            self.create_bill('Theatre')
+        self.assertEqual(self.client.get(reverse('home')).context['balance'], Decimal('4.00'))
+
+    def test_group_versions(self):
+        flat, trip = self.group, join_group(self.users, 'trip')
+        key = caching.page_key('history', trip)
+        self.create_bill('Rent', flat)
+        self.assertEqual(caching.page_key('history', trip), key)
+        self.create_bill('Train', trip)
+        self.assertNotEqual(caching.page_key('history', trip), key)
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in ('alice', 'bob')]
+        self.group = join_group(self.users)
+        self.bills = []
+        for i in range(3):
+            bill = Bill.objects.create(creator=self.users[0], amount=Decimal('4.00'), title='Bill %d' % i, group=self.group)
+            bill.create_atoms(self.users[0], self.users)
+            self.bills.append(bill)
+        self.client.force_login(self.users[0].user)
+
+    def test_bills(self):
+        with self.assertNumQueries(6):  # session, user, group, versions, bills, atoms
+            response = self.client.get(reverse('api_bills'), {'size': 2})
+        data = response.json()
+        self.assertEqual([bill['id'] for bill in data['results']], [self.bills[2].pk, self.bills[1].pk])
+        self.assertEqual(sorted(atom['amount'] for atom in data['results'][0]['atoms']), ['-2.00', '-2.00', '4.00'])
+        response = self.client.get(reverse('api_bills'), {'size': 2, 'before': data['next'], 'fields': 'id,title'})
+        self.assertEqual(response.json()['results'], [{'id': self.bills[0].pk, 'title': 'Bill 0'}])
+        self.assertEqual(self.client.get(reverse('api_bills'), {'fields': 'password'}).status_code, 400)
+
+    def test_etag(self):
+        self.client.post(reverse('groups'), {'group': self.group.pk})
+        response = self.client.get(reverse('api_balances'))
+        etag = response['ETag']
+        with self.assertNumQueries(2):  # session, versions
+            response = self.client.get(reverse('api_balances'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        trip = join_group(self.users, 'trip')
+        Bill.objects.create(creator=self.users[1], amount=Decimal('4.00'), title='Train', group=trip).create_atoms(
+            self.users[1], self.users)
+        self.assertEqual(self.client.get(reverse('api_balances'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.bills[0].delete()
+        response = self.client.get(reverse('api_balances'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0], {'id': self.users[0].pk, 'nickname': 'alice', 'balance': '4.00'})
+
+    def test_writes(self):
+        response = self.client.post(reverse('api_bills'), json.dumps({
+            'title': 'Taxi', 'amount': '9.00', 'buyer': self.users[1].pk, 'participants': [user.pk for user in self.users],
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Bill.objects.get(pk=response.json()['id']).check_integrity())
+        response = self.client.post(reverse('api_refunds'), {'amount': '-1', 'buyer': self.users[0].pk, 'participant': self.users[1].pk})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('api_refunds'), {'amount': '1.50', 'buyer': self.users[0].pk, 'participant': self.users[1].pk})
+        self.assertEqual(response.json()['refund'], True)
+
+    def test_anonymous(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('api_atoms')).status_code, 401)
+
+
+class ParticipantPickerTestCase(TestCase):
+    def setUp(self):
+        names = ['alice', 'bob', 'carol'] + ['user%02d' % i for i in range(30)]
+        self.users = [ExtendedUser.objects.create(user=User.objects.create(username=name)) for name in names]
+        self.alice, self.bob, self.carol = self.users[:3]
+        self.group = join_group(self.users)
+        for sharers in ([self.bob], [self.carol], [self.bob], [self.bob, self.carol], [self.carol]):
+            bill = Bill.objects.create(creator=self.alice, amount=Decimal('6.00'), title='Bill', group=self.group)
+            bill.create_atoms(self.alice, sharers)
+        self.client.force_login(self.alice.user)
+
+    def test_form_renders_only_the_selection(self):
+        response = self.client.get(reverse('wizard_bill_form'))
+        self.assertContains(response, 'class="participant-picker"', count=2)
+        self.assertContains(response, 'value="%d"' % self.alice.pk)
+        self.assertNotContains(response, 'user29')
+        self.assertNotContains(response, '/admin/jsi18n/')
+
+    def test_search(self):
+        response = self.client.get(reverse('api_participants'), {'q': 'user1', 'size': 3})
+        self.assertEqual([user['nickname'] for user in response.json()['results']], ['user10', 'user11', 'user12'])
+        self.assertEqual(len(participants.search(self.group, 'user')), 20)
+        self.assertEqual(participants.search(self.group, ''), [])
+        self.assertEqual(participants.search(self.group, 'ALI'), [(self.alice.pk, 'alice')])
+        self.carol.nickname = 'Caro'
+        self.carol.save()
+        self.assertEqual(participants.search(self.group, 'car'), [(self.carol.pk, 'Caro')])
+        self.assertEqual(participants.search(self.group, 'user_'), [])
+        self.assertEqual(participants.search(None, 'user'), [])
+        self.assertEqual(participants.search(join_group([self.users[5]], 'trip'), 'user'), [(self.users[5].pk, 'user02')])
+
+    def test_suggestions(self):
+        response = self.client.get(reverse('api_participant_suggestions'))
+        self.assertEqual(response.json(), {
+            'recent': [{'id': self.carol.pk, 'nickname': 'carol'}, {'id': self.bob.pk, 'nickname': 'bob'}],
+            'frequent': [{'id': self.bob.pk, 'nickname': 'bob'}, {'id': self.carol.pk, 'nickname': 'carol'}],
+        })
+        with self.assertNumQueries(1):  # versions
+            participants.suggestions(self.alice.pk, self.group)
+        bill = Bill.objects.create(creator=self.alice, amount=Decimal('6.00'), title='Bill', group=self.group)
+        bill.create_atoms(self.alice, [self.users[3]])
+        self.assertEqual(participants.suggestions(self.alice.pk, self.group)['recent'][0], (self.users[3].pk, 'user00'))
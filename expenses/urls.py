@@ -4,7 +4,7 @@ from django.conf.urls import url
 
 from django.contrib.auth.views import login, logout
 
-from expenses import views
+from expenses import api, views
 from expenses.forms import BillForm, CustomSplitForm, EmptyForm, CustomSplitFormSet
 
 urlpatterns = [
@@ -13,13 +13,30 @@ urlpatterns = [
     url(r'^bill/edit/(?P<bill_id>\d+)/?$', views.edit_bill, name='wizard_bill_form_edit'),
     url(r'^bill/view/(?P<bill_id>\d+)/?$', views.display_bill, name='display_bill'),
     url(r'^bill/refund/?$', views.RepaymentView.as_view(), name='refund_form'),
+    url(r'^bill/settle/?$', views.view_settlement, name='settlement'),
     url(r'^accounts/create/?$', views.UserCreateView.as_view(), name='user_create'),
     url(r'^accounts/edit/?$', views.UserEditView.as_view(), name='user_edit'),
     url(r'^accounts/login/?$', login, name='login'),
     url(r'^accounts/logout/?$', logout, name='logout'),
     url(r'^accounts/history/?$', views.view_account_history, name='account_history'),
+    url(r'^accounts/debts/?$', views.view_debts, name='debts'),
+    url(r'^accounts/balance-history\.json$', views.view_balance_history_json, name='balance_history_json'),
     url(r'^whatsnew/?$', views.whats_new),
     url(r'^home/?$', views.view_home, name='home'),
+    url(r'^groups/?$', views.view_groups, name='groups'),
     url(r'^balances/?$', views.view_balances, name='balances'),
-    url(r'^history/(?P<history_id>\d+)/?$', views.view_history, name='history'),
+    url(r'^balances\.json$', views.view_balances_json, name='balances_json'),
+    url(r'^analytics/?$', views.view_analytics, name='analytics'),
+    url(r'^analytics\.json$', views.view_analytics_json, name='analytics_json'),
+    url(r'^export/atoms\.(?P<format>csv|jsonl|columns)$', views.export_atoms, name='export_atoms'),
+    url(r'^slow-requests/?$', views.view_slow_requests, name='slow_requests'),
+    url(r'^api/v1/bills/?$', api.bills, name='api_bills'),
+    url(r'^api/v1/bills/(?P<bill_id>\d+)/?$', api.bill, name='api_bill'),
+    url(r'^api/v1/refunds/?$', api.refunds, name='api_refunds'),
+    url(r'^api/v1/atoms/?$', api.atoms, name='api_atoms'),
+    url(r'^api/v1/balances/?$', api.balances, name='api_balances'),
+    url(r'^api/v1/participants/?$', api.participants_search, name='api_participants'),
+    url(r'^api/v1/participants/suggestions/?$', api.participant_suggestions, name='api_participant_suggestions'),
+    url(r'^history/?$', views.view_history, name='history_page'),
+    url(r'^history/(?P<history_id>\d+)/?$', views.view_history_offset, name='history'),
     ]
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import datetime
+from functools import lru_cache
+
 from django.shortcuts import render, redirect, get_object_or_404, get_list_or_404
+from django.conf import settings
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.core.urlresolvers import reverse_lazy
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.views.generic.edit import FormView, UpdateView
 import django
 if django.VERSION[:2] < (1,8):
@@ -13,13 +22,26 @@ else:
     from formtools.wizard.views import SessionWizardView
 from django.forms.models import formset_factory
 
+from expenses import analytics, caching, debts, exporting, groups, instrumentation, ranking, splitting, tasks
 from expenses.forms import BillForm, RepaymentForm, ExtendedUserCreationForm, UserEditForm, CustomSplitForm, CustomSplitFormSet, EmptyForm
-from expenses.models import Atom, Bill, ExtendedUser, User
+from expenses.groups import current_group, group_required
+from expenses.models import Atom, BalanceSnapshot, Bill, Category, ExpenseGroup, ExtendedUser, User
+from expenses.pagination import InvalidCursor, encode_cursor, keyset_page
+from expenses.settlement import create_refunds, current_balances, settle
 
 
 # Bill related
 ###################
 
+@lru_cache(maxsize=64)
+def split_formset(num):
+    """
+    Returns the formset class splitting a bill between ``num`` participants.
+    """
+    # No validate_min: it counts the forms left to their initial split as missing
+    return formset_factory(CustomSplitForm, formset=CustomSplitFormSet, max_num=num, min_num=num, validate_max=True)
+
+
 class WizardBillView(SessionWizardView):
     TEMPLATES = {
         '0': 'bill_wizard/bill_form.html',
@@ -27,9 +49,51 @@ class WizardBillView(SessionWizardView):
         '2': 'bill_wizard/confirmation.html',
     }
 
+    @property
+    def storage_name(self):
+        return getattr(settings, 'EXPENSES_WIZARD_STORAGE', SessionWizardView.storage_name)
+
     def get_template_names(self):
         return self.TEMPLATES[self.steps.current]
 
+    def get_cleaned_data_for_step(self, step):
+        """
+        Validates the stored data of ``step`` once per request, while it doesn't change:
+        each form of the later steps needs the cleaned data of the first one.
+        """
+        if not hasattr(self, '_cleaned_data'):
+            self._cleaned_data = {}
+        data = self.storage.get_step_data(step)
+        if step not in self._cleaned_data or self._cleaned_data[step][0] != data:
+            self._cleaned_data[step] = (data, super().get_cleaned_data_for_step(step))
+        return self._cleaned_data[step][1]
+
+    def initial_split(self, total, num):
+        """
+        Returns the initial shares in cents of ``total`` cents between ``num`` participants, computed once per request.
+        Seeded by ``total``, the split is the same at each step of the wizard without being stored.
+        """
+        if not hasattr(self, '_initial_splits'):
+            self._initial_splits = {}
+        if (total, num) not in self._initial_splits:
+            self._initial_splits[total, num] = splitting.equal_split(total, num, seed=total)
+        return self._initial_splits[total, num]
+
+    def get_form_kwargs(self, step=None):
+        kwargs = super().get_form_kwargs(step)
+        if step == '0':
+            kwargs.update({'group': current_group(self.request)})
+        return kwargs
+
+    def existing_atoms(self):
+        """
+        Returns the ```Bill.atom_map``` of the edited bill, loaded once per request.
+        """
+        if not hasattr(self, '_existing_atoms'):
+            bill = self.instance_dict.get('0', None)
+            self._existing_atoms = bill.atom_map() if bill else {}
+        return self._existing_atoms
+
     def get_form(self, step=None, data=None, files=None):
         base_form = super().get_form(step, data, files)
         if step is None:
@@ -42,25 +106,23 @@ class WizardBillView(SessionWizardView):
             self.total_amount = self.base_data['amount']
         else:
             if bill:
-                base_form.initial.update({'participants': bill.list_of_participants()})
+                buyers = bill.summary_buyers()
+                base_form.initial.update({'participants': [entry.user_id for entry in bill.summary_participants()]})
+                if buyers:
+                    base_form.initial.update({'buyer': buyers[0].user_id})
             else:
                 base_form.initial.update({'buyer': self.request.user.extendeduser})
 
         if step == '1':
             num = len(participants)
-            BillFormset = formset_factory(CustomSplitForm, formset=CustomSplitFormSet, max_num=num, min_num=num, validate_max=True, validate_min=True)
-            participants, splitted_amount = zip(*Bill(amount=self.total_amount).equal_split(participants))
-            initial = [{'amount': -amount} for amount in splitted_amount]
-            formset = BillFormset(self.total_amount, data, initial=initial)
+            shares = self.initial_split(splitting.to_cents(self.total_amount), num)
+            initial = [{'amount': splitting.from_cents(cents)} for cents in shares]
+            formset = split_formset(num)(self.total_amount, data, initial=initial)
+            existing = self.existing_atoms()
             for (form, user) in zip(formset, participants):
                 form.user = user
-                try:
-                    if not bill:
-                        raise Atom.DoesNotExist()
-                    prev = -bill.atoms.get(user=user, amount__lte=0).amount
-                    form.initial.update({'amount': prev})
-                except Atom.DoesNotExist:
-                    pass
+                if (user.pk, False) in existing:
+                    form.initial.update({'amount': -existing[user.pk, False].amount})
             self.atom_forms = [form for form in formset]
             return formset
         else:
@@ -81,25 +143,25 @@ class WizardBillView(SessionWizardView):
         return context
 
     def done(self, form_list, form_dict, **kwargs):
-        with form_dict['0'].save(commit=False) as bill_model:
+        with transaction.atomic(), form_dict['0'].save(commit=False) as bill_model:
             bill_model.creator = self.request.user.extendeduser
+            if bill_model.pk is None:
+                bill_model.group = current_group(self.request)
             bill_model.save() #Register the object to the database
 
-            for atom in bill_model.atoms.all():
-                atom.delete()
-
+            atoms = []
             for form in form_dict['1']:
                 atom_model = form.save(commit=False)
                 atom_model.amount = -atom_model.amount
-                atom_model.child_of_bill = bill_model
-                atom_model.save()
-            Atom.objects.create(amount=bill_model.amount, user=form_dict['0'].cleaned_data['buyer'], child_of_bill=bill_model)
-
-            bill_model.update_amount()
-            bill_model.save()
+                atoms.append(atom_model)
+            atoms.append(Atom(amount=bill_model.amount, user=form_dict['0'].cleaned_data['buyer']))
+            # Only the atoms that differ are written, none when only the title or description changed
+            bill_model.sync_atoms(atoms, self.existing_atoms())
+            tasks.notify_involved(bill_model)
         return redirect('home')
 
     @method_decorator(login_required)
+    @method_decorator(group_required)
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
 
@@ -109,35 +171,58 @@ class NormalBillView(FormView):
     form_class = BillForm
     success_url = reverse_lazy('home')
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs.update({'group': current_group(self.request)})
+        return kwargs
+
     def form_valid(self, form):
-        with form.save(commit=False) as bill_model:
+        with transaction.atomic(), form.save(commit=False) as bill_model:
             bill_model.creator = self.request.user.extendeduser
+            bill_model.group = current_group(self.request)
             cleaned_form = form.cleaned_data
 
             bill_model.save()
             bill_model.create_atoms(cleaned_form['buyer'], cleaned_form['participants'])
-            bill_model.update_amount()
-            bill_model.save()
+            tasks.notify_involved(bill_model)
         return super().form_valid(form)
 
     @method_decorator(login_required)
+    @method_decorator(group_required)
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
 
 @login_required
+@group_required
 def edit_bill(request, bill_id):
-    bill = get_object_or_404(Bill, pk=bill_id)
+    bill = get_object_or_404(Bill, pk=bill_id, group=current_group(request))
     return WizardBillView.as_view([BillForm, CustomSplitForm, EmptyForm],
         instance_dict={
             '0': bill,
     })(request)
 
 @login_required
+@group_required
+def view_settlement(request):
+    """
+    Returns the transfers which would settle all the balances, and creates the matching refunds on POST.
+    """
+    group = current_group(request)
+    transfers = settle(current_balances(group=group))
+    if request.method == 'POST':
+        create_refunds(transfers, request.user.extendeduser, group)
+        return redirect('balances')
+    nicknames = dict(groups.members(group).values_list('pk', 'nickname'))
+    transfers = [(nicknames[transfer.debtor], nicknames[transfer.creditor], transfer.amount) for transfer in transfers]
+    return render(request, 'settlement.html', {'transfers': transfers})
+
+@login_required
+@group_required
 def display_bill(request, bill_id):
     """
     Returns a presentation page for the ```Bill``` instance corresponding to ```bill_id```.
     """
-    bill = get_object_or_404(Bill, pk=bill_id)
+    bill = get_object_or_404(Bill.objects.select_related('creator'), pk=bill_id, group=current_group(request))
     return render(request, 'display_bill.html', {'bill': bill})
 
 
@@ -147,16 +232,16 @@ class RepaymentView(FormView):
     success_url = reverse_lazy('home')
 
     def form_valid(self, form):
-        with form.save(commit=False) as refund_model:
+        with transaction.atomic(), form.save(commit=False) as refund_model:
             refund_model.refund = True
             refund_model.creator = self.request.user.extendeduser
+            refund_model.group = current_group(self.request)
             refund_model.title = refund_model.refund_name()
             cleaned_form = form.cleaned_data
 
             refund_model.save()
             refund_model.create_atoms(cleaned_form['buyer'], cleaned_form['participant'], True)
-            refund_model.update_amount()
-            refund_model.save()
+            tasks.notify_involved(refund_model)
         return super().form_valid(form)
 
     def get_initial(self):
@@ -164,11 +249,100 @@ class RepaymentView(FormView):
         initial.update({'buyer': self.request.user.extendeduser})
         return initial
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs.update({'group': current_group(self.request)})
+        return kwargs
+
     @method_decorator(login_required)
+    @method_decorator(group_required)
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
 
 
+def spending_report(request):
+    """
+    Returns the (labels, report) of the spending in the current group described by the GET parameters of ``request``:
+    ``by`` user or category, ``period`` (day, week or month), ``start`` and ``end`` dates and ``category`` names.
+    The year to date spending by category and month is returned by default.
+    """
+    by = request.GET.get('by', 'category')
+    period = request.GET.get('period', 'month')
+    if by not in analytics.ROLLUPS or period not in analytics.PERIODS:
+        raise ValueError()
+    end = parse_date(request.GET.get('end', '')) or timezone.localdate()
+    start = parse_date(request.GET.get('start', '')) or end.replace(month=1, day=1)
+    if by == 'category':
+        labels = dict(Category.objects.values_list('pk', 'name'))
+    else:
+        labels = dict(ExtendedUser.objects.values_list('pk', 'nickname'))
+    keys = None
+    if request.GET.getlist('category') and by == 'category':
+        keys = [pk for pk, name in labels.items() if name in request.GET.getlist('category')]
+    return labels, analytics.spending(by, period, start, end, keys, group=current_group(request))
+
+
+@login_required
+@group_required
+def view_analytics(request):
+    """
+    Returns a table of the spending by period, see ```spending_report```.
+    """
+    try:
+        labels, report = spending_report(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    keys = sorted({key for totals in report.values() for key in totals}, key=lambda key: labels[key])
+    rows = [(start, [totals.get(key, 0) for key in keys], sum(totals.values())) for start, totals in report.items()]
+    return render(request, 'analytics.html', {'columns': [labels[key] for key in keys], 'rows': rows})
+
+
+@login_required
+@group_required
+def view_analytics_json(request):
+    """
+    Returns the spending by period as JSON, see ```spending_report```.
+    """
+    try:
+        labels, report = spending_report(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    return JsonResponse({'spending': [
+        {'period': start.isoformat(), 'totals': {labels[key]: str(amount) for key, amount in totals.items()}}
+        for start, totals in report.items()
+    ]})
+
+
+@staff_member_required
+def export_atoms(request, format):
+    """
+    Streams the atoms with their bill, user and categories, and with ``since`` the deleted atoms,
+    see ```expenses.exporting```. The ``start``, ``end`` and ``since`` parameters are ISO datetimes.
+    """
+    try:
+        start, end, since = [parse_datetime(request.GET[name]) if request.GET.get(name) else None
+                             for name in ('start', 'end', 'since')]
+        start, end, since = [timezone.make_aware(moment) if moment and timezone.is_naive(moment) else moment
+                             for moment in (start, end, since)]
+    except ValueError:
+        return HttpResponseBadRequest()
+    chunks = exporting.export_chunks(start, end, since)
+    response = StreamingHttpResponse(exporting.write_chunks(chunks, format), content_type=exporting.FORMATS[format])
+    response['Content-Disposition'] = 'attachment; filename="atoms.%s"' % format
+    return response
+
+
+@staff_member_required
+def view_slow_requests(request):
+    """
+    Returns the slowest requests recorded by the ```InstrumentationMiddleware```, and forgets them on POST.
+    """
+    if request.method == 'POST':
+        instrumentation.slow_requests.clear()
+        return redirect('slow_requests')
+    return render(request, 'slow_requests.html', {'entries': instrumentation.slow_requests.entries()})
+
+
 # User management
 ###################
 
@@ -216,8 +390,9 @@ def view_account_history(request):
     Returns a presentation of the last 20 operations as a buyer and as a participant.
     """
     user = request.user.extendeduser
-    buyers_atoms = Atom.objects.filter(user=user).filter(amount__gt=0).order_by('-id')[:20]
-    participants_atoms = Atom.objects.filter(user=user).filter(amount__lt=0).order_by('-id')[:20]
+    atoms = Atom.objects.filter(user=user).select_related('child_of_bill').order_by('-id')
+    buyers_atoms = atoms.filter(amount__gt=0)[:20]
+    participants_atoms = atoms.filter(amount__lt=0)[:20]
 
     buyers_table = [(elmt.child_of_bill.title, elmt.amount, elmt.date) for elmt in buyers_atoms]
     participants_table = [(elmt.child_of_bill.title, elmt.amount, elmt.date) for elmt in participants_atoms]
@@ -225,49 +400,146 @@ def view_account_history(request):
 
 
 @login_required
+@group_required
 def whats_new(request):  # TODO: Remove this view ?
     user = request.user.extendeduser
-    last_actions = Bill.objects.all().order_by('-id')[:10]
-    last_actions_list = [(action, (user in action.list_of_people_involved())) for action in last_actions]
-    return render(request, 'whatsnew.html', {'last_actions': last_actions_list})
+    group = current_group(request)
+
+    def last_actions():
+        bills = Bill.objects.select_related('creator').filter(group=group).order_by('-date', '-id')[:10]
+        return [(bill, user.pk in bill.involved_ids()) for bill in bills]
+    return render(request, 'whatsnew.html', {'last_actions': caching.cached_page('whats_new', group, last_actions, user.pk)})
 
 
 @login_required
+@group_required
 def view_home(request):
     """
     Returns the ```User``` home page.
-    Contains the user ```balance``` and the last 5 bills registered.
+    Contains the user ```balance``` and the last 5 bills registered, within the current group.
     """
-    status = 'neutral'
-    if request.user.extendeduser.balance < 0:
-        status = 'negative'
-    elif request.user.extendeduser.balance > 0:
-        status = 'positive'
-    balance = request.user.extendeduser.balance
-    last_bills = Bill.objects.all().order_by('-id')[:5]
-    return render(request, 'home.html', {'balance': balance, 'status': status, 'last_bills': last_bills})
+    group = current_group(request)
+
+    def home_context():
+        balance = group.memberships.get(user__user_id=request.user.pk).balance
+        status = 'neutral'
+        if balance < 0:
+            status = 'negative'
+        elif balance > 0:
+            status = 'positive'
+        last_bills = list(Bill.objects.select_related('creator').filter(group=group).order_by('-date', '-id')[:5])
+        return {'balance': balance, 'status': status, 'last_bills': last_bills}
+    return render(request, 'home.html', caching.cached_page('home', group, home_context, request.user.pk))
 
 
 @login_required
+@group_required
 def view_balances(request):
     """
-    Returns a presentation of the ```balance``` of each users.
+    Returns a presentation of the ```balance``` of each users of the current group.
+    """
+    rows = ranking.leaderboard(current_group(request))
+    return render(request, 'balances.html', {'rows': rows})
+
+
+@login_required
+def view_balance_history_json(request):
+    """
+    Returns the daily ```balance``` of the current user between the ``start`` and ``end`` dates as JSON.
+    The last 30 days are returned by default.
+    """
+    user = request.user.extendeduser
+    try:
+        end = parse_date(request.GET.get('end', '')) or timezone.localdate()
+        start = parse_date(request.GET.get('start', '')) or end - datetime.timedelta(days=30)
+    except ValueError:
+        return HttpResponseBadRequest()
+    if start > end or (end - start).days > settings.EXPENSES_BALANCE_HISTORY_MAX_DAYS:
+        return HttpResponseBadRequest()
+    try:
+        with transaction.atomic():
+            BalanceSnapshot.objects.build(users=[user.pk])
+    except IntegrityError:
+        pass  # Built by a concurrent request or by the run_tasks worker
+    series = BalanceSnapshot.objects.series(user, start, end)
+    return JsonResponse({'balances': [{'day': day.isoformat(), 'balance': str(balance)} for day, balance in series]})
+
+
+@login_required
+@group_required
+def view_debts(request):
+    """
+    Returns what the current user owes to each other member of the current group, and what each of them owes back.
+    """
+    owes, owed = debts.debts_of(request.user.extendeduser.pk, current_group(request))
+    nicknames = dict(ExtendedUser.objects.filter(pk__in=[pk for pk, _ in owes + owed]).values_list('pk', 'nickname'))
+    return render(request, 'debts.html', {
+        'owes': [(nicknames[pk], amount) for pk, amount in owes],
+        'owed': [(nicknames[pk], amount) for pk, amount in owed],
+    })
+
+
+@login_required
+@group_required
+def view_balances_json(request):
+    """
+    Returns the ```balance``` of each users as JSON, ordered by decreasing balance.
     """
-    users = ExtendedUser.objects.all()
-    return render(request, 'balances.html', {'users': users})
+    rows = ranking.leaderboard(current_group(request))
+    return JsonResponse({'balances': [
+        {'id': row.pk, 'nickname': row.nickname, 'balance': str(row.balance)} for row in rows
+    ]})
 
 @login_required
-def view_history(request, history_id):
+@group_required
+def view_history(request):
+    """
+    Returns a page of the bills history, navigated with the ``before`` and ``after`` cursors.
+    The page size can be set with ``size``, up to ``EXPENSES_HISTORY_MAX_PAGE_SIZE``.
+    """
+    try:
+        size = int(request.GET.get('size', settings.EXPENSES_HISTORY_PAGE_SIZE))
+        size = min(max(size, 1), settings.EXPENSES_HISTORY_MAX_PAGE_SIZE)
+        group = current_group(request)
+        before, after = request.GET.get('before'), request.GET.get('after')
+        page = caching.cached_page('history', group, lambda: keyset_page(
+            Bill.objects.select_related('creator').filter(group=group), size, before=before, after=after), size, before, after)
+    except (ValueError, InvalidCursor):
+        raise Http404()
+    params = {'bills': page.items, 'previous_cursor': page.previous_cursor, 'next_cursor': page.next_cursor}
+    if size != settings.EXPENSES_HISTORY_PAGE_SIZE:
+        params['size'] = size
+    return render(request, 'history.html', params)
+
+
+@login_required
+@group_required
+def view_history_offset(request, history_id):
+    """
+    Compatibility view for the former ``/history/<n>`` pages of 10 bills.
+    """
     history_id = int(history_id)
-    queryset = Bill.objects.all().order_by('-id')[history_id*10:(history_id + 1)*10]
+    queryset = Bill.objects.select_related('creator').filter(group=current_group(request)).order_by('-date', '-id')[history_id*10:(history_id + 1)*10 + 1]
     bills = get_list_or_404(queryset)
-    if history_id == 0:
-        has_previous = False
-    else:
-        has_previous = True
-    if len(queryset) < 10:
-        has_next = False
-    else:
-        has_next = True
-    params = {'bills': bills, 'has_previous': has_previous, 'has_next': has_next, 'id': history_id}
+    params = {
+        'bills': bills[:10],
+        'previous_cursor': encode_cursor(bills[0]) if history_id > 0 else None,
+        'next_cursor': encode_cursor(bills[9]) if len(bills) > 10 else None,
+    }
     return render(request, 'history.html', params)
+
+
+@login_required
+def view_groups(request):
+    """
+    Lists the groups of the current user, and selects the current group on POST.
+    """
+    user_groups = ExpenseGroup.objects.filter(memberships__user__user_id=request.user.pk).order_by('name', 'pk')
+    if request.method == 'POST':
+        try:
+            group = user_groups.get(pk=request.POST.get('group'))
+        except (ExpenseGroup.DoesNotExist, ValueError):
+            return HttpResponseBadRequest()
+        groups.select_group(request, group)
+        return redirect('home')
+    return render(request, 'groups.html', {'groups': user_groups, 'current': current_group(request)})
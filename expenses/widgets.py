@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Form widgets of the expenses pages.
+"""
+from django import forms
+from django.core.urlresolvers import reverse
+
+from expenses.models import ExtendedUser
+
+
+class ParticipantWidget(forms.Widget):
+    """
+    Search-as-you-type picker of ```ExtendedUser```, for the fields whose choices are all the users.
+
+    Only the selected users are rendered, as hidden inputs: the others are looked up by the
+    ``api_participants`` endpoint and suggested by ``api_participant_suggestions``, see ``participants.js``.
+    """
+    template_name = 'widgets/participants.html'
+
+    class Media:
+        js = ['/static/specific/participants.js']
+
+    def __init__(self, attrs=None, multiple=True):
+        super().__init__(attrs)
+        self.allow_multiple_selected = multiple
+
+    def format_value(self, value):
+        if value is None or value == '':
+            return []
+        if isinstance(value, (str, int, ExtendedUser)):
+            value = [value]
+        pks = []
+        for item in value:
+            try:
+                pks.append(int(getattr(item, 'pk', item)))
+            except (TypeError, ValueError):
+                pass
+        return pks
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        pks = context['widget']['value']
+        nicknames = dict(ExtendedUser.objects.filter(pk__in=pks).values_list('pk', 'nickname')) if pks else {}
+        context['widget'].update({
+            'selected': [(pk, nicknames[pk]) for pk in pks if pk in nicknames],
+            'multiple': self.allow_multiple_selected,
+            'search_url': reverse('api_participants'),
+            'suggestions_url': reverse('api_participant_suggestions'),
+        })
+        return context
+
+    def value_from_datadict(self, data, files, name):
+        if self.allow_multiple_selected and hasattr(data, 'getlist'):
+            return data.getlist(name)
+        return data.get(name)
+
+    def value_omitted_from_data(self, data, files, name):
+        # An empty selection posts nothing
+        return False if self.allow_multiple_selected else name not in data
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact storages of the bill wizard, see ```WizardBillView```, selected by ``EXPENSES_WIZARD_STORAGE``.
+
+Instead of the whole POST data in the session, each step keeps only its own fields: ids as they were
+posted and amounts as integer cents. The data lives either in the ``EXPENSES_WIZARD_CACHE`` under a random token
+kept in a signed cookie (```CompactCacheStorage```) or in a signed cookie (```CompactCookieStorage```): none of them
+writes the session.
+
+A wizard in progress must reach the next step whatever the server process and whatever the other cached data:
+the ``EXPENSES_WIZARD_CACHE`` is a cache of its own, shared by the processes (e.g. the database cache) and large
+enough not to cull the pending wizards.
+"""
+from decimal import Decimal, InvalidOperation
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import get_random_string
+from django.utils.datastructures import MultiValueDict
+if django.VERSION[:2] < (1,8):
+    from django.contrib.formtools.wizard.storage.base import BaseStorage
+    from django.contrib.formtools.wizard.storage.cookie import CookieStorage
+else:
+    from formtools.wizard.storage.base import BaseStorage
+    from formtools.wizard.storage.cookie import CookieStorage
+
+from expenses import caching, splitting
+
+
+AMOUNT_SUFFIX = '-amount'
+DROPPED_FIELDS = ('csrfmiddlewaretoken', )
+LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+
+def get_cache():
+    """
+    Returns the ``EXPENSES_WIZARD_CACHE``, refusing the page cache and the caches local to a process.
+    """
+    alias = getattr(settings, 'EXPENSES_WIZARD_CACHE', None)
+    if alias is None or alias == getattr(settings, 'EXPENSES_CACHE', 'default'):
+        raise ImproperlyConfigured("CompactCacheStorage requires EXPENSES_WIZARD_CACHE, a cache alias of its own")
+    if settings.CACHES[alias]['BACKEND'] in LOCAL_CACHES:
+        raise ImproperlyConfigured("EXPENSES_WIZARD_CACHE must be shared by the server processes")
+    return caches[alias]
+
+
+def _to_cents(value):
+    """
+    Returns the amount ``value`` as integer cents, or unchanged if it isn't a whole number of cents.
+    """
+    try:
+        return splitting.to_cents(Decimal(value))
+    except (InvalidOperation, ValueError, OverflowError):
+        return value
+
+
+def compact(data):
+    """
+    Returns the dict of lists ``data`` posted for a step without the wizard management fields, the single
+    values unwrapped and the amounts converted to cents.
+    """
+    compacted = {}
+    for key, values in data.items():
+        if key in DROPPED_FIELDS or key.endswith('-current_step'):
+            continue
+        if key.endswith(AMOUNT_SUFFIX):
+            values = [_to_cents(value) for value in values]
+        compacted[key] = values[0] if len(values) == 1 else values
+    return compacted
+
+
+def expand(compacted):
+    """
+    Returns the dict of lists of strings that ```compact``` reduced to ``compacted``.
+    """
+    data = {}
+    for key, values in compacted.items():
+        values = values if isinstance(values, list) else [values]
+        data[key] = [str(splitting.from_cents(value)) if isinstance(value, int) else value for value in values]
+    return data
+
+
+class CompactStorageMixin:
+    def get_step_data(self, step):
+        values = self.data[self.step_data_key].get(step, None)
+        if values is not None:
+            values = MultiValueDict(expand(values))
+        return values
+
+    def set_step_data(self, step, cleaned_data):
+        if isinstance(cleaned_data, MultiValueDict):
+            cleaned_data = dict(cleaned_data.lists())
+        self.data[self.step_data_key][step] = compact(cleaned_data)
+
+
+class CompactCookieStorage(CompactStorageMixin, CookieStorage):
+    """
+    Keeps the data in the cookie: only for small groups, as the browsers drop the cookies over 4 KB
+    and the wizard then restarts.
+    """
+
+
+class CompactCacheStorage(CompactStorageMixin, BaseStorage):
+    """
+    Keeps the data in the ``EXPENSES_WIZARD_CACHE`` for ``EXPENSES_WIZARD_TIMEOUT`` seconds, only its token goes
+    in the cookie.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token = self.request.get_signed_cookie(self.prefix, default=None)
+        self.data = get_cache().get(self.cache_key()) if self.token else None
+        if self.data is None:
+            self.token = self.token or get_random_string(32)
+            self.init_data()
+
+    def cache_key(self):
+        return '%s:wizard:%s' % (caching.PREFIX, self.token)
+
+    def update_response(self, response):
+        super().update_response(response)
+        get_cache().set(self.cache_key(), self.data, getattr(settings, 'EXPENSES_WIZARD_TIMEOUT', 86400))
+        response.set_signed_cookie(self.prefix, self.token, httponly=True)